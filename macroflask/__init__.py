@@ -7,7 +7,7 @@ from macroflask.models import Base, db
 from macroflask.api import api_bp, enable_dynamic_api
 from macroflask.system.rest_mgmt import ResponseHandler
 from macroflask.system.sys_ext.flask_ext import FlaskRequestMiddleware
-from macroflask.system.sys_ext.loading_jwt import jwt_manager
+from macroflask.system.sys_ext.loading_jwt import jwt_manager, get_current_identity
 from macroflask.system.sys_ext.loading_logger import logging_manager, sys_logger
 from macroflask.system.sys_api import system_api_bp
 
@@ -32,8 +32,17 @@ def create_app():
             "engine_options": {}
         }
     }
+    if get_config().DB_CONNECTION_BUDGET:
+        db_config_dict['database1']['connection_budget'] = get_config().DB_CONNECTION_BUDGET
     db.set_logger(sys_logger)
-    db.init_flask_app(app, db_config_dict)
+    db.set_sqlalchemy_logging(echo_sql=get_config().SQL_ECHO)
+    slow_query_options = {"threshold_ms": get_config().SLOW_QUERY_THRESHOLD_MS}
+    # pin the reads of a user to the primary for a few seconds after the user writes
+    consistency_options = {"read_your_writes": True, "sticky_window": 5, "key_func": get_current_identity}
+    # connect to the databases in the background, so a slow or down database does not block the startup
+    db.init_flask_app(app, db_config_dict, consistency_options=consistency_options,
+                      slow_query_options=slow_query_options, connect_mode="background",
+                      session_scope=get_config().DB_SESSION_SCOPE)
     # Base.metadata.create_all(db.bind_model_engines[Base])
 
     # jwt config
@@ -40,6 +40,7 @@ user_config = {
     'module_id': ModuleConstant.USER,
     'create': {'permission_bitmask': PermissionsConstant.READ},
     'read_all': {'permission_bitmask': PermissionsConstant.READ},
+    'export': {'permission_bitmask': PermissionsConstant.READ},
     'read_one': {'permission_bitmask': PermissionsConstant.READ},
     'update': {'permission_bitmask': PermissionsConstant.UPDATE},
     'delete': {'permission_bitmask': PermissionsConstant.DELETE},
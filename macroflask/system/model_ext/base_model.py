@@ -1,12 +1,47 @@
+from sqlalchemy import inspect
+
 from macroflask.models import db
 from macroflask.system.logging_producer import LoggingProducer
 from macroflask.system.model_ext.query_processor import QueryRequest, QueryProcessor
+from macroflask.util.fork_util import register_after_fork
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy, RoutingSession
+from macroflask.util.result_cache import ResultCache
+
+# the results of read_all of the models with a result_cache_ttl, invalidated by the commits writing to their tables
+result_cache = ResultCache()
+result_cache.track_writes(RoutingSession, LightSqlAlchemy)
+register_after_fork(result_cache, "after_fork")
 
 
 class ModelExtMixin:
 
     create_schema = None
     update_schema = None
+    # the reads go to a read bind when one is configured for the model, True keeps them on the primary
+    read_from_primary = False
+    # the fields of to_dict() and of the rows of read_all, None means all the columns
+    dict_fields = None
+    # the number of seconds the results of read_all are cached, None disables the cache
+    result_cache_ttl = None
+
+    @classmethod
+    def get_dict_fields(cls):
+        if cls.dict_fields is not None:
+            return list(cls.dict_fields)
+        return list(inspect(cls).column_attrs.keys())
+
+    @classmethod
+    def get_plain_fields(cls):
+        """
+        Return the fields read_all and stream_all select as plain rows instead of loading the ORM objects,
+        None when the model overrides to_dict().
+        """
+        if cls.to_dict is not ModelExtMixin.to_dict:
+            return None
+        return cls.get_dict_fields()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.get_dict_fields()}
 
     @classmethod
     def create(cls, data, **kwargs):
@@ -28,19 +63,127 @@ class ModelExtMixin:
 
         return created_data
 
+    @classmethod
+    def bulk_create(cls, rows, chunk_size=1000, upsert=False, **kwargs):
+        """
+        Insert many rows at once without creating the ORM objects, see LightSqlAlchemy.bulk_insert.
+        The rows are not validated by the create_schema and before_create is not called.
+
+        :param rows: The iterable of dictionaries keyed by column name.
+        :param chunk_size: The number of rows of each executemany and transaction.
+        :param upsert: Whether to update the rows which already exist.
+        :return: The dictionary of the written rows, chunks, seconds and rows_per_second.
+        """
+        if upsert:
+            result = db.bulk_upsert(cls, rows, chunk_size=chunk_size)
+        else:
+            result = db.bulk_insert(cls, rows, chunk_size=chunk_size)
+        LoggingProducer.log_save_success(kwargs, result)
+        return result
+
+    @classmethod
+    def get_read_operation_type(cls, **kwargs):
+        """
+        Pick the session of the read paths, see LightSqlAlchemy.get_read_operation_type.
+
+        :param kwargs: read_from_primary overrides the read_from_primary of the model for one call.
+        :return: 'read' or 'write'.
+        """
+        return db.get_read_operation_type(cls, kwargs.get('read_from_primary', cls.read_from_primary))
+
     @classmethod
     def read_all(cls, request_body, **kwargs):
-        with db.get_db_session() as session:
-            query_request = QueryRequest(request_body)
-            query_processor = QueryProcessor(cls, session, None, query_request)
+        """
+        Read the rows matching a query request. The results of a model with a result_cache_ttl are cached
+        by request until the ttl expires or a commit writes to the tables they read.
+
+        The cache is skipped while the reads of the caller are pinned to the primary after a write, and a result
+        read from a replica is only cached once the replica has replayed the last write of its tables,
+        otherwise the rows before the write would be cached under the versions after it.
+
+        :param request_body: The query request body, see QueryRequest.
+        :return: The list of dictionaries, or {"items", ...} with cursor pagination or with_total.
+        """
+        query_request = QueryRequest(request_body)
+        if cls.result_cache_ttl is None or db._is_read_sticky():
+            return cls._read_all(query_request, **kwargs)
+
+        key = (cls, db.get_tenant(), query_request.get_cache_key())
+        tables = cls._get_read_tables(query_request)
+        versions = result_cache.get_versions(tables)
+        result = result_cache.get(key, versions)
+        if result is None:
+            read_engines = []
+            result = cls._read_all(query_request, read_engines=read_engines, **kwargs)
+            last_write_time = result_cache.get_last_write_time(tables)
+            if all(db.has_caught_up(engine, last_write_time) for engine in read_engines):
+                result_cache.put(key, versions, result, cls.result_cache_ttl)
+        return result
+
+    @classmethod
+    def _get_read_tables(cls, query_request):
+        """ Return the names of the tables read by a query request: the model and its requested relations. """
+        relationships = inspect(cls).relationships
+        names = {relation if isinstance(relation, str) else relation['name']
+                 for relation in query_request.get_relations()}
+        names.update(field.split('.', 1)[0] for field in query_request.get_need_fields() + query_request.get_group_by()
+                     if '.' in field and '(' not in field)
+        mappers = [inspect(cls)] + [relationships[name].mapper for name in sorted(names) if name in relationships]
+        return sorted({table.name for mapper in mappers for table in mapper.tables})
+
+    @classmethod
+    def _read_all(cls, query_request, read_engines=None, **kwargs):
+        """
+        :param read_engines: A list to append the engine which served the read to, a sharded model is read
+            from the primaries of its shards.
+        """
+        with db.get_db_session(cls.get_read_operation_type(**kwargs)) as session:
+            if read_engines is not None and db.get_shard_set(cls) is None:
+                read_engines.append(session.get_bind(mapper=cls))
+            query_processor = QueryProcessor(cls, session, None, query_request, plain_fields=cls.get_plain_fields())
             query_result = query_processor.process()
-        return query_result
+            if not query_processor.get_fields():
+                # the instances are expired when the read session is rolled back
+                query_result = [dict(instance.to_dict(), **query_processor.get_relation_data(instance))
+                                for instance in query_result]
+        if not query_request.is_cursor_pagination() and not query_request.get_total_strategy():
+            return query_result
+
+        page = {"items": query_result}
+        if query_request.is_cursor_pagination():
+            # the client passes next_cursor as 'after' or prev_cursor as 'before' to get the adjacent page
+            page.update(next_cursor=query_processor.next_cursor, prev_cursor=query_processor.prev_cursor)
+        if query_request.get_total_strategy():
+            page.update(total=query_processor.total, total_is_estimate=query_processor.total_is_estimate)
+        return page
+
+    @classmethod
+    def stream_all(cls, request_body, batch_size=1000, **kwargs):
+        """
+        Iterate all the rows matching the query request as dictionaries with a server-side cursor,
+        the memory use does not grow with the number of rows. The pagination is optional.
+
+        :param request_body: The query request body, see QueryRequest.
+        :param batch_size: The number of rows fetched from the database at a time.
+        :yield: The dictionaries keyed by field name.
+        """
+        with db.get_db_session(cls.get_read_operation_type(**kwargs)) as session:
+            query_request = QueryRequest(request_body, require_pagination=False)
+            query_processor = QueryProcessor(cls, session, None, query_request, plain_fields=cls.get_plain_fields())
+            query = query_processor.build_query()
+            if query_processor.get_fields():
+                yield from db.stream(query, batch_size=batch_size, plain_rows=True)
+            else:
+                # to_dict() decides which fields of the instances are exposed
+                for instance in db.stream(query, batch_size=batch_size):
+                    yield dict(instance.to_dict(), **query_processor.get_relation_data(instance))
 
     @classmethod
     def read_one(cls, id, **kwargs):
-        with db.get_db_session() as session:
+        with db.get_db_session(cls.get_read_operation_type(**kwargs)) as session:
             instance = session.query(cls).get(id)
-        return instance.to_dict()
+            data = instance.to_dict()
+        return data
 
     @classmethod
     def update(cls, id, data, **kwargs):
@@ -1,6 +1,7 @@
+import json
 import traceback
 
-from flask import request, jsonify, abort, g
+from flask import Response, request, jsonify, abort, g, stream_with_context
 from functools import wraps
 from flask_jwt_extended import jwt_required
 
@@ -10,6 +11,10 @@ from macroflask.util.os_util import UUIDUtil
 
 
 class DynamicBlueprintManager:
+    # the number of rows the export reads from the database at a time, the request may ask for fewer or more
+    EXPORT_BATCH_SIZE = 1000
+    MAX_EXPORT_BATCH_SIZE = 10000
+
     def __init__(self, blueprint, model, config):
         self.blueprint = blueprint
         self.model = model
@@ -21,6 +26,8 @@ class DynamicBlueprintManager:
             self._add_route('create', methods=['POST'])
         if self.config.get('read_all', False):
             self._add_route('read_all', methods=['POST'])
+        if self.config.get('export', False):
+            self._add_route('export', methods=['POST'])
         if self.config.get('read_one', False):
             self._add_route('read_one', methods=['GET'], detail=True)
         if self.config.get('update', False):
@@ -50,6 +57,8 @@ class DynamicBlueprintManager:
                 return self._create(uuid=uuid)
             elif action == 'read_all':
                 return self._read_all(uuid=uuid)
+            elif action == 'export':
+                return self._export(uuid=uuid)
             elif action == 'read_one':
                 return self._read_one(kwargs['id'], uuid=uuid)
             elif action == 'update':
@@ -59,6 +68,8 @@ class DynamicBlueprintManager:
             else:
                 ResponseHandler.error("Invalid action")
 
+        # the reads of the action are routed to the read bind, unless the action config keeps them on the primary
+        view_func.read_from_primary = self.config[action].get('read_from_primary', False)
         return view_func
 
     def _create(self, **kwargs):
@@ -93,6 +104,40 @@ class DynamicBlueprintManager:
             return ResponseHandler.error(msg)
         return ResponseHandler.success(msg, data=query_result)
 
+    def _export(self, **kwargs):
+        """
+        Stream all the rows matching the query request as JSON lines, the rows are read from the
+        database in batches while the response is sent.
+
+        The first batch is read before the response starts, so an invalid request gets an error response
+        instead of a truncated stream.
+        """
+        request_body = request.json or {}
+        batch_size = request_body.get('batch_size', self.EXPORT_BATCH_SIZE)
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or batch_size <= 0:
+            return ResponseHandler.error("batch_size must be a positive integer")
+        batch_size = min(batch_size, self.MAX_EXPORT_BATCH_SIZE)
+
+        rows = self.model.stream_all(request_body, batch_size=batch_size)
+        try:
+            first_row = next(rows, None)
+        except Exception as e:
+            rows.close()
+            return ResponseHandler.error(str(e))
+
+        def generate():
+            try:
+                if first_row is None:
+                    return
+                yield json.dumps(first_row, default=str) + "\n"
+                for row in rows:
+                    yield json.dumps(row, default=str) + "\n"
+            finally:
+                # release the session when the client disconnects
+                rows.close()
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
     def _read_one(self, id, **kwargs):
         data = self.model.read_one(id)
         return ResponseHandler.success("success_access", data=data)
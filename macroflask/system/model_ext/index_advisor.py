@@ -0,0 +1,111 @@
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
+
+from macroflask.system.model_ext.query_processor import QueryProcessor
+
+
+class IndexAdvisor:
+    # the filter operators an index can seek, '!=' and 'like' with a leading '%' scan it
+    EQUALITY_OPS = ('==', 'in')
+    RANGE_OPS = ('>', '<', '>=', '<=')
+
+    def __init__(self, router, shape_stats=None):
+        """
+        Explain the query shapes recorded by QueryProcessor and suggest the composite indexes they miss.
+
+        :param router: The LightSqlAlchemy object which binds the models.
+        :param shape_stats: The QueryShapeStats of the shapes, QueryProcessor.shape_stats by default.
+        """
+        self.router = router
+        self.shape_stats = shape_stats if shape_stats is not None else QueryProcessor.shape_stats
+
+    def advise(self, order_by="total_ms", limit=10):
+        """
+        Explain the top shapes with the last request of each shape.
+
+        :param order_by: The field of the shapes to sort by in descending order, see QueryShapeStats.get_top.
+        :param limit: The maximum number of shapes.
+        :return: The list of the shape dictionaries with their plan, full_scan, sort_without_index,
+            existing indexes and suggested_index, or the error which prevented explaining the shape.
+        """
+        return [self.advise_shape(shape_stats, data) for shape_stats, data in self.shape_stats.get_top(order_by, limit)]
+
+    def advise_shape(self, shape_stats, data):
+        model, request = shape_stats.sample
+        advice = dict(data)
+        try:
+            with self.router.get_db_session(self.router.get_read_operation_type(model)) as session:
+                connection = session.connection(bind_arguments={"mapper": model})
+                statement = QueryProcessor(model, session, None, request).build_query().statement
+                sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+                profile = self.router.engine_profiles.get(connection.engine)
+                explain = profile.explain(connection, sql) if profile is not None else None
+                indexes = self.get_indexes(connection, model.__table__)
+        except (ValueError, NotImplementedError, SQLAlchemyError) as e:
+            # e.g. a sharded or tenant model, or a value which can not be rendered in the SQL
+            advice["error"] = str(e)
+            return advice
+        if explain is None:
+            advice["error"] = f"EXPLAIN is not supported for the dialect: {connection.dialect.name}"
+            return advice
+
+        columns, equality_count = self.get_index_columns(model, data["filters"], data["sorting"])
+        needs_index = explain["full_scan"] or explain["sort_without_index"]
+        suggested = columns if needs_index and columns and \
+            not self._is_indexed(columns, equality_count, indexes) else None
+        advice.update(explain)
+        advice.update({
+            "indexes": indexes,
+            "suggested_index": suggested,
+            "create_index": self.get_create_index(model.__table__, suggested) if suggested else None,
+        })
+        return advice
+
+    def get_index_columns(self, model, filters, sorting):
+        """
+        Return the columns of the index serving a shape: the equality filter columns, then the sort columns
+        in order, then the first range filter column.
+
+        :return: The (columns, number of equality columns) tuple, the equality columns may be in any order.
+        """
+        def get_column_name(field):
+            columns = getattr(getattr(getattr(model, field, None), "property", None), "columns", None)
+            return columns[0].name if columns else None
+
+        equality = sorted({get_column_name(field) for field, op in filters if op in self.EQUALITY_OPS} - {None})
+        columns = list(equality)
+        for field, _ in sorting:
+            column = get_column_name(field)
+            if column is not None and column not in columns:
+                columns.append(column)
+        for field, op in filters:
+            column = get_column_name(field)
+            if op in self.RANGE_OPS and column is not None and column not in columns:
+                columns.append(column)
+                break
+        return columns, len(equality)
+
+    @staticmethod
+    def _is_indexed(columns, equality_count, indexes):
+        """ Whether an index starts with the columns, the equality columns in any order. """
+        for index in indexes:
+            prefix = index[:len(columns)]
+            if len(prefix) == len(columns) and set(prefix[:equality_count]) == set(columns[:equality_count]) \
+                    and prefix[equality_count:] == columns[equality_count:]:
+                return True
+        return False
+
+    @staticmethod
+    def get_indexes(connection, table):
+        """ Return the column lists of the indexes, primary key and unique constraints of a table in the database. """
+        inspector = inspect(connection)
+        indexes = [index["column_names"] for index in inspector.get_indexes(table.name, schema=table.schema)]
+        indexes.append(inspector.get_pk_constraint(table.name, schema=table.schema)["constrained_columns"])
+        indexes.extend(constraint["column_names"]
+                       for constraint in inspector.get_unique_constraints(table.name, schema=table.schema))
+        return [columns for columns in indexes if columns]
+
+    @staticmethod
+    def get_create_index(table, columns):
+        name = f"ix_{table.name}_{'_'.join(columns)}"
+        return f"CREATE INDEX {name} ON {table.name} ({', '.join(columns)})"
@@ -1,26 +1,60 @@
+import base64
+import datetime
+import decimal
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Union, Optional
 
-from sqlalchemy.orm import load_only, joinedload, sessionmaker
+from sqlalchemy import or_, and_, text, func, tuple_, bindparam, true, inspect
+from sqlalchemy.orm import Query, Session, joinedload, selectinload, subqueryload, aliased
 
-from sqlalchemy.orm import Query, load_only, joinedload
-from sqlalchemy import or_, and_, text, func
+from macroflask.util.concurrency_strategy import run_with_deadline
+from macroflask.util.deadline import get_deadline
+from macroflask.util.fork_util import register_after_fork
+from macroflask.util.plan_cache import PlanCache
+from macroflask.util.query_shape_stats import QueryShapeStats
 
 
 class QueryRequest:
-    def __init__(self, body: Dict[str, Union[Dict, List]]):
+    # the strategies of with_total, see QueryProcessor.process
+    TOTAL_EXACT = 'exact'
+    TOTAL_WINDOW = 'window'
+    TOTAL_ESTIMATE = 'estimate'
+    TOTAL_STRATEGIES = (TOTAL_EXACT, TOTAL_WINDOW, TOTAL_ESTIMATE)
+    # the loading strategies of relations, see QueryProcessor.apply_relations
+    RELATION_STRATEGIES = ('joined', 'selectin', 'subquery')
+
+    def __init__(self, body: Dict[str, Union[Dict, List]], require_pagination: bool = True):
+        """
+        :param body: The query request body.
+        :param require_pagination: Whether the pagination is required, an export may read all the rows.
+        """
+        self.require_pagination = require_pagination
         self.pagination = body.get('pagination', {})
         self.sorting = body.get('sorting', {})
         self.filters = body.get('filters', {})
         self.need_fields = body.get('need_fields', [])
         self.relations = body.get('relations', [])
         self.group_by = body.get('group_by', [])
+        # the total number of matching rows: false, true or 'exact', 'window' or 'estimate'
+        self.with_total = body.get('with_total', False)
 
         # Validation
         self._validate()
 
     def _validate(self):
         """ Validate the query request """
-        if 'page' not in self.pagination or 'page_count' not in self.pagination:
+        if self.is_cursor_pagination():
+            if 'page_count' not in self.pagination:
+                raise ValueError("Cursor pagination must include 'after' or 'before' and 'page_count'.")
+            if 'after' in self.pagination and 'before' in self.pagination:
+                raise ValueError("Cursor pagination must include either 'after' or 'before'.")
+            if self.group_by:
+                raise ValueError("Group by can not be used with cursor pagination.")
+        elif self.require_pagination and ('page' not in self.pagination or 'page_count' not in self.pagination):
             raise ValueError("Pagination must include 'page' and 'page_count'.")
 
         if self.sorting:
@@ -46,10 +80,18 @@ class QueryRequest:
 
         if not isinstance(self.relations, list):
             raise ValueError("Relations should be a list.")
+        if self.relations:
+            self._validate_relations()
 
         if self.group_by and self.need_fields:
             self._validate_group_by_fields()
 
+        total_strategy = self.get_total_strategy()
+        if total_strategy is not None and total_strategy not in self.TOTAL_STRATEGIES:
+            raise ValueError(f"With total must be a boolean or one of {self.TOTAL_STRATEGIES}.")
+        if total_strategy == self.TOTAL_WINDOW and self.is_cursor_pagination():
+            raise ValueError("The 'window' total can not be used with cursor pagination.")
+
     def _validate_filters(self, filters):
         """ Validate the filters recursively """
         if isinstance(filters, dict):
@@ -82,6 +124,21 @@ class QueryRequest:
         if 'value' not in filter:
             raise ValueError("Filter must include a 'value'.")
 
+    def _validate_relations(self):
+        """ Validate the relations: a relation name or {"name", "strategy", "fields"} """
+        if self.need_fields or self.group_by:
+            raise ValueError("Relations load the related objects, use 'relation.field' need fields to select columns.")
+        for relation in self.relations:
+            if isinstance(relation, str):
+                continue
+            if not isinstance(relation, dict) or not isinstance(relation.get('name'), str):
+                raise ValueError("Each relation must be a name or a dict with a 'name'.")
+            strategy = relation.get('strategy')
+            if strategy is not None and strategy not in self.RELATION_STRATEGIES:
+                raise ValueError(f"Relation 'strategy' must be one of {self.RELATION_STRATEGIES}.")
+            if not isinstance(relation.get('fields', []), list):
+                raise ValueError("Relation 'fields' should be a list.")
+
     def _validate_group_by_fields(self):
         """ Validate that all selected fields are either in group_by or are aggregate functions """
         valid_aggregate_functions = {'count', 'sum', 'avg', 'min', 'max'}
@@ -94,6 +151,14 @@ class QueryRequest:
     def get_pagination(self) -> Dict[str, int]:
         return self.pagination
 
+    def is_cursor_pagination(self) -> bool:
+        """
+        Whether the request pages with a cursor (keyset pagination) instead of a page number:
+        {"after": <next_cursor>, "page_count": N} or {"before": <prev_cursor>, "page_count": N},
+        {"after": null} is the first page and {"before": null} the last one.
+        """
+        return 'after' in self.pagination or 'before' in self.pagination
+
     def get_sorting(self) -> Optional[Dict[str, Union[str, List[Dict[str, str]]]]]:
         return self.sorting
 
@@ -109,67 +174,120 @@ class QueryRequest:
     def get_group_by(self):
         return self.group_by
 
+    def get_cache_key(self) -> str:
+        """ Return the request normalized as a string, the equal requests have the same key. """
+        return json.dumps([self.pagination, self.sorting, self.filters, self.need_fields, self.relations,
+                           self.group_by, self.with_total], sort_keys=True, separators=(',', ':'), default=str)
+
+    def get_total_strategy(self) -> Optional[str]:
+        """ Return the strategy of the total, None if the total is not requested. """
+        if self.with_total is True:
+            return self.TOTAL_EXACT
+        return self.with_total or None
+
 
 class QueryProcessor:
-    def __init__(self, model, session, query: Query, request_body: QueryRequest):
+    # the exact totals of the filtered 'estimate' requests are cached for total_cache_ttl seconds
+    total_cache_ttl = 60
+    total_cache_size = 1000
+    _total_cache = {}
+    _total_cache_lock = threading.Lock()
+    # the exact counts run on threads shared by all the processors, see _start_total()
+    total_max_workers = 8
+    _total_executor = None
+    # the statements of the request shapes, shared by all the processors, see process()
+    plan_cache = PlanCache()
+    # the filter, sort and group by fields of the processed requests, see index_advisor.py
+    shape_stats = QueryShapeStats(key_fields=("table", "filters", "sorting", "group_by"))
+
+    def __init__(self, model, session, query: Query, request_body: QueryRequest,
+                 plain_fields: Optional[List[str]] = None):
         """
         :param session:
         :param query:
         :param request_body:
+        :param plain_fields: The fields of the dictionaries returned when the request has no need_fields,
+            None returns the ORM instances. The columns are selected without creating ORM objects.
         """
         self.session = session
         self.model = model
         self.query = session.query(model)
         self.request_body = request_body
+        self.plain_fields = plain_fields
+
+        # cursor pagination: the fields of the selected rows and the cursors of the adjacent pages
+        self.row_fields = list(self.get_fields())
+        self.next_cursor = None
+        self.prev_cursor = None
+
+        # with_total: the total number of matching rows, and whether it is estimated
+        self.total = None
+        self.total_is_estimate = False
+
+        # whether the values of the request are bound parameters of the built query, see _build_plan()
+        self._bind_params = False
+        # relation name -> alias of the many-to-one relations joined for their fields, see apply_joins()
+        self._relation_aliases = {}
+
+    def get_fields(self) -> List[str]:
+        """
+        Return the fields of the returned dictionaries: need_fields, else plain_fields, empty for ORM instances.
+        The objects are returned when relations are loaded.
+        """
+        if self.request_body.get_relations():
+            return self.request_body.get_need_fields()
+        return self.request_body.get_need_fields() or self.plain_fields or []
 
     def apply_pagination(self):
         """ Apply pagination to the query. """
         pagination = self.request_body.get_pagination()
 
         if 'page' in pagination and 'page_count' in pagination:
+            if self._bind_params:
+                self.query = self.query.limit(bindparam('limit')).offset(bindparam('offset'))
+                return
             page = pagination['page']
             page_count = pagination['page_count']
             self.query = self.query.limit(page_count).offset((page - 1) * page_count)
 
     def apply_sorting(self):
         """ Apply sorting to the query. """
-        sorting = self.request_body.get_sorting().get('sort_by', None)
-        if not sorting:
-            return
+        for field, order in self._get_requested_sort_fields():
+            self.query = self.query.order_by(self._get_order_clause(field, order))
 
-        elif isinstance(sorting, str):
-            order = self.request_body.get_sorting().get('order', 'asc')
-            if order == 'asc':
-                self.query = self.query.order_by(text(f"{sorting} asc"))
-            else:
-                self.query = self.query.order_by(text(f"{sorting} desc"))
-
-        elif isinstance(sorting, list):
-            for sort in sorting:
-                field = sort.get('field')
-                order = sort.get('order', 'asc')
-                if field:
-                    if order == 'asc':
-                        self.query = self.query.order_by(text(f"{field} asc"))
-                    else:
-                        self.query = self.query.order_by(text(f"{field} desc"))
+    def _get_order_clause(self, field, order):
+        """ Order by the column of a field, qualified by its table as the joined relations may have the same names. """
+        column = self._get_column(field)
+        if not hasattr(column, 'asc'):
+            # e.g. the label of an aggregate function
+            return text(f"{field} asc") if order == 'asc' else text(f"{field} desc")
+        return column.asc() if order == 'asc' else column.desc()
 
     def apply_filters(self):
         """ Apply filters to the query. """
         filters = self.request_body.get_filters()
-        if 'and' in filters:
-            self.query = self.query.filter(self._apply_filter_list(filters['and'], and_))
-        if 'or' in filters:
-            self.query = self.query.filter(self._apply_filter_list(filters['or'], or_))
+        values = []
+        for shape in self._get_filter_shapes(filters, values):
+            self.query = self.query.filter(self._get_filter_condition(shape, values))
 
-    def _apply_filter_list(self, filter_list, operator):
-        """ Apply a list of filters to the query using the specified operator. """
-        conditions = []
+    def _get_filter_shapes(self, filters, values):
+        """ Return the shapes of the top level 'and' and 'or' filter lists which have filters. """
+        shapes = (self._get_filter_shape(filters[operator], operator, values)
+                  for operator in ('and', 'or') if operator in filters)
+        return tuple(shape for shape in shapes if shape[1])
+
+    def _get_filter_shape(self, filter_list, operator, values):
+        """
+        Return the shape of a filter list without its values: (operator, children), a filter is
+        (field, op, index of its value). The values are appended to values in order, the filters
+        without a value are left out.
+        """
+        children = []
         for f in filter_list:
             if 'and' in f:
-                conditions.append(self._apply_filter_list(f['and'], and_))
+                children.append(self._get_filter_shape(f['and'], 'and', values))
             elif 'or' in f:
-                conditions.append(self._apply_filter_list(f['or'], or_))
+                children.append(self._get_filter_shape(f['or'], 'or', values))
             else:
                 field = f.get('field')
                 op = f.get('op')
@@ -177,33 +295,55 @@ class QueryProcessor:
 
                 if not field or not op or value is None:
                     continue
-
-                column = getattr(self.model, field, None)
-                if column is None:
+                if op == 'in' and not isinstance(value, list):
                     continue
 
-                if op == '==':
-                    conditions.append(column == value)
-                elif op == 'like':
-                    conditions.append(column.like(f'%{value}%'))
-                elif op == '>':
-                    conditions.append(column > value)
-                elif op == '<':
-                    conditions.append(column < value)
-                elif op == '>=':
-                    conditions.append(column >= value)
-                elif op == '<=':
-                    conditions.append(column <= value)
-                elif op == '!=':
-                    conditions.append(column != value)
-                elif op == 'in' and isinstance(value, list):
-                    conditions.append(column.in_(value))
-
-        return operator(*conditions) if conditions else True
+                children.append((field, op, len(values)))
+                values.append(f'%{value}%' if op == 'like' else value)
+        return operator, tuple(children)
+
+    def _get_filter_condition(self, shape, values):
+        """ Build the condition of a filter shape, the values are bound parameters when building a plan. """
+        operator, children = shape
+        conditions = []
+        for child in children:
+            if len(child) == 2:
+                conditions.append(self._get_filter_condition(child, values))
+                continue
+
+            field, op, index = child
+            column = getattr(self.model, field, None)
+            if column is None:
+                continue
+            if self._bind_params:
+                value = bindparam(f'filter_{index}', expanding=op == 'in')
+            else:
+                value = values[index]
+
+            if op == '==':
+                conditions.append(column == value)
+            elif op == 'like':
+                conditions.append(column.like(value))
+            elif op == '>':
+                conditions.append(column > value)
+            elif op == '<':
+                conditions.append(column < value)
+            elif op == '>=':
+                conditions.append(column >= value)
+            elif op == '<=':
+                conditions.append(column <= value)
+            elif op == '!=':
+                conditions.append(column != value)
+            elif op == 'in':
+                conditions.append(column.in_(value))
+
+        if not conditions:
+            return true()
+        return (and_ if operator == 'and' else or_)(*conditions)
 
     def apply_field_selection(self):
         """ Select specific fields to be returned, supporting group by with aggregate functions. """
-        need_fields = self.request_body.get_need_fields()
+        need_fields = self.get_fields()
         if need_fields:
             selected_columns = []
             for field in need_fields:
@@ -219,43 +359,658 @@ class QueryProcessor:
                         raise ValueError(f"Aggregate function '{func_name}' is not valid.")
                     selected_columns.append(aggregate_func(column).label(field))
                 else:
-                    # Regular fields
-                    column = getattr(self.model, field, None)
+                    # Regular fields, or 'relation.field' fields of the joined relations
+                    column = self._get_column(field)
                     if column is None:
                         raise ValueError(f"Field '{field}' is not a valid column of the model.")
-                    selected_columns.append(column)
+                    selected_columns.append(column.label(field) if '.' in field else column)
+            if self.request_body.is_cursor_pagination():
+                # the keyset fields make the cursors of the page, process() only keeps the need fields
+                for field, _ in self._get_keyset_fields():
+                    if field not in self.row_fields:
+                        self.row_fields.append(field)
+                        selected_columns.append(getattr(self.model, field))
             self.query = self.query.with_entities(*selected_columns)
 
     def apply_relations(self):
-        """ Apply relation loading if needed. """
-        relations = self.request_body.get_relations()
-        for relation in relations:
-            self.query = self.query.options(joinedload(relation))
+        """
+        Load the relations of the returned objects with one more query per relation instead of one per row.
+        A relation without a strategy is joined when it is many-to-one, a collection is loaded by 'selectin',
+        which keeps the LIMIT of the page on the rows of the model. The 'fields' of a relation are the only
+        columns loaded besides its primary key.
+        """
+        loaders = {'joined': joinedload, 'selectin': selectinload, 'subquery': subqueryload}
+        for name, strategy, fields in self._get_relations():
+            relationship = inspect(self.model).relationships[name]
+            if strategy is None:
+                strategy = 'selectin' if relationship.uselist else 'joined'
+            loader = loaders[strategy](getattr(self.model, name))
+            if fields:
+                loader = loader.load_only(*[self._get_related_column(relationship, field) for field in fields])
+            self.query = self.query.options(loader)
+
+    def _get_relations(self):
+        """
+        Return the relations of the request as (name, strategy, fields) tuples.
+
+        :exception: ValueError if a name is not a relation of the model.
+        """
+        relations = []
+        for relation in self.request_body.get_relations():
+            if isinstance(relation, str):
+                relation = {'name': relation}
+            name = relation['name']
+            if name not in inspect(self.model).relationships:
+                raise ValueError(f"'{name}' is not a relation of the model.")
+            relations.append((name, relation.get('strategy'), tuple(relation.get('fields', []))))
+        return relations
+
+    @staticmethod
+    def _get_related_column(relationship, field):
+        column = getattr(relationship.mapper.class_, field, None)
+        if column is None:
+            raise ValueError(f"Field '{field}' is not a valid column of the relation '{relationship.key}'.")
+        return column
+
+    def get_relation_data(self, instance):
+        """
+        Return the loaded relations of an object as dictionaries keyed by relation name, a collection as a list.
+        A related object gives its 'fields', or its to_dict() when the relation has no fields.
+        """
+        def to_dict(related, fields):
+            if fields:
+                return {field: getattr(related, field) for field in fields}
+            if hasattr(related, 'to_dict'):
+                return related.to_dict()
+            return {key: getattr(related, key) for key in inspect(related).mapper.column_attrs.keys()}
+
+        data = {}
+        for name, _, fields in self._get_relations():
+            related = getattr(instance, name)
+            if related is None:
+                data[name] = None
+            elif inspect(self.model).relationships[name].uselist:
+                data[name] = [to_dict(item, fields) for item in related]
+            else:
+                data[name] = to_dict(related, fields)
+        return data
+
+    def apply_joins(self):
+        """
+        Outer join the many-to-one relations of the 'relation.field' need fields, group by and sorting fields,
+        before the pagination. Each relation is joined once, under an alias.
+        """
+        sort_fields = [field for field, _ in self._get_requested_sort_fields()]
+        for field in list(self.get_fields()) + list(self.request_body.get_group_by()) + sort_fields:
+            if '.' not in field or '(' in field:
+                continue
+            name = field.split('.', 1)[0]
+            if name in self._relation_aliases:
+                continue
+            relationship = inspect(self.model).relationships.get(name)
+            if relationship is None or relationship.uselist:
+                raise ValueError(f"'{name}' is not a many-to-one relation of the model.")
+            alias = aliased(relationship.mapper.class_)
+            self._relation_aliases[name] = alias
+            self.query = self.query.outerjoin(getattr(self.model, name).of_type(alias))
+
+    def _get_column(self, field):
+        """ Return the column of a field of the model, or of a 'relation.field' joined by apply_joins(). """
+        if '.' not in field:
+            return getattr(self.model, field, None)
+        name, related_field = field.split('.', 1)
+        alias = self._relation_aliases.get(name)
+        return getattr(alias, related_field, None) if alias is not None else None
 
     def apply_group_by(self):
         """ Apply group by to the query. """
         group_by = self.request_body.get_group_by()
         if group_by:
-            group_by_columns = [getattr(self.model, field) for field in group_by]
+            group_by_columns = [self._get_column(field) for field in group_by]
             self.query = self.query.group_by(*group_by_columns)
 
-    def process(self):
-        """ Process the query according to the request. """
+    def _get_keyset_fields(self):
+        """
+        Return the sorting fields followed by the primary key as (field, order) tuples, they order the rows
+        of cursor pagination uniquely. The primary key follows the order of the last sorting field, so one
+        index on the keyset fields serves the query.
+        """
+        keyset_fields = self._get_sort_fields()
+        order = keyset_fields[-1][1] if keyset_fields else 'asc'
+        mapper = self.model.__mapper__
+        for column in mapper.primary_key:
+            field = mapper.get_property_by_column(column).key
+            if field not in [keyset_field for keyset_field, _ in keyset_fields]:
+                keyset_fields.append((field, order))
+        return keyset_fields
+
+    def apply_keyset(self):
+        """
+        Apply cursor pagination: seek past the cursor on the keyset fields instead of skipping the previous
+        pages with OFFSET, so a deep page costs the same as the first one. One more row than the page
+        is read to know whether there is a next page. A 'before' cursor reads the rows backward.
+
+        :return: The applied order as (field, order) tuples.
+        """
+        pagination = self.request_body.get_pagination()
+        backward = 'before' in pagination
+        keyset_order = [(field, order if not backward else ('desc' if order == 'asc' else 'asc'))
+                        for field, order in self._get_keyset_fields()]
+
+        cursor = pagination.get('before' if backward else 'after')
+        columns = [getattr(self.model, field) for field, _ in keyset_order]
+        if cursor:
+            values = self._decode_cursor(cursor)
+            if self._bind_params:
+                # the NULL values are part of the plan key, see _get_plan()
+                values = [None if value is None else bindparam(f'cursor_{index}', type_=column.type)
+                          for index, (column, value) in enumerate(zip(columns, values))]
+            self.query = self.query.filter(self._get_seek_condition(keyset_order, values))
+
+        # NULL is the lowest value of the keyset: first in ascending order and last in descending order, as MySQL
+        # sorts them, the other databases are told so for the nullable fields
+        explicit_nulls = self._get_dialect_name() not in ('mysql', 'mariadb')
+        order_by = []
+        for column, (field, order) in zip(columns, keyset_order):
+            ordered = column.asc() if order == 'asc' else column.desc()
+            if explicit_nulls and self._is_nullable(field):
+                ordered = ordered.nulls_first() if order == 'asc' else ordered.nulls_last()
+            order_by.append(ordered)
+        self.query = self.query.order_by(*order_by)
+        self.query = self.query.limit(bindparam('limit') if self._bind_params else pagination['page_count'] + 1)
+        return keyset_order
+
+    def _get_seek_condition(self, keyset_order, values):
+        """
+        Return the condition of the rows after the keyset values in the keyset order, NULL is the lowest value.
+
+        :param values: The keyset values of the cursor, None for NULL.
+        """
+        columns = [getattr(self.model, field) for field, _ in keyset_order]
+        nullable = [self._is_nullable(field) for field, _ in keyset_order]
+        orders = {order for _, order in keyset_order}
+        has_null = any(value is None for value in values)
+        if len(orders) == 1 and not has_null and ('asc' in orders or not any(nullable)):
+            # a row value comparison, the database seeks the index on the keyset fields
+            if 'asc' in orders:
+                return tuple_(*columns) > tuple_(*values)
+            return tuple_(*columns) < tuple_(*values)
+
+        conditions = []
+        for index, (column, (_, order)) in enumerate(zip(columns, keyset_order)):
+            value = values[index]
+            if value is None:
+                if order != 'asc':
+                    # nothing is lower than NULL
+                    continue
+                after_condition = column.is_not(None)
+            elif order == 'asc':
+                after_condition = column > value
+            else:
+                after_condition = or_(column < value, column.is_(None)) if nullable[index] else column < value
+            equal_conditions = [columns[i].is_(None) if values[i] is None else columns[i] == values[i]
+                                for i in range(index)]
+            conditions.append(and_(*equal_conditions, after_condition))
+        return or_(*conditions)
+
+    def _is_nullable(self, field):
+        """ Return whether the column of a field of the model may be NULL. """
+        return getattr(inspect(self.model).columns.get(field), 'nullable', True)
+
+    def _get_dialect_name(self):
+        """ Return the name of the database dialect of the model, the first shard for a sharded model. """
+        shard_set = self._get_shard_set()
+        engine = shard_set.engines[0] if shard_set is not None else self.session.get_bind(mapper=self.model)
+        return engine.dialect.name
+
+    def _encode_cursor(self, row):
+        """ Return the opaque cursor of a row, made of its keyset values. """
+        keyset_fields = [field for field, _ in self._get_keyset_fields()]
+        if self.get_fields():
+            values = [row[self.row_fields.index(field)] for field in keyset_fields]
+        else:
+            values = [getattr(row, field) for field in keyset_fields]
+        values = [value.isoformat() if isinstance(value, (datetime.date, datetime.time))
+                  else str(value) if isinstance(value, decimal.Decimal) else value for value in values]
+        data = json.dumps({"fields": keyset_fields, "values": values}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+    def _decode_cursor(self, cursor):
+        """
+        Return the keyset values of a cursor.
+
+        :exception: ValueError if the cursor is malformed or was made for another sorting.
+        """
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            fields, values = data["fields"], data["values"]
+        except (AttributeError, TypeError, ValueError, KeyError):
+            raise ValueError("The pagination cursor is invalid.")
+        if fields != [field for field, _ in self._get_keyset_fields()] or len(values) != len(fields):
+            raise ValueError("The pagination cursor does not match the sorting of the request.")
+
+        decoded_values = []
+        for field, value in zip(fields, values):
+            python_type = None
+            try:
+                python_type = getattr(self.model, field).type.python_type
+            except NotImplementedError:
+                pass
+            if isinstance(value, str) and python_type in (datetime.datetime, datetime.date, datetime.time):
+                value = python_type.fromisoformat(value)
+            elif isinstance(value, str) and python_type is decimal.Decimal:
+                value = decimal.Decimal(value)
+            decoded_values.append(value)
+        return decoded_values
+
+    def _cut_cursor_page(self, datas):
+        """ Cut the page from the rows read by apply_keyset() and set the cursors of the adjacent pages. """
+        pagination = self.request_body.get_pagination()
+        page_count = pagination['page_count']
+        backward = 'before' in pagination
+        has_more = len(datas) > page_count
+        datas = datas[:page_count]
+        if backward:
+            datas.reverse()
+
+        if datas:
+            has_next, has_prev = (bool(pagination['before']), has_more) if backward \
+                else (has_more, bool(pagination['after']))
+            self.next_cursor = self._encode_cursor(datas[-1]) if has_next else None
+            self.prev_cursor = self._encode_cursor(datas[0]) if has_prev else None
+        return datas
+
+    def build_query(self, with_window_total=False, bind_params=False):
+        """
+        Build the query according to the request without executing it.
+
+        :param with_window_total: Whether to add the total number of rows as the last column, see process().
+        :param bind_params: Whether the values of the request are bound parameters, named as in _get_plan().
+        """
+        self._bind_params = bind_params
         self.apply_filters()
-        self.apply_sorting()
-        self.apply_group_by()
-        self.apply_pagination()
+        self.apply_joins()
+        if self.request_body.is_cursor_pagination():
+            self.apply_keyset()
+        else:
+            self.apply_sorting()
+            self.apply_group_by()
+            self.apply_pagination()
         self.apply_field_selection()
-        # self.apply_relations()
-        datas = self.query.all()
-
-        new_result = []
-        if self.request_body.get_need_fields():
-            for data in datas:
-                new_data = {}
-                for index, field in enumerate(self.request_body.get_need_fields()):
-                    new_data[field] = data[index]
-                new_result.append(new_data)
-            datas = new_result
+        if with_window_total:
+            self.query = self.query.add_columns(func.count().over())
+        self.apply_relations()
+        return self.query
+
+    def process(self):
+        """
+        Process the query according to the request.
 
+        With with_total, the total number of matching rows is set in self.total:
+        'exact' counts them on a second connection while the page is read, 'window' adds COUNT(*) OVER()
+        to the page query, 'estimate' reads the table statistics of an unfiltered request and caches
+        the exact count of a filtered one for total_cache_ttl seconds.
+        """
+        start = time.perf_counter()
+        shard_set = self._get_shard_set()
+        total_strategy = self.request_body.get_total_strategy()
+        if total_strategy == QueryRequest.TOTAL_WINDOW and shard_set is not None:
+            # each shard would count its own rows
+            total_strategy = QueryRequest.TOTAL_EXACT
+        count_future = self._start_total(total_strategy, shard_set) if total_strategy else None
+
+        if shard_set is None:
+            datas = self._execute_plan(with_window_total=total_strategy == QueryRequest.TOTAL_WINDOW)
+        else:
+            datas = self._process_shards(shard_set)
+        if total_strategy == QueryRequest.TOTAL_WINDOW:
+            datas = self._pop_window_total(datas)
+        if count_future is not None:
+            self.total = count_future.result()
+            self._cache_total(count_future)
+        if self.request_body.is_cursor_pagination():
+            datas = self._cut_cursor_page(datas)
+
+        fields = self.get_fields()
+        if fields:
+            # the rows may end with the keyset fields or the window total, zip() stops at the last field
+            datas = [dict(zip(fields, data)) for data in datas]
+
+        self._record_shape(time.perf_counter() - start)
         return datas
+
+    def _record_shape(self, duration):
+        """
+        Record the time of the request in shape_stats, by table, filter (field, op), sort and group by fields.
+        The rows are already read, so a failure is logged instead of raised.
+        """
+        try:
+            filters = set()
+            shapes = list(self._get_filter_shapes(self.request_body.get_filters(), []))
+            while shapes:
+                for child in shapes.pop()[1]:
+                    if len(child) == 2:
+                        shapes.append(child)
+                    else:
+                        filters.add(child[:2])
+            key = (self.model.__table__.name, tuple(sorted(filters)), self._get_requested_sort_fields(),
+                   tuple(self.request_body.get_group_by()))
+            self.shape_stats.record(key, duration, (self.model, self.request_body))
+        except Exception as e:
+            router = getattr(self.session, 'router', None)
+            logger = getattr(router, 'logger', None) or logging.getLogger(__name__)
+            logger.warning(f"Failed to record the query shape of {self.model.__name__}: {e}")
+
+    def _get_requested_sort_fields(self):
+        """
+        Return the sorting of the request as (field, order) tuples without checking the fields, which may be
+        model columns, 'relation.field' fields or the labels of aggregate functions.
+        """
+        sorting = self.request_body.get_sorting()
+        if not sorting:
+            return ()
+        if isinstance(sorting, dict):
+            sort_by = sorting.get('sort_by')
+            if not isinstance(sort_by, list):
+                return ((sort_by, sorting.get('order', 'asc')),) if sort_by else ()
+            sorting = sort_by
+        return tuple((sort.get('field'), sort.get('order', 'asc')) for sort in sorting if sort.get('field'))
+
+    def _get_plan(self, with_window_total):
+        """
+        Return the shape key of the request, its structure without the values, and the values to bind to
+        the statement of the shape. The requests of one shape differ only by their filter values, page
+        and cursor, so they share one statement.
+
+        :return: The (key, params) tuple.
+        """
+        request = self.request_body
+        filters = request.get_filters()
+        values = []
+        filter_shapes = self._get_filter_shapes(filters, values)
+        params = {f'filter_{index}': value for index, value in enumerate(values)}
+
+        pagination = request.get_pagination()
+        if request.is_cursor_pagination():
+            backward = 'before' in pagination
+            cursor = pagination.get('before' if backward else 'after')
+            nulls = ()
+            if cursor:
+                values = self._decode_cursor(cursor)
+                params.update({f'cursor_{index}': value for index, value in enumerate(values) if value is not None})
+                # the seek condition of a NULL value is not a comparison with a bound parameter
+                nulls = tuple(index for index, value in enumerate(values) if value is None)
+            params['limit'] = pagination['page_count'] + 1
+            paging = ('before' if backward else 'after', bool(cursor), nulls)
+        elif 'page' in pagination and 'page_count' in pagination:
+            params['limit'] = pagination['page_count']
+            params['offset'] = (pagination['page'] - 1) * pagination['page_count']
+            paging = ('page',)
+        else:
+            paging = None
+
+        sorting = request.get_sorting()
+        if isinstance(sorting, dict):
+            sorting = tuple(sorted((key, str(value)) for key, value in sorting.items()))
+        else:
+            sorting = tuple((sort.get('field'), sort.get('order', 'asc')) for sort in sorting)
+        key = (self.model, filter_shapes, sorting, tuple(self.get_fields()), tuple(request.get_group_by()),
+               tuple(self._get_relations()), paging, with_window_total)
+        return key, params
+
+    def _build_plan(self, with_window_total):
+        """ Build the statement of the request shape with bound parameters, see _get_plan(). """
+        processor = QueryProcessor(self.model, self.session, None, self.request_body, self.plain_fields)
+        statement = processor.build_query(with_window_total=with_window_total, bind_params=True).statement
+        return statement, tuple(processor.row_fields)
+
+    def _execute_plan(self, with_window_total):
+        """
+        Read the rows with the cached statement of the request shape, it is built on the first request of the shape.
+        The statement is the same object on each request, so the SQL compiled by SQLAlchemy is reused as well.
+        """
+        key, params = self._get_plan(with_window_total)
+        plan = self.plan_cache.get(key)
+        if plan is None:
+            start = time.perf_counter()
+            plan = self._build_plan(with_window_total)
+            self.plan_cache.put(key, plan, time.perf_counter() - start)
+        statement, row_fields = plan
+        self.row_fields = list(row_fields)
+
+        if self.get_fields():
+            # the columns are read by the connection of the model, the ORM does not process the rows
+            if self.session.autoflush:
+                # as session.execute() would, so the pending changes are read
+                self.session.flush()
+            connection = self.session.connection(bind_arguments={'mapper': self.model})
+            return connection.execute(statement, params).all()
+        result = self.session.execute(statement, params)
+        if self.request_body.get_relations():
+            # the rows of a joined collection repeat the objects
+            result = result.unique()
+        if with_window_total:
+            return result.all()
+        return result.scalars().all()
+
+    def build_count_query(self):
+        """ Build the query counting the rows matching the filters, or the groups of a group by. """
+        count_processor = QueryProcessor(self.model, self.session, None, self.request_body)
+        group_by = self.request_body.get_group_by()
+        if group_by:
+            count_processor.apply_joins()
+            group_by_columns = [count_processor._get_column(field) for field in group_by]
+            count_processor.query = count_processor.query.with_entities(*group_by_columns)
+            count_processor.apply_filters()
+            groups = count_processor.query.group_by(*group_by_columns).subquery()
+            return self.session.query(func.count()).select_from(groups)
+
+        count_processor.query = self.session.query(func.count()).select_from(self.model)
+        count_processor.apply_filters()
+        return count_processor.query
+
+    def _start_total(self, total_strategy, shard_set):
+        """
+        Count the total number of rows for the 'exact' and 'estimate' strategies.
+
+        :return: The future of the exact count run on a second connection, None if the total is already known.
+        """
+        cache_key = None
+        if total_strategy == QueryRequest.TOTAL_ESTIMATE:
+            if not self.request_body.get_filters() and not self.request_body.get_group_by():
+                self.total = self._estimate_row_count(shard_set)
+                if self.total is not None:
+                    self.total_is_estimate = True
+                    return None
+
+            # without statistics, the exact count of the same filters is reused for total_cache_ttl seconds
+            cache_key = self._get_total_cache_key()
+            cached = self._total_cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[1] < self.total_cache_ttl:
+                self.total, self.total_is_estimate = cached[0], True
+                return None
+
+        elif total_strategy != QueryRequest.TOTAL_EXACT:
+            return None
+
+        count_query = self.build_count_query()
+        deadline = get_deadline()
+        if shard_set is not None:
+            shard_ids = shard_set.shard_ids_for_criteria(self.model, count_query.whereclause)
+
+            def count_rows():
+                return sum(result[0][0] for result in shard_set.fan_out(count_query, shard_ids))
+        else:
+            engine = self.session.get_bind(mapper=self.model)
+
+            def count_rows():
+                with self._new_count_session(engine) as session:
+                    return count_query.with_session(session).scalar()
+
+        future = self._get_total_executor().submit(run_with_deadline, deadline, count_rows, ())
+        future.total_cache_key = cache_key
+        return future
+
+    @classmethod
+    def _get_total_executor(cls):
+        """ Return the executor of the exact counts, it is started on the first count of the process. """
+        with cls._total_cache_lock:
+            if QueryProcessor._total_executor is None:
+                QueryProcessor._total_executor = ThreadPoolExecutor(max_workers=cls.total_max_workers,
+                                                                    thread_name_prefix="query-total")
+            return QueryProcessor._total_executor
+
+    @classmethod
+    def after_fork(cls):
+        """ The threads of the executor do not exist in a forked child, it starts its own executor. """
+        QueryProcessor._total_cache_lock = threading.Lock()
+        QueryProcessor._total_executor = None
+
+    def _new_count_session(self, engine):
+        """
+        Return a new session for the exact count on the engine of the page. It comes from the read sessions
+        of the router, so the count runs in a read-only transaction and its statements are accounted.
+        """
+        router = getattr(self.session, 'router', None)
+        sessions = None
+        if router is not None:
+            sessions = router.sessions.get("read") or router.sessions.get("write")
+        if sessions is None:
+            return Session(bind=engine)
+        # the worker thread has neither the tenant nor the sticky reads of the caller to route the session again
+        return sessions.session_factory(router=None, binds=None, bind=engine)
+
+    def _estimate_row_count(self, shard_set):
+        """ Return the row count of the table from the database statistics, None if there are none. """
+        router = getattr(self.session, 'router', None)
+        if router is None:
+            return None
+        engines = shard_set.engines if shard_set is not None else [self.session.get_bind(mapper=self.model)]
+        total = 0
+        for engine in engines:
+            profile = router.engine_profiles.get(engine)
+            if profile is None:
+                return None
+            with engine.connect() as connection:
+                row_count = profile.estimate_row_count(connection, self.model.__table__)
+            if row_count is None:
+                return None
+            total += row_count
+        return total
+
+    def _get_total_cache_key(self):
+        return (self.model, json.dumps(self.request_body.get_filters(), sort_keys=True, default=str),
+                tuple(self.request_body.get_group_by()))
+
+    def _cache_total(self, count_future):
+        cache_key = getattr(count_future, 'total_cache_key', None)
+        if cache_key is None:
+            return
+        with self._total_cache_lock:
+            if len(self._total_cache) >= self.total_cache_size:
+                # drop the oldest half of the counts
+                oldest = sorted(self._total_cache.items(), key=lambda item: item[1][1])[:len(self._total_cache) // 2]
+                for key, _ in oldest:
+                    self._total_cache.pop(key, None)
+            self._total_cache[cache_key] = (self.total, time.monotonic())
+
+    def _pop_window_total(self, datas):
+        """ Take the COUNT(*) OVER() column added by build_query() out of the rows. """
+        if datas:
+            self.total = datas[0][-1]
+        else:
+            pagination = self.request_body.get_pagination()
+            # a page past the end has no row to carry the total
+            self.total = 0 if pagination.get('page', 1) <= 1 else self.build_count_query().scalar()
+        if not self.get_fields():
+            return [data[0] for data in datas]
+        return datas
+
+    def _get_shard_set(self):
+        """ Return the ShardSet of a sharded model, None for the other models. """
+        router = getattr(self.session, 'router', None)
+        return router.get_shard_set(self.model) if router is not None else None
+
+    def _get_sort_fields(self):
+        """ Return the sorting of the request as a list of (field, order) tuples. """
+        sorting = self.request_body.get_sorting()
+        if not sorting:
+            return []
+        if isinstance(sorting, dict):
+            sorting = [{'field': sorting.get('sort_by'), 'order': sorting.get('order', 'asc')}]
+        sort_fields = []
+        for sort in sorting:
+            field = sort.get('field')
+            if field:
+                if getattr(self.model, field, None) is None:
+                    raise ValueError(f"Field '{field}' is not a valid column of the model.")
+                sort_fields.append((field, sort.get('order', 'asc')))
+        return sort_fields
+
+    def _process_shards(self, shard_set):
+        """
+        Query the shards the filters can match in parallel, then merge their rows with the sorting and pagination.
+        A query filtered by one shard key value only runs on its shard.
+        """
+        self.apply_filters()
+        self.apply_joins()
+        self.apply_relations()
+        cursor_pagination = self.request_body.is_cursor_pagination()
+        if not cursor_pagination:
+            self.apply_sorting()
+        shard_ids = shard_set.shard_ids_for_criteria(self.model, self.query.whereclause)
+        if len(shard_ids) <= 1:
+            # the session runs the query on its shard
+            if cursor_pagination:
+                self.apply_keyset()
+            else:
+                self.apply_group_by()
+                self.apply_pagination()
+            self.apply_field_selection()
+            return self.query.all()
+
+        need_fields = self.get_fields()
+        if self.request_body.get_group_by() or any('(' in field for field in need_fields):
+            raise ValueError("Group by and aggregate functions require a filter on the shard key of a sharded model.")
+
+        pagination = self.request_body.get_pagination()
+        if cursor_pagination:
+            # each shard returns the rows of the page past the cursor, process() cuts the page from the merged rows
+            sort_fields = self.apply_keyset()
+            self.apply_field_selection()
+            columns = self.row_fields
+            paginate = False
+        else:
+            sort_fields = self._get_sort_fields()
+            self.apply_field_selection()
+            columns = list(need_fields)
+            if need_fields:
+                # select the sorting fields as well to merge the rows, process() only keeps the need fields
+                columns.extend(field for field, _ in sort_fields if field not in need_fields)
+                self.query = self.query.add_columns(
+                    *[getattr(self.model, field) for field in columns[len(need_fields):]])
+
+            # each shard returns the rows up to the end of the page, the page is cut from the merged rows
+            paginate = 'page' in pagination and 'page_count' in pagination
+            if paginate:
+                self.query = self.query.limit(pagination['page'] * pagination['page_count'])
+
+        datas = [data for shard_datas in shard_set.fan_out(self.query, shard_ids) for data in shard_datas]
+        for field, order in reversed(sort_fields):
+            # stable sorts from the last sorting field to the first, NULL comes first in ascending order
+            if need_fields:
+                index = columns.index(field)
+                datas.sort(key=lambda data: (data[index] is not None, data[index]), reverse=order != 'asc')
+            else:
+                datas.sort(key=lambda data: (getattr(data, field) is not None, getattr(data, field)),
+                           reverse=order != 'asc')
+
+        if paginate:
+            start = (pagination['page'] - 1) * pagination['page_count']
+            datas = datas[start:start + pagination['page_count']]
+        return datas
+
+
+register_after_fork(QueryProcessor, "after_fork")
+register_after_fork(QueryProcessor.plan_cache, "after_fork")
+register_after_fork(QueryProcessor.shape_stats, "after_fork")
@@ -18,7 +18,7 @@ def permission_required(module_id, permission_bitmask):
     def decorator(f):
         @wraps(f)  # preserve the original function's metadata
         def decorated_function(*args, **kwargs):
-            with db.get_db_session() as session:
+            with db.get_db_session(db.get_read_operation_type(RoleModulePermission)) as session:
                 user_id = get_jwt_identity()
                 # get user permissions
                 permissions = session.query(
@@ -4,8 +4,11 @@ from flask import Blueprint, request
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
 
 from macroflask import db
+from macroflask.system.model_ext.base_model import result_cache
+from macroflask.system.model_ext.index_advisor import IndexAdvisor
+from macroflask.system.model_ext.query_processor import QueryProcessor
 from macroflask.system.rest_mgmt import permission_required, ResponseHandler
-from macroflask.system.user_model import User, PermissionsConstant
+from macroflask.system.user_model import User, PermissionsConstant, ModuleConstant
 
 system_api_bp = Blueprint('system', __name__)
 
@@ -18,7 +21,7 @@ def login():
     if not username or not password:
         return ResponseHandler.error("Missing username or password", status_code=400)
 
-    with db.get_db_session() as session:
+    with db.get_db_session(db.get_read_operation_type(User)) as session:
         user = session.query(User).filter_by(username=username).one_or_none()
         if not user or not user.check_password(password):
             return ResponseHandler.error("Wrong username or password", status_code=401)
@@ -44,3 +47,72 @@ def protected():
     current_user = get_jwt_identity()
     claims = get_jwt()
     return ResponseHandler.success("Protected route", data={"user_id": current_user, "claims": claims})
+
+
+@system_api_bp.route("/ready/", methods=["GET"])
+def ready():
+    # used by the load balancer, the databases are connected in the background at startup
+    if not db.is_ready:
+        return ResponseHandler.error("Database connections are warming up", status_code=503)
+    return ResponseHandler.success("Ready", data={"warm_up_errors": db.warm_up_errors})
+
+
+@system_api_bp.route("/metrics/pool/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def pool_metrics():
+    return ResponseHandler.success("success_access", data=db.get_pool_metrics())
+
+
+@system_api_bp.route("/metrics/slow_queries/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def slow_queries():
+    order_by = request.args.get("order_by", "total_ms")
+    limit = request.args.get("limit", 50, type=int)
+    try:
+        data = db.get_slow_queries(order_by=order_by, limit=limit)
+    except ValueError as e:
+        return ResponseHandler.error(str(e), status_code=400)
+    return ResponseHandler.success("success_access", data=data)
+
+
+@system_api_bp.route("/metrics/query_plans/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def query_plans():
+    return ResponseHandler.success("success_access", data=QueryProcessor.plan_cache.stats())
+
+
+@system_api_bp.route("/metrics/result_cache/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def result_cache_metrics():
+    return ResponseHandler.success("success_access", data=result_cache.stats())
+
+
+@system_api_bp.route("/metrics/query_shapes/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def query_shapes():
+    order_by = request.args.get("order_by", "total_ms")
+    limit = request.args.get("limit", 50, type=int)
+    try:
+        shapes = QueryProcessor.shape_stats.get_top(order_by=order_by, limit=limit)
+    except ValueError as e:
+        return ResponseHandler.error(str(e), status_code=400)
+    return ResponseHandler.success("success_access", data=[data for _, data in shapes])
+
+
+@system_api_bp.route("/indexes/advice/", methods=["GET"])
+@jwt_required()
+@permission_required(module_id=ModuleConstant.PERMISSION, permission_bitmask=PermissionsConstant.READ)
+def index_advice():
+    # runs EXPLAIN on the top query shapes of this worker
+    order_by = request.args.get("order_by", "total_ms")
+    limit = request.args.get("limit", 10, type=int)
+    try:
+        data = IndexAdvisor(db).advise(order_by=order_by, limit=limit)
+    except ValueError as e:
+        return ResponseHandler.error(str(e), status_code=400)
+    return ResponseHandler.success("success_access", data=data)
@@ -4,10 +4,37 @@ import traceback
 from flask import request, g
 
 from macroflask import ResponseHandler
+from macroflask.models import db
+from macroflask.util.deadline import DeadlineExceeded, get_deadline, set_request_deadline
 from macroflask.util.os_util import UUIDUtil
 
 
+def request_timeout(seconds):
+    """
+    Set the time budget of a route, the database statements and device commands of the request
+    are limited to the remaining time, see FlaskRequestMiddleware.get_request_timeout.
+
+    :param seconds: The time budget in seconds.
+    """
+    def decorator(func):
+        func.request_timeout = seconds
+        return func
+    return decorator
+
+
+def read_from_primary(func):
+    """
+    Keep the reads of a route on the primary, e.g. the permission check and the ModelExtMixin reads of a route
+    which must see the latest writes of other users. Put it right below the route decorator.
+    """
+    func.read_from_primary = True
+    return func
+
+
 class FlaskRequestMiddleware:
+    # the client may ask for a shorter time budget than the route, e.g. the timeout of its own HTTP call
+    TIMEOUT_HEADER = "X-Request-Timeout"
+
     def __init__(self, app=None, logger=None):
         if app is not None:
             self.app = app
@@ -24,6 +51,35 @@ class FlaskRequestMiddleware:
         g.req_start_time = time.time()
         g.req_uuid = UUIDUtil.generate_uuid()
 
+        timeout = self.get_request_timeout()
+        if timeout:
+            set_request_deadline(timeout)
+
+        view_func = self.app.view_functions.get(request.endpoint)
+        if getattr(view_func, "read_from_primary", False):
+            db.read_from_primary()
+
+    def get_request_timeout(self):
+        """
+        Return the time budget of the request in seconds, the shortest of the X-Request-Timeout header
+        and the request_timeout of the route, which defaults to the REQUEST_TIMEOUT config.
+
+        :return: The time budget, or None if the request has no deadline.
+        """
+        view_func = self.app.view_functions.get(request.endpoint)
+        route_timeout = getattr(view_func, "request_timeout", None)
+        if route_timeout is None:
+            route_timeout = self.app.config.get("REQUEST_TIMEOUT")
+
+        header_timeout = None
+        try:
+            header_timeout = float(request.headers.get(self.TIMEOUT_HEADER, ""))
+        except ValueError:
+            pass
+
+        timeouts = [timeout for timeout in (route_timeout, header_timeout) if timeout and timeout > 0]
+        return min(timeouts) if timeouts else None
+
     def after_request(self, response):
         """Called after each request to calculate and print the elapsed time."""
         if hasattr(g, 'req_start_time'):
@@ -32,8 +88,13 @@ class FlaskRequestMiddleware:
             uuid = ""
             if hasattr(g, 'req_uuid'):
                 uuid = g.req_uuid
+            # the statements executed by the request, the warnings of the N+1 queries are logged here
+            statement_stats = db.finish_statement_stats()
+            db_info = ""
+            if statement_stats is not None:
+                db_info = f" {statement_stats.count} statements, {statement_stats.db_time:.4f} seconds in database."
             if self.logger:
-                self.logger.info(f"=== {uuid} API {api_name} took {total_time:.4f} seconds.")
+                self.logger.info(f"=== {uuid} API {api_name} took {total_time:.4f} seconds.{db_info}")
 
         return response
 
@@ -42,4 +103,8 @@ class FlaskRequestMiddleware:
         if self.logger:
             self.logger.error(info)
         msg = ResponseHandler.convert_error_msg(error)
+        # the statements and commands interrupted by the deadline raise their own errors
+        deadline = get_deadline()
+        if isinstance(error, DeadlineExceeded) or (deadline is not None and deadline.expired()):
+            return ResponseHandler.error(msg, status_code=504)
         return ResponseHandler.error(msg, status_code=500)
@@ -1,4 +1,4 @@
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, get_jwt_identity
 
 from macroflask.system.rest_mgmt import ResponseHandler
 
@@ -39,4 +39,14 @@ jwt configuration end.
 
 
 def config_jwt():
-    pass
\ No newline at end of file
+    pass
+
+
+def get_current_identity():
+    """
+    Return the identity of the current request, None if the request carries no verified token.
+    """
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
\ No newline at end of file
@@ -1,4 +1,5 @@
 from sqlalchemy import Integer, String, Column, Boolean, ForeignKey, BigInteger
+from sqlalchemy.orm import relationship
 from flask_login import current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -12,6 +13,7 @@ class User(Base, UserMixin, CommonModelMixin, ModelExtMixin):
 
     create_schema = UserSchema
     update_schema = UserSchema
+    dict_fields = ('id', 'username', 'email', 'role_id')
 
     username = Column(String(50), unique=True, nullable=False)
     email = Column(String(100), unique=True, nullable=False)
@@ -21,6 +23,7 @@ class User(Base, UserMixin, CommonModelMixin, ModelExtMixin):
     last_login_time = Column(String(50), nullable=True)
     locale = Column(String(32))
     role_id = Column(Integer, ForeignKey("sys_role.id"), nullable=False)
+    role = relationship("Role")
 
     @property
     def password(self):
@@ -38,14 +41,6 @@ class User(Base, UserMixin, CommonModelMixin, ModelExtMixin):
         """Check if the provided password matches the hashed password."""
         return check_password_hash(self.password_hash, password)
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'email': self.email,
-            'role_id': self.role_id
-        }
-
 
 class Role(Base, CommonModelMixin, ModelExtMixin):
     __tablename__ = "sys_role"
@@ -0,0 +1,319 @@
+import asyncio
+import os
+
+import sqlalchemy as raw_sa
+import sqlalchemy.event as raw_sa_event
+
+from contextlib import AsyncExitStack, asynccontextmanager
+from sqlalchemy.ext.asyncio import async_sessionmaker, async_scoped_session, create_async_engine
+from sqlalchemy.util import greenlet_spawn
+
+from macroflask.util.bulk_write import BulkWriteStats, iter_chunks
+from macroflask.util.engine_profile import get_engine_profile
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy, RoutingSession
+
+
+class AsyncLightSqlAlchemy(LightSqlAlchemy):
+    # the asyncio driver used when the url names a blocking driver, e.g. mysql+pymysql
+    ASYNC_DRIVERS = {
+        "mysql": "aiomysql",
+        "sqlite": "aiosqlite",
+        "postgresql": "asyncpg",
+    }
+
+    def __init__(self, db_config: dict = None, open_logging=False, logger=None, **kwargs):
+        """
+        Initialize the asyncio counterpart of LightSqlAlchemy, it accepts the same db_config dictionary.
+
+        One session is scoped to each asyncio task, use it with `async with db.get_db_session() as session`.
+        The engines are not connected by the constructor, await connect_engines() in eager or
+        background connect mode, it is started automatically in background mode when an event loop is running.
+
+        :param db_config: Database configuration dictionary. Defaults to None.
+        :param open_logging: Whether to enable logging for SQLAlchemy. Defaults to False.
+        :param logger: The logger used to record the database events.
+        :param kwargs: Additional keyword arguments, the same as LightSqlAlchemy.
+        """
+        self._loop = None
+        self._warm_up_task = None
+        super().__init__(is_flask=False, db_config=db_config, open_logging=open_logging, logger=logger, **kwargs)
+
+    def validate_db_config(self, db_config: dict):
+        super().validate_db_config(db_config)
+        for key, db_obj in db_config.items():
+            if isinstance(db_obj.get("url"), (list, tuple)):
+                raise ValueError(f"Read replica pools are not supported by AsyncLightSqlAlchemy with key: {key}")
+            if db_obj.get("tenant_url"):
+                raise ValueError(f"tenant_url is not supported by AsyncLightSqlAlchemy with key: {key}")
+            # waiting for a slot of the budget would block the event loop
+            if db_obj.get("connection_budget"):
+                raise ValueError(f"connection_budget is not supported by AsyncLightSqlAlchemy with key: {key}")
+
+    def _set_init_options(self, kwargs):
+        if "session_scope" in kwargs:
+            raise ValueError("The async sessions are scoped to the asyncio task, session_scope is not supported")
+        super()._set_init_options(kwargs)
+
+    def _to_async_url(self, url):
+        """
+        Replace a blocking driver of the url by the asyncio driver of the dialect.
+
+        :param url: Database connection URI.
+        :return: The URL instance with an asyncio driver.
+        """
+        url = raw_sa.engine.make_url(url)
+        if url.get_dialect().is_async:
+            return url
+
+        backend_name = url.get_backend_name()
+        if backend_name not in self.ASYNC_DRIVERS:
+            raise ValueError(f"No asyncio driver is known for database: {backend_name}")
+        return url.set(drivername=f"{backend_name}+{self.ASYNC_DRIVERS[backend_name]}")
+
+    def _build_engine(self, url, engine_options, dialect_options=None):
+        profile = get_engine_profile(self._to_async_url(url), dialect_options)
+        options = profile.get_engine_options()
+        options.update(engine_options)
+        engine = create_async_engine(profile.url, **options)
+        # the events are registered on the synchronous engine proxied by the AsyncEngine
+        profile.configure_engine(engine.sync_engine)
+        self.engine_profiles[engine.sync_engine] = profile
+        return engine
+
+    def _instrument_engine(self, name, engine):
+        super()._instrument_engine(name, engine.sync_engine)
+
+    def route_bind(self, session, mapper, shard_id=None, instance=None):
+        # RoutingSession is the synchronous session proxied by the AsyncSession, it needs a synchronous engine
+        engine = super().route_bind(session, mapper, shard_id=shard_id, instance=instance)
+        return engine.sync_engine if engine is not None else None
+
+    def _make_session(self, **kwargs):
+        """
+        Create the read and write async sessions, each asyncio task gets its own session.
+        """
+        # init session configuration
+        session_options = {
+            "autoflush": True,
+            # the attributes can not be lazy loaded after commit without awaiting
+            "expire_on_commit": False,
+        }
+
+        if "session_options" in kwargs:
+            session_options.update(kwargs.pop("session_options"))
+
+        if self.bind_model_engines["read"]:
+            if self.open_logging and self.logger:
+                self.logger.info("Create async read session.")
+            # Configure the session binds, one session for multiple databases
+            read_session_class = type("AsyncReadRoutingSession", (RoutingSession,), {})
+            read_session_local = async_sessionmaker(
+                binds=self.bind_model_engines["read"], sync_session_class=read_session_class,
+                router=self, db_operation_type="read", **self._get_read_session_options(session_options, kwargs))
+            read_session = async_scoped_session(read_session_local, scopefunc=asyncio.current_task)
+            self.sessions["read"] = read_session
+
+            # the transactions of the read sessions are read-only
+            raw_sa_event.listen(read_session_class, "after_begin", self._on_read_begin)
+            if self.shard_sets:
+                raw_sa_event.listen(read_session_class, "do_orm_execute", self._on_shard_execute)
+
+        if self.bind_model_engines["write"]:
+            # The session events are registered on a synchronous session class of this instance only
+            write_session_class = type("AsyncWriteRoutingSession", (RoutingSession,), {})
+            write_session_local = async_sessionmaker(
+                binds=self.bind_model_engines["write"], sync_session_class=write_session_class,
+                router=self, db_operation_type="write", **session_options)
+            if self.open_logging and self.logger:
+                self.logger.info("Create async write session.")
+            write_session = async_scoped_session(write_session_local, scopefunc=asyncio.current_task)
+            self.sessions["write"] = write_session
+
+            # track the committed writes for the read-your-writes consistency
+            raw_sa_event.listen(write_session_class, "after_flush", self._on_write_flush)
+            raw_sa_event.listen(write_session_class, "do_orm_execute", self._on_write_execute)
+            raw_sa_event.listen(write_session_class, "after_commit", self._on_write_commit)
+            raw_sa_event.listen(write_session_class, "after_rollback", self._on_write_rollback)
+
+            # run the statements of the sharded models on their shards
+            if self.shard_sets:
+                raw_sa_event.listen(write_session_class, "do_orm_execute", self._on_shard_execute)
+
+    def _warm_up_engines(self):
+        """
+        Keep the engines to connect for connect_engines(), the constructor can not await them.
+        """
+        if self.connect_mode == self.CONNECT_LAZY or not self._warm_up_targets:
+            self._warm_up_targets = []
+            self._ready.set()
+            return
+
+        if self.connect_mode == self.CONNECT_BACKGROUND:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._warm_up_task = loop.create_task(self.connect_engines())
+
+    async def _connect_engine(self, engine, replica_pool=None):
+        async with engine.connect():
+            if self.logger:
+                self.logger.info("Connected to database: " + str(engine.url))
+
+    async def connect_engines(self):
+        """
+        Connect to all the engines concurrently.
+
+        In eager mode the first connection error is raised, otherwise the errors are recorded in warm_up_errors.
+        """
+        targets, self._warm_up_targets = self._warm_up_targets, []
+        await self._bind_event_loop()
+        results = await asyncio.gather(
+            *(self._connect_engine(engine) for engine, _ in targets), return_exceptions=True)
+
+        errors = []
+        for (engine, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+                self.warm_up_errors[engine.url.render_as_string(hide_password=True)] = str(result)
+                if self.logger:
+                    self.logger.error(f"Failed to connect to database {engine.url}: {result}")
+
+        self._ready.set()
+        if errors and self.connect_mode == self.CONNECT_EAGER:
+            raise errors[0]
+
+    def _replace_pool(self, engine):
+        engine.sync_engine.dispose(close=False)
+
+    def after_fork(self):
+        if self._pid != os.getpid():
+            # the event loop of the parent does not run in the child, the new pools are bound to the first loop
+            self._loop = None
+        super().after_fork()
+
+    async def _bind_event_loop(self):
+        """
+        Bind the connection pools to the running event loop.
+
+        The pooled asyncio connections can not be used by another event loop, e.g. each
+        CoroutineStrategy.execute() runs its own loop, so the pools are replaced when the loop changes.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+
+        previous_loop, self._loop = self._loop, loop
+        if previous_loop is None:
+            return
+
+        # Replace all the pools before awaiting, so the other tasks of this loop never check out from an old pool
+        previous_pools = []
+        for engine in self._iter_engines():
+            previous_pools.append(engine.sync_engine.pool)
+            engine.sync_engine.dispose(close=False)
+
+        for previous_pool in previous_pools:
+            await greenlet_spawn(previous_pool.dispose)
+
+    @asynccontextmanager
+    async def get_db_session(self, db_operation_type="write"):
+        """
+        Async context manager for managing the session lifecycle of the current asyncio task.
+
+        The write session is committed at the end, the read session runs read-only transactions
+        and is rolled back at the end.
+
+        :param db_operation_type: The type of database operation. Defaults to "write".
+
+        :yield: The AsyncSession instance for the current task.
+        """
+        await self._bind_event_loop()
+        session = self._get_session(db_operation_type)
+        try:
+
+            yield session
+            if db_operation_type == "read":
+                await session.rollback()  # Nothing to commit, ending the read-only transaction is cheaper
+            else:
+                await session.commit()  # Commit the transaction
+
+        except Exception as e:
+
+            await session.rollback()  # Rollback the transaction in case of an exception
+            raise e  # Re-raise the exception
+
+        finally:
+
+            await self.close_session(db_operation_type)  # Close the session and connections when the context ends
+
+    async def stream(self, query, batch_size=1000, plain_rows=False, db_operation_type="read"):
+        """
+        Iterate the rows of a large Select with a server-side cursor, see LightSqlAlchemy.stream.
+        The Select runs on the session of the get_db_session() of the calling task, or on a session of its own
+        which is ended with the iteration.
+
+        :yield: The ORM objects of a single entity query, the rows otherwise.
+        """
+        if plain_rows:
+            query = self._select_columns(query)
+
+        await self._bind_event_loop()
+        async with AsyncExitStack() as stack:
+            if self._has_session(db_operation_type):
+                # the caller's get_db_session() ends the session
+                session = self._get_session(db_operation_type)
+            else:
+                session = await stack.enter_async_context(self.get_db_session(db_operation_type))
+            result = await session.stream(query, execution_options={"yield_per": batch_size})
+            if self._is_entity_query(query):
+                result = result.scalars()
+            stack.push_async_callback(result.close)
+
+            async for row in result:
+                yield row._asdict() if plain_rows else row
+
+    async def _bulk_write(self, model, rows, chunk_size, build_statement):
+        # bulk_insert() and bulk_upsert() return this coroutine, await them
+        await self._bind_event_loop()
+        table = model.__table__
+        stats = BulkWriteStats(table.name)
+        statement = None
+        for chunk in iter_chunks(rows, chunk_size):
+            for engine, engine_rows in self._split_rows_by_engine(model, chunk):
+                if statement is None:
+                    statement = build_statement(table, engine.dialect.name, list(chunk[0].keys()))
+                async with engine.begin() as connection:
+                    await connection.execute(statement, engine_rows)
+            stats.add_chunk(len(chunk))
+            self._on_bulk_write(table)
+
+        result = stats.to_dict()
+        if self.logger:
+            self.logger.info(
+                f"Bulk wrote {result['rows']} rows into {table.name} in {result['chunks']} chunks, "
+                f"{result['seconds']} seconds, {result['rows_per_second']} rows per second.")
+        return result
+
+    async def close_session(self, db_operation_type):
+        """
+        Close the session of the current asyncio task and release the connection.
+
+        :param db_operation_type: The type of database operation.
+        """
+        if self.logger and self.open_logging:
+            self.logger.info(f"Close {db_operation_type} session.")
+
+        if self.sessions[db_operation_type]:
+            await self.sessions[db_operation_type].remove()
+
+    async def dispose_engine(self):
+        """
+        Dispose the engines and close all connections.
+
+        The connections left in the pools by a finished event loop are closed as well,
+        await it before the process exits, the asyncio drivers may keep the process alive otherwise.
+        """
+        await self._bind_event_loop()
+        for engine in self._iter_engines():
+            await engine.dispose()
@@ -0,0 +1,108 @@
+import time
+
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+
+# the INSERT constructs which know the upsert clause of each dialect
+UPSERT_INSERTS = {
+    "mysql": mysql.insert,
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+def iter_chunks(rows, chunk_size):
+    """
+    Split the rows into lists of chunk_size rows, the rows may be a generator.
+
+    :param rows: The iterable of row dictionaries.
+    :param chunk_size: The number of rows of each chunk.
+    :return: The generator of the chunks.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def build_insert_statement(table):
+    """
+    Build a plain INSERT, executed with a list of rows it is sent by executemany / insertmanyvalues.
+    The columns are those of the first row, the same statement suits every dialect.
+
+    :param table: The table to insert into.
+    :return: The INSERT statement.
+    """
+    return table.insert()
+
+
+def build_upsert_statement(table, dialect_name, columns, update_columns=None, conflict_columns=None):
+    """
+    Build an INSERT which updates the existing rows, by ON DUPLICATE KEY UPDATE on MySQL
+    and ON CONFLICT DO UPDATE on SQLite and PostgreSQL.
+
+    :param table: The table to insert into.
+    :param dialect_name: The name of the database dialect.
+    :param columns: The column names of the rows.
+    :param update_columns: The columns to update on conflict, defaults to the columns of the rows
+        except the conflict columns.
+    :param conflict_columns: The columns of the unique constraint, defaults to the primary key.
+        MySQL always uses the conflicting unique key.
+    :return: The upsert statement.
+
+    :exception: ValueError if the dialect does not support upserts.
+    """
+    if dialect_name not in UPSERT_INSERTS:
+        raise ValueError(f"Upsert is not supported by database: {dialect_name}")
+
+    conflict_columns = list(conflict_columns or [column.name for column in table.primary_key.columns])
+    if update_columns is None:
+        update_columns = [column for column in columns if column not in conflict_columns]
+
+    statement = UPSERT_INSERTS[dialect_name](table)
+    if dialect_name == "mysql":
+        # the values of the conflicting row, rendered as VALUES(column)
+        set_ = {column: statement.inserted[column] for column in update_columns}
+        if not set_:
+            # keep the existing row, assigning a key column to itself is a no-op
+            set_ = {conflict_columns[0]: table.c[conflict_columns[0]]}
+        return statement.on_duplicate_key_update(set_)
+
+    if not update_columns:
+        return statement.on_conflict_do_nothing(index_elements=conflict_columns)
+    set_ = {column: statement.excluded[column] for column in update_columns}
+    return statement.on_conflict_do_update(index_elements=conflict_columns, set_=set_)
+
+
+class BulkWriteStats:
+    def __init__(self, table_name):
+        """
+        Throughput of one bulk write.
+
+        :param table_name: The name of the table written to.
+        """
+        self.table_name = table_name
+        self.rows = 0
+        self.chunks = 0
+        self.start_time = time.perf_counter()
+
+    def add_chunk(self, row_count):
+        self.rows += row_count
+        self.chunks += 1
+
+    def to_dict(self):
+        seconds = time.perf_counter() - self.start_time
+        return {
+            "table": self.table_name,
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(self.rows / seconds) if seconds > 0 else self.rows,
+        }
@@ -1,5 +1,15 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError
+
+from macroflask.util.deadline import deadline_scope, get_deadline
+
+DEADLINE_EXCEEDED_MSG = "Task cancelled: deadline exceeded"
+
+
+def run_with_deadline(deadline, task, args):
+    """ Run a task of a worker thread or process with the deadline of the caller. """
+    with deadline_scope(deadline):
+        return task(*args)
 
 
 class ConcurrencyStrategy:
@@ -9,95 +19,122 @@ class ConcurrencyStrategy:
 
 
 class ThreadPoolStrategy(ConcurrencyStrategy):
-    def execute(self, tasks_with_args, worker_count, logger=None, **kwargs):
+    def execute(self, tasks_with_args, worker_count, logger=None, deadline=None, **kwargs):
+        """
+        :param deadline: The Deadline of the tasks, defaults to the deadline of the current request.
+            The tasks which have not finished by then are reported as failed, the pending ones are cancelled.
+        """
         if logger:
             logger.info(f"Using threads to execute tasks, worker count: {worker_count}...")
         else:
             print(f"Using threads to execute tasks, worker count: {worker_count}...")
 
-        with ThreadPoolExecutor(max_workers=worker_count) as executor:
-            futures = []  # Store all task Future objects
-            for task, args in tasks_with_args:
-                try:
-                    future = executor.submit(lambda: task(*args))  # Submit task
-                    futures.append(future)
-                except Exception as e:
-                    error_msg = f"Task submission failed: {e}"
-                    if logger:
-                        logger.error(error_msg)
-                    else:
-                        print(error_msg)
-
-            # Collect results as they complete
-            results = []
-            for future in as_completed(futures):
-                try:
-                    result = future.result()  # Get task result
-                    results.append((True, result))  # Success status and result
-                except Exception as e:
-                    error_msg = f"Task execution failed: {e}"
-                    if logger:
-                        logger.error(error_msg)
-                    else:
-                        print(error_msg)
-                    results.append((False, error_msg))  # Failure status and error message
+        deadline = deadline or get_deadline()
+        executor = ThreadPoolExecutor(max_workers=worker_count)
+        futures = []  # Store all task Future objects
+        for task, args in tasks_with_args:
+            try:
+                future = executor.submit(run_with_deadline, deadline, task, args)  # Submit task
+                futures.append(future)
+            except Exception as e:
+                error_msg = f"Task submission failed: {e}"
+                if logger:
+                    logger.error(error_msg)
+                else:
+                    print(error_msg)
 
+        results = _collect_results(futures, deadline, logger)
+        # do not wait for the tasks running past the deadline, their own timeouts are capped by it
+        executor.shutdown(wait=not (deadline and deadline.expired()), cancel_futures=True)
         return results
 
 
 class ProcessPoolStrategy(ConcurrencyStrategy):
-    def execute(self, tasks_with_args, worker_count, logger=None, **kwargs):
+    def execute(self, tasks_with_args, worker_count, logger=None, deadline=None, **kwargs):
         if logger:
             logger.info(f"Using processes to execute tasks, worker count: {worker_count}...")
 
-        with ProcessPoolExecutor(max_workers=worker_count, **kwargs) as executor:
-            futures = []  # Store all task Future objects
-            for task, args in tasks_with_args:
-                try:
-                    future = executor.submit(task, *args)  # Submit task
-                    futures.append(future)
-                except Exception as e:
-                    error_msg = f"Task submission failed: {e}"
-                    if logger:
-                        logger.error(error_msg)
-                    else:
-                        print(error_msg)
-                    futures.append((False, error_msg))  # Store failure status for submission error
-
-            # Collect results as they complete
-            results = []
-            for future in as_completed(futures):
-                try:
-                    result = future.result()  # Get task result
-                    results.append((True, result))  # Success status and result
-                except Exception as e:
-                    error_msg = f"Task execution failed: {e}"
-                    if logger:
-                        logger.error(error_msg)
-                    else:
-                        print(error_msg)
-                    results.append((False, error_msg))  # Failure status and error message
+        deadline = deadline or get_deadline()
+        executor = ProcessPoolExecutor(max_workers=worker_count, **kwargs)
+        futures = []  # Store all task Future objects
+        results = []
+        for task, args in tasks_with_args:
+            try:
+                future = executor.submit(run_with_deadline, deadline, task, args)  # Submit task
+                futures.append(future)
+            except Exception as e:
+                error_msg = f"Task submission failed: {e}"
+                if logger:
+                    logger.error(error_msg)
+                else:
+                    print(error_msg)
+                results.append((False, error_msg))  # Store failure status for submission error
 
+        results.extend(_collect_results(futures, deadline, logger))
+        executor.shutdown(wait=not (deadline and deadline.expired()), cancel_futures=True)
         return results
 
 
+def _collect_results(futures, deadline, logger=None):
+    """
+    Collect the results of the futures as they complete, until the deadline.
+
+    :return: The list of (success, result or error message) tuples.
+    """
+    results = []
+    done_futures = set()
+    try:
+        for future in as_completed(futures, timeout=deadline.remaining() if deadline else None):
+            done_futures.add(future)
+            try:
+                result = future.result()  # Get task result
+                results.append((True, result))  # Success status and result
+            except Exception as e:
+                error_msg = f"Task execution failed: {e}"
+                if logger:
+                    logger.error(error_msg)
+                else:
+                    print(error_msg)
+                results.append((False, error_msg))  # Failure status and error message
+    except TimeoutError:
+        for future in futures:
+            if future not in done_futures:
+                future.cancel()
+                results.append((False, DEADLINE_EXCEEDED_MSG))
+        if logger:
+            logger.error(f"{len(futures) - len(done_futures)} tasks did not finish before the deadline.")
+
+    return results
+
+
 class CoroutineStrategy(ConcurrencyStrategy):
-    async def async_execute(self, tasks_with_args, worker_count=None, logger=None):
+    async def async_execute(self, tasks_with_args, worker_count=None, logger=None, deadline=None):
         if logger:
             logger.info("Executing tasks using coroutines with limited worker count...")
 
         # Set up a semaphore to limit the concurrency level
         semaphore = asyncio.Semaphore(worker_count) if worker_count else None
+        deadline = deadline or get_deadline()
+
+        async def run_with_timeout(task, args):
+            if deadline is None:
+                return await task(*args)  # Run the coroutine task with args
+            # cancel the task when the deadline passes
+            return await asyncio.wait_for(task(*args), timeout=deadline.remaining())
 
         async def run_task(task, args):
             try:
                 # Wait for a slot if worker count is limited
                 if semaphore:
                     async with semaphore:
-                        result = await task(*args)  # Run the coroutine task with args
+                        result = await run_with_timeout(task, args)
                 else:
-                    result = await task(*args)
+                    result = await run_with_timeout(task, args)
                 return (True, result)
+            except asyncio.TimeoutError:
+                if logger:
+                    logger.error(DEADLINE_EXCEEDED_MSG)
+                return (False, DEADLINE_EXCEEDED_MSG)
             except Exception as e:
                 error_msg = f"Task execution failed: {e}"
                 if logger:
@@ -109,11 +146,12 @@ class CoroutineStrategy(ConcurrencyStrategy):
         # Create coroutine tasks for all input tasks
         tasks = [run_task(task, args) for task, args in tasks_with_args]
 
-        # Execute all tasks concurrently with control on worker count
-        return await asyncio.gather(*tasks)
+        # Execute all tasks concurrently with control on worker count, the tasks see the deadline
+        with deadline_scope(deadline):
+            return await asyncio.gather(*tasks)
 
-    def execute(self, tasks_with_args, worker_count=None, logger=None):
-        return asyncio.run(self.async_execute(tasks_with_args, worker_count, logger))
+    def execute(self, tasks_with_args, worker_count=None, logger=None, deadline=None):
+        return asyncio.run(self.async_execute(tasks_with_args, worker_count, logger, deadline))
 
 
 class ConcurrencyContext:
@@ -0,0 +1,214 @@
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+import sqlalchemy.event as raw_sa_event
+import sqlalchemy.exc as raw_sa_exc
+
+from macroflask.util.deadline import cap_timeout
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows
+    fcntl = None
+
+
+class ConnectionBudget:
+    def __init__(self, name, max_connections, timeout=30, min_connections=1, pressure_window=1, path=None,
+                 logger=None):
+        """
+        Limit the number of connections all the processes of a host open to one database.
+
+        Each connection holds one of max_connections slots, a slot is a byte of a lock file locked with
+        fcntl.lockf(). The kernel releases the slots of a process when it exits, even if it crashes, and
+        a forked child does not inherit the slots of its parent.
+        A process waiting for a slot marks the budget under pressure, then the other processes close the
+        connections they check in instead of keeping them idle, so the share of each process follows its demand.
+        The locks belong to the process, so a process must use a single ConnectionBudget per lock file.
+
+        :param name: The name of the budget, the engines of all processes using the same name share it.
+        :param max_connections: The maximum number of connections of all processes.
+        :param timeout: Number of seconds to wait for a slot, capped by the deadline of the current request.
+        :param min_connections: The number of connections a process keeps under pressure.
+        :param pressure_window: Number of seconds the budget stays under pressure after a process waited.
+        :param path: The lock file, defaults to a file named after the budget in the temporary directory.
+        :param logger: The logger used to record the exhausted budget.
+        """
+        if fcntl is None:
+            raise ValueError("The connection budget requires fcntl, it is not available on this platform")
+        if not isinstance(max_connections, int) or max_connections < 1:
+            raise ValueError(f"max_connections must be a positive integer with budget: {name}")
+
+        self.name = name
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.min_connections = min_connections
+        self.pressure_window = pressure_window
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), "macroflask-budget-" + re.sub(r"[^\w.-]", "_", name) + ".lock")
+        self.pressure_path = self.path + ".pressure"
+        self.logger = logger
+
+        self.waits = 0
+        self.timeouts = 0
+        self.released_under_pressure = 0
+        self._reset()
+
+    def _reset(self):
+        self._fd = None
+        # the slots locked by this process, and the slots of its connections keyed by their id
+        self._held = set()
+        self._slots = {}
+        self._last_pressure = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_default_name(url):
+        """ :return: The name of the budget of a database url, e.g. 'mysql-db1.local-3306-inventory'. """
+        return "-".join(str(part) for part in (url.get_backend_name(), url.host, url.port, url.database) if part)
+
+    def register_engine(self, engine):
+        """
+        Take a slot for each connection the engine opens and give it back when the connection is closed.
+        Register it after the other do_connect events of the engine, it opens the connection itself.
+
+        :param engine: The engine to limit.
+        """
+        raw_sa_event.listen(engine, "do_connect", self._on_do_connect)
+        raw_sa_event.listen(engine, "checkin", self._on_checkin)
+        raw_sa_event.listen(engine, "close", self._on_close)
+        raw_sa_event.listen(engine, "close_detached", self._on_close_detached)
+
+    def _get_fd(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        return self._fd
+
+    def _try_acquire(self):
+        """ :return: A free slot locked by this process, None if all the slots are taken. """
+        with self._lock:
+            fd = self._get_fd()
+            # start at a random slot, so the processes do not all compete for the first ones
+            start = random.randrange(self.max_connections)
+            for offset in range(self.max_connections):
+                slot = (start + offset) % self.max_connections
+                # the locks belong to the process, lockf() would lock a slot of another thread again
+                if slot in self._held:
+                    continue
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except OSError:
+                    continue
+                self._held.add(slot)
+                return slot
+        return None
+
+    def acquire(self):
+        """
+        Wait for a free slot.
+
+        :return: The slot.
+
+        :exception: sqlalchemy.exc.TimeoutError if no slot is free before the timeout.
+        """
+        slot = self._try_acquire()
+        if slot is not None:
+            return slot
+
+        self.waits += 1
+        timeout = cap_timeout(self.timeout)
+        expires_at = time.monotonic() + (timeout if timeout is not None else float("inf"))
+        delay = 0.005
+        while True:
+            self._signal_pressure()
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                if self.logger:
+                    self.logger.warning(
+                        f"The connection budget {self.name} of {self.max_connections} connections is exhausted.")
+                raise raw_sa_exc.TimeoutError(
+                    f"Connection budget {self.name} of {self.max_connections} connections exhausted, "
+                    f"timed out after {timeout} seconds")
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+            slot = self._try_acquire()
+            if slot is not None:
+                return slot
+
+    def release(self, slot):
+        with self._lock:
+            fcntl.lockf(self._get_fd(), fcntl.LOCK_UN, 1, slot)
+            self._held.discard(slot)
+
+    def _signal_pressure(self):
+        now = time.time()
+        if now - self._last_pressure < self.pressure_window / 4:
+            return
+        self._last_pressure = now
+        try:
+            with open(self.pressure_path, "a"):
+                pass
+            os.utime(self.pressure_path)
+        except OSError:
+            pass
+
+    def is_under_pressure(self):
+        """ Whether a process has been waiting for a slot within the pressure window. """
+        try:
+            return time.time() - os.stat(self.pressure_path).st_mtime < self.pressure_window
+        except OSError:
+            return False
+
+    def _on_do_connect(self, dialect, conn_rec, cargs, cparams):
+        slot = self.acquire()
+        try:
+            dbapi_connection = dialect.connect(*cargs, **cparams)
+        except Exception:
+            self.release(slot)
+            raise
+
+        with self._lock:
+            self._slots[id(dbapi_connection)] = slot
+        return dbapi_connection
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        if dbapi_connection is None or len(self._slots) <= self.min_connections:
+            return
+        if self.is_under_pressure():
+            # close the connection instead of keeping it idle, its slot goes to a waiting process
+            self.released_under_pressure += 1
+            connection_record.close()
+
+    def _on_close(self, dbapi_connection, connection_record):
+        self._on_close_detached(dbapi_connection)
+
+    def _on_close_detached(self, dbapi_connection):
+        with self._lock:
+            slot = self._slots.pop(id(dbapi_connection), None)
+        if slot is not None:
+            self.release(slot)
+
+    def after_fork(self):
+        """
+        Forget the slots of the parent in a forked child process, the locks of the parent are not inherited.
+        Closing the inherited file descriptor does not release the locks of the parent.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+        self._reset()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "max_connections": self.max_connections,
+            "held": len(self._held),
+            "under_pressure": self.is_under_pressure(),
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "released_under_pressure": self.released_under_pressure,
+        }
@@ -0,0 +1,97 @@
+import contextvars
+import time
+
+from contextlib import contextmanager
+from flask import g, has_app_context
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout):
+        """
+        The point in time by which a unit of work, e.g. an HTTP request, must be done.
+
+        :param timeout: Number of seconds from now.
+        """
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        """ Return the remaining seconds, 0 when the deadline has passed. """
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self):
+        """
+        :exception: DeadlineExceeded if the deadline has passed.
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.timeout} seconds exceeded")
+
+
+# the deadline of the non-Flask code and of the worker threads, see deadline_scope
+_current_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def get_deadline():
+    """
+    Return the deadline of the current unit of work.
+
+    :return: The Deadline set by deadline_scope(), otherwise the deadline of the current Flask request, or None.
+    """
+    deadline = _current_deadline.get()
+    if deadline is None and has_app_context():
+        deadline = g.get("deadline")
+    return deadline
+
+
+def set_request_deadline(timeout):
+    """
+    Set the deadline of the current Flask request.
+
+    :param timeout: Number of seconds from now.
+    :return: The Deadline instance.
+    """
+    g.deadline = Deadline(timeout)
+    return g.deadline
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """
+    Run the code inside the context with a deadline, e.g. the tasks of a worker thread.
+
+    :param deadline: A Deadline instance, a number of seconds from now, or None for no deadline.
+
+    :yield: The Deadline instance or None.
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def cap_timeout(timeout=None):
+    """
+    Shorten a timeout to the remaining time of the current deadline.
+
+    :param timeout: The timeout in seconds, None means no timeout.
+    :return: The timeout, or the remaining seconds if it is shorter or no timeout is given.
+
+    :exception: DeadlineExceeded if the deadline has passed.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+
+    deadline.check()
+    remaining = deadline.remaining()
+    return remaining if timeout is None else min(timeout, remaining)
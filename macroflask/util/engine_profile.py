@@ -0,0 +1,390 @@
+import sqlalchemy as raw_sa
+import sqlalchemy.event as raw_sa_event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
+
+from macroflask.util.deadline import get_deadline
+
+
+class EngineProfile:
+    """
+    Default engine options and connection tuning of one database dialect.
+
+    The engine_options of a bind are applied on top of the profile defaults,
+    and the dialect_options of a bind tune the profile itself.
+    """
+    dialect = None
+
+    def __init__(self, url, dialect_options=None):
+        """
+        :param url: The database url.
+        :param dialect_options: The dialect specific options of the bind.
+        """
+        self.url = raw_sa.engine.make_url(url)
+        self.dialect_options = dialect_options or {}
+
+    def get_engine_options(self):
+        """
+        Return the default keyword arguments for create_engine.
+
+        :return: The engine options dictionary.
+        """
+        return {
+            # enable the echo mode for debugging
+            "echo": False,
+            # enable the echo mode for the connection pool, input 'debug' if you want to debug
+            "echo_pool": False,
+        }
+
+    def configure_engine(self, engine):
+        """
+        Register the dialect specific tuning on a newly created engine.
+
+        :param engine: The engine instance.
+        """
+        # limit the statements of each transaction to the remaining time of the request deadline
+        raw_sa_event.listen(engine, "begin", self._on_begin)
+        raw_sa_event.listen(engine, "checkin", self._on_checkin)
+
+    def set_statement_timeout(self, dialect, dbapi_connection, deadline):
+        """
+        Limit the statements executed on a connection to the remaining time of a deadline.
+
+        :param dialect: The dialect of the engine.
+        :param dbapi_connection: The DBAPI connection.
+        :param deadline: The Deadline instance.
+        :return: True if the timeout outlives the transaction and must be reset when the connection is checked in.
+        """
+        return False
+
+    def reset_statement_timeout(self, dialect, dbapi_connection):
+        """
+        Remove the statement timeout before the connection is used by another request.
+
+        :param dialect: The dialect of the engine.
+        :param dbapi_connection: The DBAPI connection.
+        """
+        pass
+
+    def set_read_only(self, dialect, dbapi_connection):
+        """
+        Make the transaction which is beginning on a connection read-only, the database may skip
+        the bookkeeping of the writes, e.g. the transaction id of InnoDB.
+
+        :param dialect: The dialect of the engine.
+        :param dbapi_connection: The DBAPI connection.
+        :return: True if the setting outlives the transaction and must be reset when the connection is checked in.
+        """
+        return False
+
+    def reset_read_only(self, dialect, dbapi_connection):
+        """
+        Allow the writes again before the connection is used by another session.
+
+        :param dialect: The dialect of the engine.
+        :param dbapi_connection: The DBAPI connection.
+        """
+        pass
+
+    def estimate_row_count(self, connection, table):
+        """
+        Return the number of rows of a table estimated by the statistics of the database, without scanning it.
+
+        :param connection: The Connection instance.
+        :param table: The Table instance.
+        :return: The estimated number of rows, None if the database has no statistics of the table.
+        """
+        return None
+
+    def explain(self, connection, statement):
+        """
+        Return the execution plan of a SELECT statement.
+
+        :param connection: The Connection instance.
+        :param statement: The SQL of the statement with literal values.
+        :return: The dictionary of the plan lines, full_scan (a table is read without an index) and
+            sort_without_index (the rows are sorted after they are read), None if the dialect is not supported.
+        """
+        return None
+
+    def begin_read_only(self, connection):
+        """
+        Called when a read session begins a transaction on a connection.
+
+        :param connection: The Connection instance.
+        """
+        if self.set_read_only(connection.dialect, connection.connection.dbapi_connection):
+            connection.connection.info["read_only_dialect"] = connection.dialect
+
+    def _on_begin(self, conn):
+        deadline = get_deadline()
+        if deadline is None:
+            return
+
+        # do not start a transaction which can not finish in time
+        deadline.check()
+        if self.set_statement_timeout(conn.dialect, conn.connection.dbapi_connection, deadline):
+            conn.connection.info["statement_timeout_dialect"] = conn.dialect
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        dialect = connection_record.info.pop("statement_timeout_dialect", None)
+        if dialect is not None and dbapi_connection is not None:
+            self.reset_statement_timeout(dialect, dbapi_connection)
+
+        dialect = connection_record.info.pop("read_only_dialect", None)
+        if dialect is not None and dbapi_connection is not None:
+            self.reset_read_only(dialect, dbapi_connection)
+
+    @staticmethod
+    def _execute(dbapi_connection, statement):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+class MySQLProfile(EngineProfile):
+    dialect = "mysql"
+
+    def get_engine_options(self):
+        engine_options = super().get_engine_options()
+        engine_options.update({
+            # increase the number of connections in the pool
+            "pool_size": 50,
+            # increase the number of connections that can be created when the pool is empty
+            "max_overflow": 100,
+            # number of seconds to wait before giving up on getting a connection from the pool
+            "pool_timeout": 30,
+            # reset the timeout of idle connections in the connection pool (seconds)
+            "pool_recycle": 4 * 60 * 60,
+            # isolation level for the engine
+            "isolation_level": "READ COMMITTED",
+            # enable the pool pre-ping to test connections before using them
+            # "pool_pre_ping": False,
+        })
+        return engine_options
+
+    def set_statement_timeout(self, dialect, dbapi_connection, deadline):
+        # only the SELECT statements can be interrupted, MariaDB takes seconds instead of milliseconds
+        remaining = deadline.remaining()
+        if dialect.is_mariadb:
+            self._execute(dbapi_connection, f"SET SESSION max_statement_time = {max(remaining, 0.001):.3f}")
+        else:
+            self._execute(dbapi_connection, f"SET SESSION max_execution_time = {max(int(remaining * 1000), 1)}")
+        return True
+
+    def reset_statement_timeout(self, dialect, dbapi_connection):
+        if dialect.is_mariadb:
+            self._execute(dbapi_connection, "SET SESSION max_statement_time = 0")
+        else:
+            self._execute(dbapi_connection, "SET SESSION max_execution_time = 0")
+
+    def set_read_only(self, dialect, dbapi_connection):
+        # applies to the next transaction, it starts with the first statement of the session
+        self._execute(dbapi_connection, "SET TRANSACTION READ ONLY")
+        return False
+
+    def estimate_row_count(self, connection, table):
+        # InnoDB samples the table, the estimate may be off by tens of percent
+        statement = "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_NAME = :name AND TABLE_SCHEMA = "
+        statement += ":schema" if table.schema else "DATABASE()"
+        row_count = connection.execute(raw_sa.text(statement), {"name": table.name, "schema": table.schema}).scalar()
+        return int(row_count) if row_count is not None else None
+
+    def explain(self, connection, statement):
+        rows = [row._mapping for row in connection.exec_driver_sql(f"EXPLAIN {statement}")]
+        plan = [f"{row['table']}: type={row['type']} key={row['key']} rows={row['rows']} {row['Extra'] or ''}"
+                for row in rows]
+        return {
+            "plan": [line.strip() for line in plan],
+            "full_scan": any(row["type"] == "ALL" for row in rows),
+            "sort_without_index": any("Using filesort" in (row["Extra"] or "") for row in rows),
+        }
+
+
+class SQLiteProfile(EngineProfile):
+    dialect = "sqlite"
+
+    # PRAGMA statements executed on every new connection, override them with dialect_options["pragmas"]
+    DEFAULT_PRAGMAS = {
+        # readers do not block the writer and the writer does not block readers
+        "journal_mode": "WAL",
+        # safe with WAL, only the checkpoints are synced
+        "synchronous": "NORMAL",
+        # read the database file through memory mapping (256 MB)
+        "mmap_size": 256 * 1024 * 1024,
+        # page cache size in KiB when negative (64 MB)
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+    def is_memory_database(self):
+        database = self.url.database
+        return not database or database == ":memory:" or self.url.query.get("mode") == "memory"
+
+    def get_pragmas(self):
+        pragmas = dict(self.DEFAULT_PRAGMAS)
+        pragmas.update(self.dialect_options.get("pragmas", {}))
+        if self.is_memory_database():
+            # an in-memory database has no journal file to put in WAL mode
+            pragmas.pop("journal_mode", None)
+        return pragmas
+
+    def get_engine_options(self):
+        engine_options = super().get_engine_options()
+        connect_args = {
+            # the pooled connections are shared by the threads of the process
+            "check_same_thread": False,
+            # number of prepared statements cached by each connection
+            "cached_statements": self.dialect_options.get("cached_statements", 256),
+        }
+        engine_options["connect_args"] = connect_args
+
+        if self.is_memory_database():
+            # all threads share the single connection, otherwise each connection gets its own empty database
+            engine_options["poolclass"] = StaticPool
+        else:
+            # the asyncio driver does not pool the connections by default
+            engine_options["poolclass"] = AsyncAdaptedQueuePool if self.url.get_dialect().is_async else QueuePool
+            # SQLite has a single writer, a small pool is enough
+            engine_options["pool_size"] = 10
+            engine_options["max_overflow"] = 20
+            engine_options["pool_timeout"] = 30
+        return engine_options
+
+    def set_statement_timeout(self, dialect, dbapi_connection, deadline):
+        # the asyncio driver runs the sqlite3 connection in its own thread, it can not be interrupted from here
+        if not hasattr(dbapi_connection, "set_progress_handler"):
+            return False
+
+        # called every 1000 virtual machine instructions, a non-zero return value interrupts the statement
+        dbapi_connection.set_progress_handler(lambda: int(deadline.expired()), 1000)
+        return True
+
+    def reset_statement_timeout(self, dialect, dbapi_connection):
+        dbapi_connection.set_progress_handler(None, 0)
+
+    def set_read_only(self, dialect, dbapi_connection):
+        # SQLite has no read-only transactions, the pragma applies to the connection
+        self._execute(dbapi_connection, "PRAGMA query_only = ON")
+        return True
+
+    def reset_read_only(self, dialect, dbapi_connection):
+        self._execute(dbapi_connection, "PRAGMA query_only = OFF")
+
+    def estimate_row_count(self, connection, table):
+        # the statistics collected by ANALYZE, the first number of the stat of a table is its row count
+        has_statistics = connection.execute(
+            raw_sa.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")).scalar()
+        if not has_statistics:
+            return None
+        stat = connection.execute(
+            raw_sa.text("SELECT stat FROM sqlite_stat1 WHERE tbl = :name LIMIT 1"), {"name": table.name}).scalar()
+        return int(stat.split()[0]) if stat else None
+
+    def explain(self, connection, statement):
+        # the detail column, e.g. 'SCAN device', 'SEARCH device USING INDEX ix_vendor (vendor=?)'
+        plan = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}")]
+        return {
+            "plan": plan,
+            "full_scan": any(line.startswith("SCAN") and "INDEX" not in line and "CONSTANT ROW" not in line
+                             for line in plan),
+            "sort_without_index": any(line.startswith("USE TEMP B-TREE FOR") and "ORDER BY" in line for line in plan),
+        }
+
+    def configure_engine(self, engine):
+        super().configure_engine(engine)
+        pragmas = self.get_pragmas()
+
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas.items():
+                    cursor.execute(f"PRAGMA {name}={value}")
+            finally:
+                cursor.close()
+
+        raw_sa_event.listen(engine, "connect", on_connect)
+
+
+class PostgreSQLProfile(EngineProfile):
+    dialect = "postgresql"
+
+    def get_engine_options(self):
+        engine_options = super().get_engine_options()
+        engine_options.update({
+            # number of seconds to wait before giving up on getting a connection from the pool
+            "pool_timeout": 30,
+            # isolation level for the engine
+            "isolation_level": "READ COMMITTED",
+            # test connections before using them, the server or pgbouncer may close idle connections
+            "pool_pre_ping": True,
+            # reuse the most recent connections, so the idle ones can be closed by the server
+            "pool_use_lifo": True,
+        })
+
+        if self.dialect_options.get("pgbouncer"):
+            # pgbouncer multiplexes the server connections, a small client pool per process is enough
+            engine_options.update({"pool_size": 5, "max_overflow": 10, "pool_recycle": 5 * 60})
+            if self.url.get_driver_name() == "psycopg":
+                # transaction pooling does not support server-side prepared statements
+                engine_options["connect_args"] = {"prepare_threshold": None}
+            elif self.url.get_driver_name() == "asyncpg":
+                engine_options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+        else:
+            engine_options.update({"pool_size": 20, "max_overflow": 40, "pool_recycle": 60 * 60})
+
+        # no engine-wide stream_results: a named cursor can not run INSERT, UPDATE or SET statements,
+        # db.stream() asks for a server-side cursor per SELECT with yield_per
+        return engine_options
+
+    def set_statement_timeout(self, dialect, dbapi_connection, deadline):
+        # SET LOCAL ends with the transaction, it is also safe with the transaction pooling of pgbouncer
+        self._execute(dbapi_connection, f"SET LOCAL statement_timeout = {max(int(deadline.remaining() * 1000), 1)}")
+        return False
+
+    def set_read_only(self, dialect, dbapi_connection):
+        # the driver has started the transaction, it must be the first statement of it
+        self._execute(dbapi_connection, "SET TRANSACTION READ ONLY")
+        return False
+
+    def estimate_row_count(self, connection, table):
+        # the planner statistics, up to date after ANALYZE or autovacuum, -1 if the table was never analyzed
+        name = f"{table.schema}.{table.name}" if table.schema else table.name
+        row_count = connection.execute(
+            raw_sa.text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}).scalar()
+        return int(row_count) if row_count is not None and row_count >= 0 else None
+
+    def explain(self, connection, statement):
+        plan = [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}")]
+        return {
+            "plan": plan,
+            "full_scan": any("Seq Scan" in line for line in plan),
+            "sort_without_index": any(line.strip().startswith("Sort Key:") for line in plan),
+        }
+
+
+ENGINE_PROFILES = {
+    MySQLProfile.dialect: MySQLProfile,
+    SQLiteProfile.dialect: SQLiteProfile,
+    PostgreSQLProfile.dialect: PostgreSQLProfile,
+}
+
+
+def get_engine_profile(url, dialect_options=None):
+    """
+    Return the engine profile of a database url.
+
+    :param url: The database url.
+    :param dialect_options: The dialect specific options of the bind.
+    :return: The EngineProfile instance.
+
+    :exception: ValueError if the database dialect is not supported.
+    """
+    url = raw_sa.engine.make_url(url)
+    profile_class = ENGINE_PROFILES.get(url.get_backend_name())
+    if profile_class is None:
+        raise ValueError(
+            f"Unsupported database: {url.get_backend_name()}, "
+            f"supported databases are: {', '.join(ENGINE_PROFILES)}.")
+    return profile_class(url, dialect_options)
@@ -0,0 +1,24 @@
+import os
+import weakref
+
+
+def register_after_fork(instance, method_name):
+    """
+    Call a method of an object in the child process after each os.fork(), e.g. when a pre-forking server
+    like gunicorn --preload forks its workers. The object is not kept alive by the registration.
+
+    :param instance: The object to reinitialize in the child process.
+    :param method_name: The name of the method to call, it is called without arguments.
+    """
+    if not hasattr(os, "register_at_fork"):
+        # e.g. Windows, where the child processes are spawned instead of forked
+        return
+
+    instance_ref = weakref.ref(instance)
+
+    def after_fork_in_child():
+        instance = instance_ref()
+        if instance is not None:
+            getattr(instance, method_name)()
+
+    os.register_at_fork(after_in_child=after_fork_in_child)
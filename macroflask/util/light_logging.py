@@ -4,6 +4,8 @@ import os
 from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 from multiprocessing import Queue
 
+from macroflask.util.fork_util import register_after_fork
+
 
 class CustomizeQueueListener(QueueListener):
 
@@ -48,6 +50,12 @@ class MacroFlaskLogger:
         self.path = path
         self.mode = mode  # Either 'multiprocessing' or 'multithreading'
 
+        # the process running the queue listener and the handlers sending to the queue, see after_fork
+        self._pid = os.getpid()
+        self._listener_pid = None
+        self._queue_handlers = []
+        register_after_fork(self, "after_fork")
+
         if config:
             self._setup_logging()
 
@@ -60,6 +68,7 @@ class MacroFlaskLogger:
         if self.mode == 'multiprocessing':
             self.queue_listener = CustomizeQueueListener(self.log_queue, *self._get_handlers())
             self.queue_listener.start()
+            self._listener_pid = os.getpid()
 
         elif self.mode == 'multithreading':
             logging.config.dictConfig(self.logger_config)
@@ -150,8 +159,33 @@ class MacroFlaskLogger:
         logger = logging.getLogger(name)
         if self.mode == 'multiprocessing':
             logger.setLevel(logging.DEBUG)
-            logger.addHandler(QueueHandler(self.log_queue))
+            queue_handler = QueueHandler(self.log_queue)
+            self._queue_handlers.append(queue_handler)
+            logger.addHandler(queue_handler)
         return logger
 
+    def after_fork(self):
+        """
+        Reinitialize in a forked child process, e.g. the workers of gunicorn --preload.
+
+        The feeder thread of the log queue and the queue listener thread of the parent are not copied by
+        the fork, so the child gets a log queue and a queue listener of its own, as a process which creates
+        its own MacroFlaskLogger does, and the queue handlers of its loggers send to the new queue.
+        It is called automatically after os.fork(), call it from the post-fork hook of a server which
+        forks outside of Python, e.g. @postfork of uWSGI.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+
+        if self.mode == 'multiprocessing':
+            self.log_queue = Queue(-1)
+            for queue_handler in self._queue_handlers:
+                queue_handler.queue = self.log_queue
+            if self._listener_pid is not None:
+                self._setup_logging()
+
     def shutdown(self):
-        self.queue_listener.stop()
+        # only the process which started the listener stops it, a child would stop the listener of its parent
+        if self._listener_pid == os.getpid():
+            self.queue_listener.stop()
@@ -1,15 +1,78 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import sqlalchemy as raw_sa
 import sqlalchemy.event as raw_sa_event
 import sqlalchemy.exc as raw_sa_exc
 import sqlalchemy.orm as raw_sa_orm
 
-from flask import Flask, g
+from flask import Flask, g, has_app_context
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from contextlib import contextmanager
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from contextlib import ExitStack, contextmanager
+
+from macroflask.util.bulk_write import BulkWriteStats, build_insert_statement, build_upsert_statement, iter_chunks
+from macroflask.util.connection_budget import ConnectionBudget
+from macroflask.util.engine_profile import get_engine_profile
+from macroflask.util.fork_util import register_after_fork
+from macroflask.util.pool_metrics import PoolMetrics
+from macroflask.util.replica_pool import ReplicaPool
+from macroflask.util.session_scope import SCOPE_THREAD, get_scopefunc, is_cooperative_driver
+from macroflask.util.shard_set import ShardSet
+from macroflask.util.slow_query_log import SlowQueryLog
+from macroflask.util.statement_stats import StatementStats, StatementTracker
+from macroflask.util.tenant_engines import TenantEngines
+
+
+class RoutingSession(Session):
+    def __init__(self, router=None, db_operation_type="write", **kwargs):
+        """
+        Session which lets the router pick the engine of each mapped class.
+
+        :param router: The LightSqlAlchemy object which routes the mapped classes to engines.
+        :param db_operation_type: The type of database operation of the session.
+        """
+        super().__init__(**kwargs)
+        self.router = router
+        self.db_operation_type = db_operation_type
+        if router is not None and router.shard_sets:
+            # the unit of work asks for the connection of each object, so each object is saved on its own shard
+            self.connection_callable = self._connection_for_object
+
+    def get_bind(self, mapper=None, shard_id=None, instance=None, **kwargs):
+        if self.router is not None and mapper is not None:
+            engine = self.router.route_bind(self, mapper, shard_id=shard_id, instance=instance)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, **kwargs)
+
+    def _connection_for_object(self, mapper=None, instance=None, **kwargs):
+        shard_id = None
+        if instance is not None and self.router.get_shard_set(mapper) is not None:
+            state = raw_sa.inspect(instance)
+            # the identity token of an object loaded from a shard is its shard id
+            shard_id = state.key[2] if state.key is not None else state.identity_token
+            if shard_id is None:
+                shard_id = self.router.get_shard_set(mapper).shard_id_for_instance(instance)
+                state.identity_token = shard_id
+        return self.connection(bind_arguments={"mapper": mapper, "shard_id": shard_id, "instance": instance})
 
 
 class LightSqlAlchemy:
+    # connect to every bind at startup and fail if one of them is unreachable
+    CONNECT_EAGER = "eager"
+    # connect to every bind in a background thread, check is_ready or wait_until_ready()
+    CONNECT_BACKGROUND = "background"
+    # connect on the first checkout of each engine
+    CONNECT_LAZY = "lazy"
+    CONNECT_MODES = (CONNECT_EAGER, CONNECT_BACKGROUND, CONNECT_LAZY)
+
+    # the functions called with the tables committed by bulk_insert() and bulk_upsert(), see add_bulk_write_listener
+    _bulk_write_listeners = []
+
     def __init__(self, is_flask=False, db_config: dict = None, open_logging=False, logger=None, **kwargs):
         """
         Initialize the LightSqlAlchemy object.
@@ -17,6 +80,9 @@ class LightSqlAlchemy:
         :param is_flask: Whether the environment is a Flask application. Defaults to False.
         :param db_config: Database configuration dictionary. Defaults to None.
         :param open_logging: Whether to enable logging for SQLAlchemy. Defaults to False.
+        :param kwargs: Additional keyword arguments, e.g. engine_options, session_options, consistency_options,
+            read_session_options, statement_options, slow_query_options, connect_mode ('eager', 'background' or 'lazy')
+            and session_scope ('thread', 'greenlet', 'context' or a scope function, see session_scope.py).
         """
         self.is_flask = is_flask
 
@@ -34,6 +100,56 @@ class LightSqlAlchemy:
         self.bind_model_engines = {"read": {}, "write": {}}
         self.bind_key_models = {}
 
+        # read replica pools, a read bind configured with a list of urls is balanced across its replicas
+        self.replica_pools = {}
+        self._replica_pool_by_base = {}
+
+        # sharded binds, a write bind configured with a list of shard urls partitions its models by __shard_key__
+        self.shard_sets = {}
+        self._shard_set_by_base = {}
+
+        # binds with one database per tenant, their engines are created on first use, see use_tenant
+        self.tenant_engines = {}
+        self._tenant_engines_by_base = {}
+        self._tenant_id = contextvars.ContextVar("tenant_id", default=None)
+
+        # connection pool metrics of each engine, keyed by '<db_operation_type>:<bind_key>'
+        self.pool_metrics = {}
+
+        # connection budgets shared by all the processes of the host, keyed by their name, see _set_connection_budget
+        self.connection_budgets = {}
+
+        # the EngineProfile of each engine, see engine_profile.py
+        self.engine_profiles = {}
+
+        # statements executed by each request, see set_statement_options
+        self.statement_options = {"statement_budget": 100, "repeat_threshold": 10}
+        self.statement_tracker = StatementTracker(self)
+        self._statement_stats = contextvars.ContextVar("statement_stats", default=None)
+
+        # statements slower than a threshold, see set_slow_query_options
+        self.slow_query_log = None
+        self.statement_tracker.add_listener(self._on_statement)
+
+        # read-your-writes consistency, see set_consistency_options
+        self.consistency_options = {"read_your_writes": False, "sticky_window": 5, "key_func": None}
+        self._last_write_by_key = {}
+        self._local = threading.local()
+
+        # the scope of the sessions, one session per thread by default, see session_scope.py
+        self.session_scope = SCOPE_THREAD
+        self._scopefunc = None
+
+        # engines to connect at startup, see _warm_up_engines
+        self.connect_mode = self.CONNECT_EAGER
+        self._warm_up_targets = []
+        self._ready = threading.Event()
+        self.warm_up_errors = {}
+
+        # the pools inherited by a forked child process are replaced, see after_fork
+        self._pid = os.getpid()
+        register_after_fork(self, "after_fork")
+
         if is_flask:
             pass
 
@@ -52,6 +168,7 @@ class LightSqlAlchemy:
             raise ValueError("Flask environment is not enabled.")
 
         self.validate_db_config(db_config)
+        self._set_init_options(kwargs)
 
         # Initialize the database engine for each bind key
         for bind_key, db_obj in db_config.items():
@@ -62,6 +179,7 @@ class LightSqlAlchemy:
 
         # Binds engines to the Session
         self._make_session(**kwargs)
+        self._warm_up_engines()
 
         # Register teardown function to ensure session is cleaned up at the end of each request.
         app.teardown_appcontext(self._teardown_session)
@@ -72,12 +190,14 @@ class LightSqlAlchemy:
 
         :param exc: Any exception that might have occurred during request processing. Defaults to None.
         """
-        db_operation_type = getattr(g, "session_db_operation_type", None)
-        if db_operation_type:
-            self.close_session(db_operation_type)
+        db_operation_types = getattr(g, "session_db_operation_types", None)
+        if db_operation_types:
+            # A request may use both the read and the write session, close all of them
+            for db_operation_type in db_operation_types:
+                self.close_session(db_operation_type)
 
-            # Remove the session_db_operation_type key from the Flask global context
-            delattr(g, "session_db_operation_type")
+            # Remove the session_db_operation_types key from the Flask global context
+            delattr(g, "session_db_operation_types")
 
     def _register_model(self, bind_key, model_class):
         """
@@ -95,6 +215,8 @@ class LightSqlAlchemy:
         :param url: Database connection URI.
         :param kwargs: Additional keyword arguments for creating the engine.
         """
+        self._set_init_options(kwargs)
+
         for bind_key, db_obj in db_config.items():
             if bind_key not in self.bind_key_models:
                 raise ValueError(f"No model class registered for bind: {bind_key}")
@@ -103,47 +225,252 @@ class LightSqlAlchemy:
 
         # Binds engines to the Session
         self._make_session(**kwargs)
+        self._warm_up_engines()
 
-    def _create_engine(self, url, base_class, bind_key, **kwargs):
-        url = raw_sa.engine.make_url(url)
-        if not url.drivername.startswith("mysql"):
-            raise ValueError(
-                "MySQL database is required for non-Flask environments,"
-                " other databases are not supported.")
-
-        # init engine configuration
-        engine_options = {
-            # increase the number of connections in the pool
-            "pool_size": 50,
-            # increase the number of connections that can be created when the pool is empty
-            "max_overflow": 100,
-            # number of seconds to wait before giving up on getting a connection from the pool
-            "pool_timeout": 30,
-            # reset the timeout of idle connections in the connection pool (seconds)
-            "pool_recycle": 4 * 60 * 60,
-            # isolation level for the engine
-            "isolation_level": "READ COMMITTED",
-            # enable the echo mode for debugging
-            "echo": False,
-            # enable the echo mode for the connection pool, input 'debug' if you want to debug
-            "echo_pool": False,
-            # enable the pool pre-ping to test connections before using them
-            # "pool_pre_ping": False,
-        }
-        if "engine_options" in kwargs:
-            engine_options.update(kwargs.pop("engine_options"))
-        engine = create_engine(url, **engine_options)
-        with engine.connect():
-            if self.logger:
-                self.logger.info("Connected to database: " + str(url))
+    def _set_init_options(self, kwargs):
+        """
+        Pop the LightSqlAlchemy options out of the init keyword arguments,
+        the remaining arguments are used to create the engines and sessions.
+
+        :param kwargs: The init keyword arguments.
+        """
+        if "consistency_options" in kwargs:
+            self.set_consistency_options(**kwargs.pop("consistency_options"))
+
+        if "statement_options" in kwargs:
+            self.set_statement_options(**kwargs.pop("statement_options"))
+
+        if "slow_query_options" in kwargs:
+            self.set_slow_query_options(**kwargs.pop("slow_query_options"))
+
+        if "session_scope" in kwargs:
+            self.session_scope = kwargs.pop("session_scope")
+            self._scopefunc = get_scopefunc(self.session_scope)
+
+        connect_mode = kwargs.pop("connect_mode", self.CONNECT_EAGER)
+        if connect_mode not in self.CONNECT_MODES:
+            raise ValueError(f"connect_mode must be one of {self.CONNECT_MODES}")
+        self.connect_mode = connect_mode
+
+    def _create_engine(self, base_class, bind_key, url=None, **kwargs):
+        # The engine options override the defaults of the dialect profile, see engine_profile.py
+        engine_options = kwargs.pop("engine_options", {})
+        dialect_options = kwargs.get("dialect_options")
 
         # Determine whether to read and write separately，
         db_operation_type = kwargs.get("db_operation_type", "write")
+
+        tenant_url = kwargs.get("tenant_url")
+        if tenant_url:
+            # The engines of the tenant databases are created on first use
+            tenant_engines = TenantEngines(
+                bind_key, tenant_url, create_engine=lambda tenant_id, tenant_url: self._create_tenant_engine(
+                    bind_key, tenant_id, tenant_url, engine_options, dialect_options, kwargs.get("connection_budget")),
+                dispose_engine=lambda tenant_id, tenant_engine: self._forget_engine(
+                    f"{db_operation_type}:{bind_key}[{tenant_id}]", tenant_engine),
+                logger=self.logger, **kwargs.get("tenant_options", {}))
+            self.tenant_engines[bind_key] = tenant_engines
+            self._tenant_engines_by_base[base_class] = tenant_engines
+            return
+
+        shards = kwargs.get("shards")
+        new_engines = []
+        if shards:
+            # The rows of the models are partitioned across the shard databases
+            shard_set = ShardSet(
+                bind_key, [self._build_engine(shard_url, engine_options, dialect_options) for shard_url in shards])
+            engine = shard_set.engines[0]
+            self.shard_sets[bind_key] = shard_set
+            self._shard_set_by_base[base_class] = shard_set
+            self._warm_up_targets.extend((shard_engine, None) for shard_engine in shard_set.engines)
+            for index, shard_engine in enumerate(shard_set.engines):
+                self._instrument_engine(f"{db_operation_type}:{bind_key}[{index}]", shard_engine)
+            new_engines.extend(shard_set.engines)
+        elif isinstance(url, (list, tuple)):
+            # A list of urls means a pool of read replicas
+            replica_pool = self._create_replica_pool(
+                url, bind_key, engine_options, dialect_options, kwargs.get("replica_options"))
+            engine = replica_pool.engines[0]
+            self._replica_pool_by_base[base_class] = replica_pool
+            self._warm_up_targets.extend((replica_engine, replica_pool) for replica_engine in replica_pool.engines)
+            for index, replica_engine in enumerate(replica_pool.engines):
+                self._instrument_engine(f"{db_operation_type}:{bind_key}[{index}]", replica_engine)
+            new_engines.extend(replica_pool.engines)
+        else:
+            engine = self._build_engine(url, engine_options, dialect_options)
+            self._warm_up_targets.append((engine, None))
+            self._instrument_engine(f"{db_operation_type}:{bind_key}", engine)
+            new_engines.append(engine)
+
+        budget_options = kwargs.get("connection_budget")
+        if budget_options:
+            for new_engine in new_engines:
+                self._set_connection_budget(new_engine, budget_options)
+
         # Configure the engine for the specified bind key
         self.engines[db_operation_type][bind_key] = engine
         # Configure the session binds
         self.bind_model_engines[db_operation_type][base_class] = engine
 
+    def _build_engine(self, url, engine_options, dialect_options=None):
+        """
+        Build the engine of a database url without connecting to it.
+
+        :param url: Database connection URI.
+        :param engine_options: The keyword arguments for creating the engine.
+        :param dialect_options: The dialect specific options, e.g. SQLite pragmas or PostgreSQL pgbouncer mode.
+        :return: The engine instance.
+        """
+        profile = get_engine_profile(url, dialect_options)
+        options = profile.get_engine_options()
+        options.update(engine_options)
+        engine = create_engine(profile.url, **options)
+        profile.configure_engine(engine)
+        self.engine_profiles[engine] = profile
+        return engine
+
+    def _create_tenant_engine(self, bind_key, tenant_id, url, engine_options, dialect_options=None,
+                              budget_options=None):
+        """
+        Build and instrument the engine of a tenant database, it is called by TenantEngines on first use.
+
+        :return: The engine instance.
+        """
+        engine = self._build_engine(url, engine_options, dialect_options)
+        self._instrument_engine(f"write:{bind_key}[{tenant_id}]", engine)
+        if budget_options:
+            self._set_connection_budget(engine, budget_options)
+        return engine
+
+    def _forget_engine(self, name, engine):
+        """ Drop the metrics and profile of a disposed tenant engine. """
+        self.pool_metrics.pop(name, None)
+        self.engine_profiles.pop(engine, None)
+
+    def _create_replica_pool(self, urls, bind_key, engine_options, dialect_options=None, replica_options=None):
+        """
+        Create the engines of the read replicas and balance them with a ReplicaPool.
+
+        :param urls: The list of replica urls.
+        :param bind_key: The bind key for the database.
+        :param engine_options: The keyword arguments for creating the engines.
+        :param dialect_options: The dialect specific options of the engines.
+        :param replica_options: The keyword arguments for the ReplicaPool, e.g. policy, weights, retry_interval.
+        :return: The ReplicaPool instance.
+        """
+        engines = [self._build_engine(url, engine_options, dialect_options) for url in urls]
+        replica_pool = ReplicaPool(bind_key, engines, logger=self.logger, **(replica_options or {}))
+        self.replica_pools[bind_key] = replica_pool
+        return replica_pool
+
+    def _instrument_engine(self, name, engine):
+        """
+        Collect the pool metrics and time the statements of an engine.
+
+        :param name: The name of the engine, e.g. 'write:database1'.
+        :param engine: The engine instance.
+        """
+        self.pool_metrics[name] = PoolMetrics(name, engine)
+        self.statement_tracker.register_engine(name, engine)
+
+    def _set_connection_budget(self, engine, budget_options):
+        """
+        Limit the connections all the processes of the host open to the database of an engine.
+        The engines of the same budget name share it, by default the name is made of the database url.
+
+        :param engine: The engine instance.
+        :param budget_options: The keyword arguments for the ConnectionBudget, e.g. max_connections, timeout.
+        """
+        budget_options = dict(budget_options)
+        name = budget_options.pop("name", None) or ConnectionBudget.get_default_name(engine.url)
+        budget = self.connection_budgets.get(name)
+        if budget is None:
+            budget = ConnectionBudget(name, logger=self.logger, **budget_options)
+            self.connection_budgets[name] = budget
+        # registered last, it opens the DBAPI connection after the other do_connect events of the engine
+        budget.register_engine(engine)
+
+    def get_pool_metrics(self):
+        """
+        Return the live connection pool metrics of all engines and the state of the replica pools.
+
+        :return: The metrics dictionary.
+        """
+        return {
+            "engines": [metrics.snapshot() for metrics in self.pool_metrics.values()],
+            "replica_pools": [replica_pool.stats() for replica_pool in self.replica_pools.values()],
+            "shard_sets": [shard_set.stats() for shard_set in self.shard_sets.values()],
+            "connection_budgets": [budget.stats() for budget in self.connection_budgets.values()],
+            "tenant_engines": [tenant_engines.stats() for tenant_engines in self.tenant_engines.values()],
+        }
+
+    def _connect_engine(self, engine, replica_pool=None):
+        """
+        Open the first connection of an engine.
+
+        Replicas which can not be connected are kept out of rotation until they recover,
+        other engines raise the connection error.
+
+        :param engine: The engine to connect.
+        :param replica_pool: The ReplicaPool the engine belongs to, None if it is not a replica.
+        """
+        if replica_pool is not None:
+            if replica_pool.ping(engine) and self.logger:
+                self.logger.info("Connected to database: " + str(engine.url))
+            return
+
+        with engine.connect():
+            if self.logger:
+                self.logger.info("Connected to database: " + str(engine.url))
+
+    def _warm_up_engines(self):
+        """
+        Connect to all the engines concurrently according to the connect mode.
+
+        In eager mode the first connection error is raised, in background mode the errors
+        are recorded in warm_up_errors, and in lazy mode nothing is connected.
+        """
+        targets, self._warm_up_targets = self._warm_up_targets, []
+        if self.connect_mode == self.CONNECT_LAZY or not targets:
+            self._ready.set()
+            return
+
+        if self.connect_mode == self.CONNECT_EAGER:
+            with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                futures = [executor.submit(self._connect_engine, *target) for target in targets]
+                for future in futures:
+                    future.result()
+            self._ready.set()
+            return
+
+        threading.Thread(target=self._warm_up_in_background, args=(targets,), daemon=True).start()
+
+    def _warm_up_in_background(self, targets):
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = {executor.submit(self._connect_engine, *target): target[0] for target in targets}
+            for future, engine in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.warm_up_errors[engine.url.render_as_string(hide_password=True)] = str(e)
+                    if self.logger:
+                        self.logger.error(f"Failed to connect to database {engine.url}: {e}")
+        self._ready.set()
+
+    @property
+    def is_ready(self):
+        """ Whether the startup connections of all engines have been attempted. """
+        return self._ready.is_set()
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Block until the startup connections of all engines have been attempted.
+
+        :param timeout: Number of seconds to wait, None means waiting forever.
+        :return: True if ready, False if the timeout expired.
+        """
+        return self._ready.wait(timeout)
+
     def _make_session(self, **kwargs):
         """
         Create a new session instance for the specified bind key.
@@ -160,24 +487,535 @@ class LightSqlAlchemy:
         if "session_options" in kwargs:
             session_options.update(kwargs.pop("session_options"))
 
+        if self.session_scope != SCOPE_THREAD:
+            self._check_cooperative_drivers()
+
         if self.bind_model_engines["read"]:
             if self.open_logging and self.logger:
                 self.logger.info("Create read session.")
-            read_session_local = sessionmaker(**session_options)
-            # get the same session for the one same thread
-            read_session = scoped_session(read_session_local)
+            read_session_local = sessionmaker(
+                class_=RoutingSession, router=self, db_operation_type="read",
+                **self._get_read_session_options(session_options, kwargs))
+            # get the same session for the one same thread, or greenlet with the 'greenlet' session_scope
+            read_session = scoped_session(read_session_local, scopefunc=self._scopefunc)
             # Configure the session binds, one session for multiple databases
             read_session.configure(binds=self.bind_model_engines["read"])
             self.sessions["read"] = read_session
 
-        if self.bind_model_engines["write"]:
-            write_session_local = sessionmaker(**session_options)
+            # the transactions of the read sessions are read-only
+            raw_sa_event.listen(read_session_local, "after_begin", self._on_read_begin)
+            if self.shard_sets:
+                raw_sa_event.listen(read_session_local, "do_orm_execute", self._on_shard_execute)
+
+        if self.bind_model_engines["write"] or self.tenant_engines:
+            write_session_local = sessionmaker(
+                class_=RoutingSession, router=self, db_operation_type="write", **session_options)
             if self.open_logging and self.logger:
                 self.logger.info("Create write session.")
-            write_session = scoped_session(write_session_local)
+            write_session = scoped_session(write_session_local, scopefunc=self._scopefunc)
             write_session.configure(binds=self.bind_model_engines["write"])
             self.sessions["write"] = write_session
 
+            # track the committed writes for the read-your-writes consistency
+            raw_sa_event.listen(write_session_local, "after_flush", self._on_write_flush)
+            raw_sa_event.listen(write_session_local, "do_orm_execute", self._on_write_execute)
+            raw_sa_event.listen(write_session_local, "after_commit", self._on_write_commit)
+            raw_sa_event.listen(write_session_local, "after_rollback", self._on_write_rollback)
+
+            # run the statements of the sharded models on their shards
+            if self.shard_sets:
+                raw_sa_event.listen(write_session_local, "do_orm_execute", self._on_shard_execute)
+
+    def _check_cooperative_drivers(self):
+        """
+        Warn about the engines whose driver blocks all the greenlets of the worker during a statement.
+        """
+        for engine in self._iter_engines():
+            if not is_cooperative_driver(engine.dialect) and self.logger:
+                self.logger.warning(f"The driver {engine.dialect.driver} of {engine.url} is not cooperative, "
+                                    f"it blocks the other greenlets during a statement with session_scope "
+                                    f"'{self.session_scope}'.")
+
+    @staticmethod
+    def _get_read_session_options(session_options, kwargs):
+        """
+        Return the options of the read sessions, they never flush and are rolled back at the end,
+        so the flush and expiration bookkeeping is skipped.
+
+        :param session_options: The options of the write sessions.
+        :param kwargs: The init keyword arguments, read_session_options overrides the defaults.
+        :return: The read session options.
+        """
+        read_session_options = dict(session_options, autoflush=False, expire_on_commit=False)
+        read_session_options.update(kwargs.pop("read_session_options", {}))
+        return read_session_options
+
+    def _on_read_begin(self, session, transaction, connection):
+        profile = self.engine_profiles.get(connection.engine)
+        if profile is not None:
+            profile.begin_read_only(connection)
+
+    def set_consistency_options(self, read_your_writes=False, sticky_window=5, key_func=None):
+        """
+        Configure the read-your-writes consistency of the read sessions.
+
+        Once a write session commits changes, the reads of the same request or thread, and the reads
+        with the same consistency key within `sticky_window` seconds, are pinned to the primary.
+
+        Note: the consistency keys are recorded per process, the reads of the same user served by
+        another worker process are only protected by the replica lag check.
+
+        :param read_your_writes: Whether to pin the reads to the primary after a write.
+        :param sticky_window: Number of seconds the reads stay on the primary after a write.
+        :param key_func: A callable returning the consistency key of the caller, e.g. the user id.
+        """
+        self.consistency_options = {
+            "read_your_writes": read_your_writes,
+            "sticky_window": sticky_window,
+            "key_func": key_func,
+        }
+
+    def _get_consistency_key(self):
+        key_func = self.consistency_options["key_func"]
+        if key_func is None:
+            return None
+        try:
+            return key_func()
+        except Exception:
+            return None
+
+    def _on_write_flush(self, session, flush_context):
+        session.info["has_db_writes"] = True
+
+    def _on_write_execute(self, orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            orm_execute_state.session.info["has_db_writes"] = True
+
+    def _on_write_commit(self, session):
+        if session.info.pop("has_db_writes", False):
+            self.mark_write()
+
+    def _on_write_rollback(self, session):
+        session.info.pop("has_db_writes", None)
+
+    @classmethod
+    def add_bulk_write_listener(cls, listener):
+        """
+        Call a function after each chunk committed by bulk_insert() or bulk_upsert() of any LightSqlAlchemy
+        object, the bulk writes bypass the session events.
+
+        :param listener: The callable receiving the list of the written table names.
+        """
+        cls._bulk_write_listeners.append(listener)
+
+    def _on_bulk_write(self, table):
+        self.mark_write()
+        for listener in self._bulk_write_listeners:
+            listener([table.name])
+
+    def mark_write(self):
+        """
+        Record that the caller has committed a write, the following reads will be pinned to the primary.
+
+        :return: None
+        """
+        if not self.consistency_options["read_your_writes"]:
+            return
+
+        now = time.time()
+        if self.is_flask and has_app_context():
+            g.db_write_time = now
+        else:
+            self._local.last_write_time = now
+
+        key = self._get_consistency_key()
+        if key is not None:
+            self._last_write_by_key[key] = now
+            if len(self._last_write_by_key) > 10000:
+                self._prune_write_keys(now)
+
+    def _prune_write_keys(self, now):
+        """ Remove the consistency keys whose sticky window has expired. """
+        sticky_window = self.consistency_options["sticky_window"]
+        for key, write_time in list(self._last_write_by_key.items()):
+            if now - write_time >= sticky_window:
+                self._last_write_by_key.pop(key, None)
+
+    def _is_read_sticky(self):
+        """
+        Check whether the reads of the caller should be pinned to the primary.
+
+        :return: True if the caller has written recently, False otherwise.
+        """
+        if not self.consistency_options["read_your_writes"]:
+            return False
+
+        now = time.time()
+        sticky_window = self.consistency_options["sticky_window"]
+        if self.is_flask and has_app_context():
+            # the reads after a write in the same request always go to the primary
+            if g.get("db_write_time"):
+                return True
+        else:
+            last_write_time = getattr(self._local, "last_write_time", None)
+            if last_write_time and now - last_write_time < sticky_window:
+                return True
+
+        key = self._get_consistency_key()
+        if key is None:
+            return False
+        last_write_time = self._last_write_by_key.get(key)
+        return bool(last_write_time and now - last_write_time < sticky_window)
+
+    def read_from_primary(self):
+        """
+        Send the automatically routed reads of the current request to the primary, see get_read_operation_type.
+        It is called for the routes decorated with flask_ext.read_from_primary.
+
+        :return: None
+        """
+        if self.is_flask and has_app_context():
+            g.db_read_from_primary = True
+
+    def get_read_operation_type(self, model=None, read_from_primary=False):
+        """
+        Pick the session of a read: the read session when a read bind can serve the model, otherwise the write one.
+
+        :param model: The mapped class to read, None if the read session serves all the models.
+        :param read_from_primary: Whether the caller needs the primary, e.g. to read what it has just written
+            outside of read-your-writes consistency.
+        :return: 'read' or 'write', the db_operation_type for get_db_session.
+        """
+        if read_from_primary or not self.sessions["read"]:
+            return "write"
+        if self.is_flask and has_app_context() and g.get("db_read_from_primary"):
+            return "write"
+        if model is not None and self.get_shard_set(model) is None \
+                and self._find_base_class(model, self.bind_model_engines["read"]) is None:
+            return "write"
+        return "read"
+
+    def has_caught_up(self, engine, since):
+        """
+        Whether the reads served by an engine see the writes this process committed at a point in time.
+
+        The primaries always do, a replica of a pool once its last lag measurement shows it had replayed them,
+        and a read bind without lag checks never does.
+
+        :param engine: The engine which served the reads.
+        :param since: The time.time() of the writes, 0 or None if there were none.
+        :return: True if the reads are not older than the writes.
+        """
+        if not since:
+            return True
+        for replica_pool in self.replica_pools.values():
+            if engine in replica_pool.engines:
+                return replica_pool.has_caught_up(engine, since)
+        return engine not in self.engines["read"].values()
+
+    def set_statement_options(self, statement_budget=100, repeat_threshold=10):
+        """
+        Configure the warnings about the statements executed by one request.
+
+        :param statement_budget: The number of statements a request may execute before a warning is logged,
+            None disables the warning.
+        :param repeat_threshold: The number of executions of the same statement reported as a possible N+1 query,
+            e.g. a lazy loaded relationship accessed in a loop. None disables the warning.
+        """
+        self.statement_options = {
+            "statement_budget": statement_budget,
+            "repeat_threshold": repeat_threshold,
+        }
+
+    def get_statement_stats(self):
+        """
+        Return the StatementStats of the current request.
+
+        In Flask they are created on the first statement of the request, otherwise
+        only the statements executed inside track_statements() are recorded.
+
+        :return: The StatementStats instance, or None if the statements are not tracked.
+        """
+        if self.is_flask and has_app_context():
+            if "db_statement_stats" not in g:
+                g.db_statement_stats = StatementStats(g.get("req_uuid"))
+            return g.db_statement_stats
+        return self._statement_stats.get()
+
+    def finish_statement_stats(self):
+        """
+        Report the statements of the current Flask request, called at the end of the request.
+
+        :return: The StatementStats instance, or None if the request has not executed any statement.
+        """
+        stats = g.pop("db_statement_stats", None)
+        if stats is not None:
+            self.report_statement_stats(stats)
+        return stats
+
+    @contextmanager
+    def track_statements(self, request_uuid=None):
+        """
+        Record the statements executed inside the context, for the non-Flask environments.
+
+        :param request_uuid: The identifier of the unit of work shown in the warnings.
+
+        :yield: The StatementStats instance.
+        """
+        stats = StatementStats(request_uuid)
+        token = self._statement_stats.set(stats)
+        try:
+            yield stats
+        finally:
+            self._statement_stats.reset(token)
+            self.report_statement_stats(stats)
+
+    def report_statement_stats(self, stats):
+        """
+        Log a warning when the request has exceeded the statement budget or repeated the same statement.
+
+        :param stats: The StatementStats of the request.
+        """
+        if not self.logger:
+            return
+
+        statement_budget = self.statement_options["statement_budget"]
+        if statement_budget is not None and stats.count > statement_budget:
+            self.logger.warning(
+                f"=== {stats.request_uuid} executed {stats.count} statements in {stats.db_time:.4f} seconds, "
+                f"the statement budget is {statement_budget}.")
+
+        repeat_threshold = self.statement_options["repeat_threshold"]
+        if repeat_threshold is not None:
+            for statement, count in stats.repeated_statements(repeat_threshold):
+                self.logger.warning(
+                    f"=== {stats.request_uuid} possible N+1 query, the same statement was executed {count} times: "
+                    f"{' '.join(statement.split())[:200]}")
+
+    def set_slow_query_options(self, threshold_ms=200, max_entries=500, max_fingerprints=1000):
+        """
+        Record the statements slower than threshold_ms, and aggregate the durations of all statements
+        by fingerprint, the statement with its literals and parameters stripped.
+
+        :param threshold_ms: The duration in milliseconds above which a statement is logged and recorded,
+            None disables the slow query log.
+        :param max_entries: The number of the most recent slow statements kept.
+        :param max_fingerprints: The maximum number of aggregated fingerprints.
+        """
+        if threshold_ms is None:
+            self.slow_query_log = None
+        else:
+            self.slow_query_log = SlowQueryLog(threshold_ms, max_entries, max_fingerprints)
+
+    def _on_statement(self, engine_name, statement, duration, rowcount, stats):
+        slow_query_log = self.slow_query_log
+        if slow_query_log is None:
+            return
+
+        request_uuid = stats.request_uuid if stats is not None else None
+        entry = slow_query_log.record(engine_name, statement, duration, rowcount, request_uuid)
+        if entry is not None and self.logger:
+            self.logger.warning(
+                f"=== {request_uuid} slow query took {entry['duration_ms']} ms on {engine_name}, "
+                f"{rowcount} rows: {entry['fingerprint'][:500]}")
+
+    def get_slow_queries(self, order_by="total_ms", limit=50):
+        """
+        Return the recent slow statements and the aggregates of the fingerprints.
+
+        :param order_by: The aggregate field to sort the fingerprints by, e.g. 'total_ms', 'count' or 'p99_ms'.
+        :param limit: The maximum number of slow statements and fingerprints.
+        :return: The dictionary of the slow query log, empty if it is disabled.
+        """
+        slow_query_log = self.slow_query_log
+        if slow_query_log is None:
+            return {}
+        return {
+            "threshold_ms": slow_query_log.threshold_ms,
+            "entries": slow_query_log.get_entries(limit),
+            "fingerprints": slow_query_log.get_aggregates(order_by, limit),
+        }
+
+    def route_bind(self, session, mapper, shard_id=None, instance=None):
+        """
+        Pick the engine of a mapped class for the session.
+
+        A sharded model goes to the shard of shard_id or of the instance, a tenant model to the database
+        of the current tenant.
+        A read session keeps the replica it picked for each bind until the session is removed,
+        so all the queries of one session see the same replica.
+        The reads of a caller who has written recently are pinned to the primary.
+
+        :param session: The RoutingSession instance.
+        :param mapper: The mapper or mapped class to route.
+        :param shard_id: The shard chosen for a sharded model.
+        :param instance: The ORM object being saved.
+        :return: The engine, or None to use the session binds.
+
+        :exception: ValueError if no shard can be chosen for a sharded model, or no tenant is set for a tenant model.
+        """
+        shard_set = self.get_shard_set(mapper)
+        if shard_set is not None:
+            if shard_id is None and instance is not None:
+                shard_id = shard_set.shard_id_for_instance(instance)
+            if shard_id is None:
+                raise ValueError(f"No shard is chosen for the sharded model: {getattr(mapper, 'class_', mapper)}")
+            return shard_set.engines[shard_id]
+
+        tenant_engines = self.get_tenant_engines(mapper)
+        if tenant_engines is not None:
+            return tenant_engines.get_engine(self.require_tenant())
+
+        if session.db_operation_type != "read":
+            return None
+
+        if self._is_read_sticky():
+            base_class = self._find_base_class(mapper, self.bind_model_engines["write"])
+            if base_class is not None:
+                return self.bind_model_engines["write"][base_class]
+
+        if not self._replica_pool_by_base:
+            return None
+
+        base_class = self._find_base_class(mapper, self._replica_pool_by_base)
+        if base_class is None:
+            return None
+
+        picked_engines = session.info.setdefault("replica_engines", {})
+        if base_class not in picked_engines:
+            engine = self._replica_pool_by_base[base_class].pick()
+            # fall back to the primary when all replicas are out of rotation
+            picked_engines[base_class] = engine or self.bind_model_engines["write"].get(base_class)
+        return picked_engines[base_class]
+
+    def get_tenant_engines(self, mapper):
+        """
+        :param mapper: The mapper or mapped class.
+        :return: The TenantEngines of a tenant model, None for the other models.
+        """
+        if not self._tenant_engines_by_base or mapper is None:
+            return None
+        base_class = self._find_base_class(mapper, self._tenant_engines_by_base)
+        return self._tenant_engines_by_base[base_class] if base_class is not None else None
+
+    def set_tenant(self, tenant_id):
+        """
+        Set the tenant of the current request, or of the current context outside of Flask.
+        The tenant models are read and written in the database of the tenant.
+
+        :param tenant_id: The id of the tenant, None to unset it.
+        """
+        if self.is_flask and has_app_context():
+            g.db_tenant_id = tenant_id
+        else:
+            self._tenant_id.set(tenant_id)
+
+    def get_tenant(self):
+        """ :return: The id of the current tenant, None if no tenant is set. """
+        if self.is_flask and has_app_context():
+            return g.get("db_tenant_id")
+        return self._tenant_id.get()
+
+    def require_tenant(self):
+        """
+        :return: The id of the current tenant.
+
+        :exception: ValueError if no tenant is set.
+        """
+        tenant_id = self.get_tenant()
+        if tenant_id is None:
+            raise ValueError("No tenant is set for the tenant models, call set_tenant() or use_tenant() first")
+        return tenant_id
+
+    @contextmanager
+    def use_tenant(self, tenant_id):
+        """
+        Use the database of a tenant within the block, e.g. `with db.use_tenant(42), db.get_db_session() as session:`.
+
+        :param tenant_id: The id of the tenant.
+        """
+        previous_tenant_id = self.get_tenant()
+        self.set_tenant(tenant_id)
+        try:
+            yield
+        finally:
+            self.set_tenant(previous_tenant_id)
+
+    def get_shard_set(self, mapper):
+        """
+        :param mapper: The mapper or mapped class.
+        :return: The ShardSet of a sharded model, None for the other models.
+        """
+        if not self._shard_set_by_base or mapper is None:
+            return None
+        base_class = self._find_base_class(mapper, self._shard_set_by_base)
+        return self._shard_set_by_base[base_class] if base_class is not None else None
+
+    def _on_shard_execute(self, orm_context):
+        """
+        Run the ORM statements of a sharded model on the shards their shard key conditions match,
+        and merge the results. A statement without shard key condition runs on all the shards one by one,
+        use ShardSet.fan_out() to query them in parallel.
+
+        :exception: ValueError if a statement picks rows by primary key without the shard key, e.g. Session.get()
+            of a sharded model: filter on the primary key and the shard key instead.
+        """
+        if orm_context.bind_arguments.get("shard_id") is not None:
+            return None
+
+        mapper = orm_context.bind_mapper
+        shard_set = self.get_shard_set(mapper)
+        if shard_set is None:
+            return None
+
+        if orm_context.is_select:
+            load_options = orm_context.load_options
+            identity_token = load_options._identity_token
+            state = load_options._refresh_state or load_options._lazy_loaded_from
+            if identity_token is None and state is not None and state.key is not None:
+                # SQLAlchemy drops the falsy identity token of the shard 0, the object still has it
+                identity_token = state.key[2]
+        elif orm_context.is_update or orm_context.is_delete:
+            identity_token = orm_context.update_delete_options._identity_token
+        else:
+            # the inserts are routed by the shard key of each object
+            return None
+
+        if identity_token is not None:
+            # e.g. the lazy loads and refreshes of an object loaded from a shard
+            shard_ids = [identity_token]
+        else:
+            whereclause = orm_context.statement.whereclause
+            shard_ids = shard_set.shard_ids_for_criteria(mapper.class_, whereclause, orm_context.parameters)
+            if len(shard_ids) > 1 and shard_set.is_primary_key_lookup(mapper.class_, whereclause):
+                # each shard may have a row with the primary key
+                raise ValueError(f"The primary key lookups of the sharded model {mapper.class_.__name__} require "
+                                 f"a filter on its shard key {shard_set.get_shard_key(mapper.class_)}")
+            shard_ids = shard_ids or shard_set.shard_ids[:1]
+
+        results = []
+        for shard_id in shard_ids:
+            # the loaded objects keep the shard id as identity token, the same primary key may exist on several shards
+            orm_context.update_execution_options(identity_token=shard_id)
+            results.append(orm_context.invoke_statement(
+                bind_arguments=dict(orm_context.bind_arguments, shard_id=shard_id)))
+        return results[0].merge(*results[1:])
+
+    @staticmethod
+    def _find_base_class(mapper, base_classes):
+        """
+        Find the registered base class of a mapper or mapped class.
+
+        :param mapper: The mapper or mapped class.
+        :param base_classes: The registered base classes.
+        :return: The base class, or None if the class is not registered.
+        """
+        mapped_class = getattr(mapper, "class_", mapper)
+        for cls in getattr(mapped_class, "__mro__", ()):
+            if cls in base_classes:
+                return cls
+        return None
+
     def _get_session(self, db_operation_type):
         """
         Retrieve the current thread's session instance.
@@ -199,18 +1037,26 @@ class LightSqlAlchemy:
         """
         Context manager for managing session lifecycle in Flask or non-Flask environments.
 
+        The write session is committed at the end, the read session runs read-only transactions
+        and is rolled back at the end.
+
         :param db_operation_type: The type of database operation. Defaults to "write".
 
         :yield: The session instance for the current thread.
         """
         if self.is_flask:
-            g.session_db_operation_type = db_operation_type
+            if not hasattr(g, "session_db_operation_types"):
+                g.session_db_operation_types = set()
+            g.session_db_operation_types.add(db_operation_type)
 
         session = self._get_session(db_operation_type)
         try:
 
             yield session
-            session.commit()  # Commit the transaction
+            if db_operation_type == "read":
+                session.rollback()  # Nothing to commit, ending the read-only transaction is cheaper
+            else:
+                session.commit()  # Commit the transaction
 
         except Exception as e:
 
@@ -224,6 +1070,220 @@ class LightSqlAlchemy:
             if not self.is_flask:
                 self.close_session(db_operation_type)  # Close the session and connections when the context ends
 
+    @staticmethod
+    def _is_entity_query(query):
+        """ Whether the query selects one mapped class, e.g. select(User). """
+        descriptions = query.column_descriptions
+        return len(descriptions) == 1 and descriptions[0]["type"] is descriptions[0]["expr"]
+
+    @staticmethod
+    def _select_columns(query):
+        """
+        Select the columns of the mapped class of a single entity query instead of the class itself.
+
+        :param query: The Query or Select of one mapped class, other queries are returned unchanged.
+        :return: The query whose rows are keyed by attribute name.
+        """
+        if LightSqlAlchemy._is_entity_query(query):
+            model = query.column_descriptions[0]["entity"]
+            columns = [getattr(model, key) for key in raw_sa.inspect(model).column_attrs.keys()]
+            if isinstance(query, raw_sa_orm.Query):
+                return query.with_entities(*columns)
+            return query.with_only_columns(*columns)
+        return query
+
+    @staticmethod
+    def fetch_plain_rows(query):
+        """
+        Return the rows of an ORM query as dictionaries, the ORM objects are neither created
+        nor registered in the identity map of the session.
+
+        :param query: The Query of one mapped class, e.g. session.query(User).filter(User.id > 10).
+        :return: The list of dictionaries keyed by attribute name.
+        """
+        query = LightSqlAlchemy._select_columns(query)
+        return [row._asdict() for row in query.all()]
+
+    def stream(self, query, batch_size=1000, plain_rows=False, db_operation_type="read"):
+        """
+        Iterate the rows of a large query with a server-side cursor, so only about batch_size rows
+        are held in memory whatever the size of the result, e.g. for exports and streaming responses.
+
+        PyMySQL fetches the rows with an unbuffered SSCursor, the connection can not run other
+        statements until the iteration is finished or the generator is closed.
+
+        :param query: A Query, which runs on its own session, or a Select, which runs on the
+            session of db_operation_type: the session of the get_db_session() of the caller, or a session
+            of its own which is ended with the iteration.
+        :param batch_size: The number of rows fetched from the cursor at a time.
+        :param plain_rows: Whether to yield the rows of a single entity query as dictionaries
+            instead of ORM objects.
+        :param db_operation_type: The session of a Select. Defaults to "read".
+
+        :yield: The ORM objects of a single entity query, the rows otherwise.
+        """
+        if plain_rows:
+            query = self._select_columns(query)
+
+        with ExitStack() as stack:
+            if isinstance(query, raw_sa_orm.Query):
+                # yield_per() turns stream_results on, closing the iterator closes the result
+                rows = iter(query.yield_per(batch_size))
+            else:
+                if self._has_session(db_operation_type):
+                    # the caller's get_db_session() ends the session
+                    session = self._get_session(db_operation_type)
+                else:
+                    session = stack.enter_context(self.get_db_session(db_operation_type))
+                rows = session.execute(query, execution_options={"yield_per": batch_size})
+                if self._is_entity_query(query):
+                    rows = rows.scalars()
+            # release the cursor and its connection when the caller stops early, before the session is ended
+            stack.callback(rows.close)
+
+            for row in rows:
+                yield row._asdict() if plain_rows else row
+
+    def _has_session(self, db_operation_type):
+        """ Whether the current scope has a session of db_operation_type, e.g. inside get_db_session(). """
+        return bool(self.sessions[db_operation_type]) and self.sessions[db_operation_type].registry.has()
+
+    def get_write_engine(self, model):
+        """
+        Return the write engine of a mapped class.
+
+        :param model: The mapped class.
+        :return: The engine instance.
+
+        :exception: ValueError if the model does not belong to a write database.
+        """
+        tenant_engines = self.get_tenant_engines(model)
+        if tenant_engines is not None:
+            return tenant_engines.get_engine(self.require_tenant())
+
+        base_class = self._find_base_class(model, self.bind_model_engines["write"])
+        if base_class is None:
+            raise ValueError(f"No write database is configured for model: {model.__name__}")
+        return self.bind_model_engines["write"][base_class]
+
+    def bulk_insert(self, model, rows, chunk_size=1000):
+        """
+        Insert many rows without creating ORM objects, each chunk is sent by one executemany and committed.
+
+        :param model: The mapped class, the rows are inserted into its table on its write database.
+        :param rows: The iterable of dictionaries keyed by column name, all rows must have the same keys.
+        :param chunk_size: The number of rows of each executemany and transaction.
+        :return: The dictionary of the inserted rows, chunks, seconds and rows_per_second.
+        """
+        def build_statement(table, dialect_name, columns):
+            return build_insert_statement(table)
+
+        return self._bulk_write(model, rows, chunk_size, build_statement)
+
+    def bulk_upsert(self, model, rows, chunk_size=1000, update_columns=None, conflict_columns=None):
+        """
+        Insert many rows and update the existing ones, by ON DUPLICATE KEY UPDATE on MySQL
+        and ON CONFLICT DO UPDATE on SQLite and PostgreSQL.
+
+        :param model: The mapped class, the rows are upserted into its table on its write database.
+        :param rows: The iterable of dictionaries keyed by column name, all rows must have the same keys.
+        :param chunk_size: The number of rows of each executemany and transaction.
+        :param update_columns: The columns to update on conflict, defaults to all the columns of the rows
+            except the conflict columns.
+        :param conflict_columns: The columns of the unique constraint, defaults to the primary key.
+        :return: The dictionary of the upserted rows, chunks, seconds and rows_per_second.
+        """
+        def build_statement(table, dialect_name, columns):
+            return build_upsert_statement(table, dialect_name, columns, update_columns, conflict_columns)
+
+        return self._bulk_write(model, rows, chunk_size, build_statement)
+
+    def _bulk_write(self, model, rows, chunk_size, build_statement):
+        table = model.__table__
+        stats = BulkWriteStats(table.name)
+        statement = None
+        for chunk in iter_chunks(rows, chunk_size):
+            for engine, engine_rows in self._split_rows_by_engine(model, chunk):
+                if statement is None:
+                    statement = build_statement(table, engine.dialect.name, list(chunk[0].keys()))
+                # one transaction per chunk, a failure only rolls back the current chunk
+                with engine.begin() as connection:
+                    connection.execute(statement, engine_rows)
+            stats.add_chunk(len(chunk))
+            self._on_bulk_write(table)
+
+        result = stats.to_dict()
+        if self.logger:
+            self.logger.info(
+                f"Bulk wrote {result['rows']} rows into {table.name} in {result['chunks']} chunks, "
+                f"{result['seconds']} seconds, {result['rows_per_second']} rows per second.")
+        return result
+
+    def _split_rows_by_engine(self, model, rows):
+        """
+        Split the rows of a bulk write by the write engine they belong to, the rows of a sharded model
+        are split by the shard of their shard key.
+
+        :return: The list of (engine, rows) tuples.
+        """
+        shard_set = self.get_shard_set(model)
+        if shard_set is None:
+            return [(self.get_write_engine(model), rows)]
+
+        shard_key = shard_set.get_shard_key(model)
+        rows_by_shard = {}
+        for row in rows:
+            rows_by_shard.setdefault(shard_set.shard_id_for(row[shard_key]), []).append(row)
+        return [(shard_set.engines[shard_id], shard_rows) for shard_id, shard_rows in rows_by_shard.items()]
+
+    def _iter_engines(self):
+        """ Return the engines of all the binds, including the replicas and the shards. """
+        engines = [engine for bind_engines in self.engines.values() for engine in bind_engines.values()]
+        engine_groups = list(self.replica_pools.values()) + list(self.shard_sets.values()) + \
+            list(self.tenant_engines.values())
+        for engine_group in engine_groups:
+            engines.extend(engine for engine in engine_group.engines if engine not in engines)
+        return engines
+
+    def after_fork(self):
+        """
+        Reinitialize in a forked child process, e.g. the workers of gunicorn --preload, so the app
+        and its engines can be created once in the parent.
+
+        The pooled connections of the parent are dropped without being closed, the parent keeps using them
+        and the child opens its own. It is called automatically after os.fork(), call it from the
+        post-fork hook of a server which forks outside of Python, e.g. @postfork of uWSGI.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+
+        for session in self.sessions.values():
+            # a session of the parent may hold a connection, forget it without closing
+            if session is not None:
+                session.registry.clear()
+
+        for engine in self._iter_engines():
+            self._replace_pool(engine)
+        for metrics in self.pool_metrics.values():
+            metrics.after_fork()
+        for replica_pool in self.replica_pools.values():
+            replica_pool.after_fork()
+        for budget in self.connection_budgets.values():
+            budget.after_fork()
+        for tenant_engines in self.tenant_engines.values():
+            tenant_engines.after_fork()
+        if self.slow_query_log is not None:
+            self.slow_query_log.after_fork()
+
+        self._local = threading.local()
+        # a background warm-up interrupted by the fork does not go on in the child, the engines connect on first use
+        self._ready.set()
+
+    def _replace_pool(self, engine):
+        # the connections of the old pool are left open for the parent process
+        engine.dispose(close=False)
+
     def dispose_engine(self):
         """
         Dispose the engine and close all connections.
@@ -236,6 +1296,15 @@ class LightSqlAlchemy:
         for engine in self.engines['write'].values():
             engine.dispose()
 
+        for replica_pool in self.replica_pools.values():
+            replica_pool.dispose()
+
+        for shard_set in self.shard_sets.values():
+            shard_set.dispose()
+
+        for tenant_engines in self.tenant_engines.values():
+            tenant_engines.dispose()
+
     def close_session(self, db_operation_type):
         """
         :param db_operation_type: The type of database operation.
@@ -250,9 +1319,12 @@ class LightSqlAlchemy:
         if self.sessions[db_operation_type]:
             self.sessions[db_operation_type].remove()
 
-    def set_sqlalchemy_logging(self):
+    def set_sqlalchemy_logging(self, echo_sql=True):
         """
         Set up logging for SQLAlchemy to log all SQL queries.
+
+        :param echo_sql: Whether to log every SQL statement when open_logging is enabled,
+            turn it off in production and record the slow statements with set_slow_query_options().
         :return:
         """
         import logging
@@ -260,7 +1332,7 @@ class LightSqlAlchemy:
         if self.open_logging:
             logging.getLogger('sqlalchemy.echo').setLevel(logging.INFO)
             logging.getLogger('sqlalchemy.pool').setLevel(logging.INFO)
-            logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+            logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO if echo_sql else logging.WARN)
 
     def validate_db_config(self, db_config: dict):
         """
@@ -284,9 +1356,44 @@ class LightSqlAlchemy:
                 if db_operation_type and db_operation_type not in ["read", "write"]:
                     raise ValueError(f"db_operation_type must be 'read' or 'write' with key: {key}")
 
-                # check db url
-                if not db_obj.get("url"):
+                # check db url, a sharded bind has the list of shard urls instead
+                shards = db_obj.get("shards")
+                tenant_url = db_obj.get("tenant_url")
+                if tenant_url is not None:
+                    if not isinstance(tenant_url, (str, dict)) and not callable(tenant_url):
+                        raise ValueError(f"tenant_url must be a url template, a dictionary or a function with key: {key}")
+                    if db_operation_type == "read" or db_obj.get("url") or shards:
+                        raise ValueError(
+                            f"tenant_url can not be used with url, shards or db_operation_type 'read' with key: {key}")
+                    tenant_options = db_obj.get("tenant_options")
+                    if tenant_options is not None and not isinstance(tenant_options, dict):
+                        raise ValueError(f"tenant_options must be a dictionary with key: {key}")
+
+                elif shards is not None:
+                    if not isinstance(shards, (list, tuple)) or not shards:
+                        raise ValueError(f"shards must be a non-empty list of urls with key: {key}")
+                    if db_operation_type == "read" or db_obj.get("url"):
+                        raise ValueError(f"shards can not be used with url or db_operation_type 'read' with key: {key}")
+
+                elif not db_obj.get("url"):
                     raise ValueError(f"url is required with key: {key}")
 
+                # A list of urls is only supported by the read replicas
+                elif isinstance(db_obj["url"], (list, tuple)) and db_operation_type != "read":
+                    raise ValueError(f"A list of urls is only supported when db_operation_type is 'read' with key: {key}")
+
+                replica_options = db_obj.get("replica_options")
+                if replica_options is not None and not isinstance(replica_options, dict):
+                    raise ValueError(f"replica_options must be a dictionary with key: {key}")
+
+                dialect_options = db_obj.get("dialect_options")
+                if dialect_options is not None and not isinstance(dialect_options, dict):
+                    raise ValueError(f"dialect_options must be a dictionary with key: {key}")
+
+                connection_budget = db_obj.get("connection_budget")
+                if connection_budget is not None and (not isinstance(connection_budget, dict)
+                                                      or not connection_budget.get("max_connections")):
+                    raise ValueError(f"connection_budget must be a dictionary with max_connections with key: {key}")
+
     def set_logger(self, logger):
         self.logger = logger
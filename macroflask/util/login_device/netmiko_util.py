@@ -1,5 +1,6 @@
 import time
 from netmiko import ConnectHandler
+from macroflask.util.deadline import cap_timeout
 from macroflask.util.login_device.base_login_util import BaseLogin
 
 
@@ -25,6 +26,10 @@ class NetmikoLogin(BaseLogin):
             'password': kwargs['password'],
             'device_type': kwargs['device_type']
         }
+        # do not wait for the device longer than the remaining time of the request
+        conn_timeout = cap_timeout(kwargs.get('conn_timeout'))
+        if conn_timeout:
+            connection_params['conn_timeout'] = conn_timeout
         self.device = ConnectHandler(**connection_params)
         if 'secret' in kwargs:
             self.device.enable()
@@ -40,6 +45,8 @@ class NetmikoLogin(BaseLogin):
         Returns:
             str: The response from the device.
         """
+        # the read timeout is shortened to the remaining time of the request deadline
+        timeout = cap_timeout(timeout)
         extra_params = {'read_timeout': timeout} if timeout else {}
         return self.device.send_command(command, **extra_params)
 
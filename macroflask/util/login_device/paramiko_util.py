@@ -4,6 +4,8 @@ from base64 import decodebytes
 
 import paramiko
 
+from macroflask.util.deadline import cap_timeout
+
 
 class ParamikoLoginUtils(object):
     wait_login_timeout = 5
@@ -18,7 +20,7 @@ class ParamikoLoginUtils(object):
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh.connect(ip, port, username, password,
-                         timeout=self.wait_login_timeout,
+                         timeout=cap_timeout(self.wait_login_timeout),
                          look_for_keys=False, allow_agent=False,
                          disabled_algorithms=dict(pubkeys=['rsa-sha2-256', 'rsa-sha2-512'])
                          )
@@ -27,7 +29,7 @@ class ParamikoLoginUtils(object):
     # realtime query info for dealing upgrade process
     def execute_command_and_get_response(self, command):
         stdin, stdout, stderr = self.ssh.exec_command(
-            command, get_pty=True, timeout=self.wait_exec_command_timeout)
+            command, get_pty=True, timeout=cap_timeout(self.wait_exec_command_timeout))
         while not stdout.channel.exit_status_ready():
             line_content = stdout.readline()
             print(line_content)
@@ -38,6 +40,8 @@ class ParamikoLoginUtils(object):
 
     def execute_command_quickly(self, command, timeout=None):
         timeout = self.wait_login_timeout if not timeout else timeout
+        # the timeouts are shortened to the remaining time of the request deadline
+        timeout = cap_timeout(timeout)
         stdin, stdout, stderr = self.ssh.exec_command(command, timeout=timeout)
         return stdout.readlines()
     
@@ -57,6 +61,7 @@ class ParamikoLoginUtils(object):
         return channel
 
     def pull_result_in_shell(self, channel, target_character=None, timeout=1, sleep_time=1):
+        timeout = cap_timeout(timeout)
         start_time = time.time()
         status, message = False, ""
         total_result = ""
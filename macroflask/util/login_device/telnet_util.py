@@ -1,6 +1,7 @@
 import telnetlib
 import time
 
+from macroflask.util.deadline import cap_timeout
 from macroflask.util.login_device.base_login_util import BaseLogin
 
 
@@ -51,7 +52,11 @@ class TelnetLogin(BaseLogin):
             Exception: If login fails after 3 attempts.
         """
         self.host_ip = host_ip
-        self.device = telnetlib.Telnet(host=host_ip, port=port)
+        connect_timeout = cap_timeout()
+        if connect_timeout:
+            self.device = telnetlib.Telnet(host=host_ip, port=port, timeout=connect_timeout)
+        else:
+            self.device = telnetlib.Telnet(host=host_ip, port=port)
         for attempt in range(3):
             if self.attempt_login(kwargs):
                 return "Login successful"
@@ -70,7 +75,8 @@ class TelnetLogin(BaseLogin):
         Returns:
             bool: True if the expected string is found in the actual response, False otherwise.
         """
-        result = self.device.read_until(bytes(expected_str, encoding=self.encoding), timeout)
+        # the timeouts are shortened to the remaining time of the request deadline
+        result = self.device.read_until(bytes(expected_str, encoding=self.encoding), cap_timeout(timeout))
         return expected_str in result.decode(self.encoding)
 
     def send_command(self, command: str) -> None:
@@ -94,7 +100,7 @@ class TelnetLogin(BaseLogin):
             str: The response from the server.
         """
         self.device.write(bytes(command, encoding=self.encoding) + b'\n')
-        time.sleep(timeout)
+        time.sleep(cap_timeout(timeout))
         return self.device.read_very_eager().decode(self.encoding)
 
     def send_command_and_get_response_efficiency(self, expected_str: str, timeout: int = 10) -> str:
@@ -108,6 +114,7 @@ class TelnetLogin(BaseLogin):
         Returns:
             str: The response from the server.
         """
+        timeout = cap_timeout(timeout)
         return self.device.read_until(bytes(expected_str, encoding=self.encoding), timeout).decode(self.encoding)
 
     def get_show_command_result(self, command_set: list) -> dict:
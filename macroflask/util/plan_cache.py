@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+
+class PlanCache:
+    def __init__(self, max_size=500):
+        """
+        A bounded LRU of query plans: the statements built once per query shape, executed again with the
+        parameter values of each request.
+
+        :param max_size: The maximum number of plans, the least recently used plan is dropped beyond it.
+        """
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_time = 0.0
+
+    def get(self, key):
+        """
+        :param key: The shape key of the query.
+        :return: The cached plan, None on a miss.
+        """
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, key, plan, compile_time):
+        """
+        :param key: The shape key of the query.
+        :param plan: The plan built for the shape.
+        :param compile_time: The number of seconds spent building the plan.
+        """
+        with self._lock:
+            self.compile_time += compile_time
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+                self.evictions += 1
+
+    def after_fork(self):
+        """ Reset the lock in a forked child process, the plans stay valid. """
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.compile_time = 0.0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "plans": len(self._plans),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "evictions": self.evictions,
+            "compile_ms": round(self.compile_time * 1000, 3),
+            "avg_compile_ms": round(self.compile_time * 1000 / self.misses, 3) if self.misses else 0,
+        }
@@ -0,0 +1,172 @@
+import bisect
+import threading
+import time
+
+import sqlalchemy.event as raw_sa_event
+
+
+class LatencyHistogram:
+    # upper bounds of the buckets in milliseconds, the last bucket collects everything above
+    DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, milliseconds):
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        if milliseconds > self.max:
+            self.max = milliseconds
+
+    def to_dict(self):
+        labels = [f"<={bucket}ms" for bucket in self.buckets] + [f">{self.buckets[-1]}ms"]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max, 3),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class PoolMetrics:
+    def __init__(self, name, engine):
+        """
+        Collect the live connection pool metrics of one engine.
+
+        :param name: The name of the engine in the metrics, e.g. 'write:database1'.
+        :param engine: The engine to instrument.
+        """
+        self.name = name
+        self.engine = engine
+        self._reset()
+
+        self._register_events()
+        self.instrument_pool()
+
+    def _reset(self):
+        self.checkout_wait = LatencyHistogram()
+        self.connect_latency = LatencyHistogram()
+        self.checkouts = 0
+        self.checkout_errors = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+        self.recycles = 0
+        self.max_checked_out = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._instrumented_pool = None
+
+    def after_fork(self):
+        """
+        Start over in a forked child process, the metrics of the parent do not describe the pool of the child.
+        Call it after the pool of the engine is replaced, the new pool is instrumented.
+        """
+        self._reset()
+        self.instrument_pool()
+
+    def _register_events(self):
+        # The pool events registered on the engine are kept when the pool is recreated by dispose()
+        raw_sa_event.listen(self.engine, "do_connect", self._on_do_connect)
+        raw_sa_event.listen(self.engine, "connect", self._on_connect)
+        raw_sa_event.listen(self.engine, "checkout", self._on_checkout)
+        raw_sa_event.listen(self.engine, "invalidate", self._on_invalidate)
+        raw_sa_event.listen(self.engine, "soft_invalidate", self._on_soft_invalidate)
+
+    def instrument_pool(self):
+        """
+        Time the checkouts of the current pool of the engine.
+
+        The engine replaces its pool on dispose(), call it again for the new pool.
+        """
+        pool = self.engine.pool
+        if pool is self._instrumented_pool:
+            return
+
+        pool_connect = pool.connect
+
+        def timed_connect():
+            start_time = time.perf_counter()
+            try:
+                return pool_connect()
+            except Exception:
+                with self._lock:
+                    self.checkout_errors += 1
+                raise
+            finally:
+                with self._lock:
+                    self.checkout_wait.observe((time.perf_counter() - start_time) * 1000)
+
+        pool.connect = timed_connect
+        self._instrumented_pool = pool
+
+    def _on_do_connect(self, dialect, conn_rec, cargs, cparams):
+        self._local.connect_start_time = time.perf_counter()
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        start_time = getattr(self._local, "connect_start_time", None)
+        with self._lock:
+            if start_time is not None:
+                self.connect_latency.observe((time.perf_counter() - start_time) * 1000)
+
+            # the record_info outlives the DBAPI connection, a record connecting again without
+            # being invalidated has been recycled by pool_recycle
+            record_info = connection_record.record_info
+            if record_info.get("metrics_connected") and not record_info.pop("metrics_invalidated", False):
+                self.recycles += 1
+            record_info["metrics_connected"] = True
+        self._local.connect_start_time = None
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        checked_out = self._pool_status("checkedout")
+        with self._lock:
+            self.checkouts += 1
+            if checked_out is not None and checked_out > self.max_checked_out:
+                self.max_checked_out = checked_out
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        connection_record.record_info["metrics_invalidated"] = True
+        with self._lock:
+            self.invalidations += 1
+
+    def _on_soft_invalidate(self, dbapi_connection, connection_record, exception):
+        connection_record.record_info["metrics_invalidated"] = True
+        with self._lock:
+            self.soft_invalidations += 1
+
+    def _pool_status(self, method_name):
+        # Only the QueuePool knows its size and overflow, e.g. the StaticPool does not
+        method = getattr(self.engine.pool, method_name, None)
+        return method() if callable(method) else None
+
+    def snapshot(self):
+        """
+        Return the current metrics of the engine.
+
+        :return: The metrics dictionary.
+        """
+        self.instrument_pool()
+        overflow = self._pool_status("overflow")
+        with self._lock:
+            return {
+                "name": self.name,
+                "url": self.engine.url.render_as_string(hide_password=True),
+                "pool_class": self.engine.pool.__class__.__name__,
+                "pool_size": self._pool_status("size"),
+                "checked_out": self._pool_status("checkedout"),
+                "checked_in": self._pool_status("checkedin"),
+                # the overflow is negative while the pool has not created all of its connections
+                "overflow_in_use": max(overflow, 0) if overflow is not None else None,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_errors": self.checkout_errors,
+                "checkout_wait": self.checkout_wait.to_dict(),
+                "connect_latency": self.connect_latency.to_dict(),
+                "invalidations": self.invalidations,
+                "soft_invalidations": self.soft_invalidations,
+                "recycles": self.recycles,
+            }
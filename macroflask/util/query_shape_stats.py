@@ -0,0 +1,88 @@
+import threading
+
+
+class ShapeStats:
+    def __init__(self, key, sample):
+        """
+        The executions of one query shape.
+
+        :param key: The key of the shape.
+        :param sample: The last query of the shape, e.g. to explain it.
+        """
+        self.key = key
+        self.sample = sample
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, duration, sample):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.sample = sample
+
+
+class QueryShapeStats:
+    ORDER_FIELDS = ("total_ms", "count", "avg_ms", "max_ms")
+
+    def __init__(self, key_fields, max_shapes=1000):
+        """
+        Count the executions and the time of the query shapes, e.g. the combinations of filter and sort fields.
+
+        :param key_fields: The names of the parts of the shape keys, used in to_dict().
+        :param max_shapes: The maximum number of shapes, the least executed shape is dropped beyond it.
+        """
+        self.key_fields = key_fields
+        self.max_shapes = max_shapes
+        self.shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, duration, sample=None):
+        """
+        :param key: The key of the shape, a tuple of key_fields values.
+        :param duration: The number of seconds of the execution.
+        :param sample: The query executed, kept for the last execution of each shape.
+        """
+        with self._lock:
+            shape_stats = self.shapes.get(key)
+            if shape_stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    least_executed = min(self.shapes.values(), key=lambda item: item.count)
+                    del self.shapes[least_executed.key]
+                shape_stats = self.shapes[key] = ShapeStats(key, sample)
+            shape_stats.record(duration, sample)
+
+    def to_dict(self, shape_stats):
+        data = dict(zip(self.key_fields, shape_stats.key))
+        data.update({
+            "count": shape_stats.count,
+            "total_ms": round(shape_stats.total_time * 1000, 3),
+            "avg_ms": round(shape_stats.total_time * 1000 / shape_stats.count, 3),
+            "max_ms": round(shape_stats.max_time * 1000, 3),
+        })
+        return data
+
+    def get_top(self, order_by="total_ms", limit=20):
+        """
+        Return the shapes with the most time or executions.
+
+        :param order_by: The field to sort by in descending order, one of ORDER_FIELDS.
+        :param limit: The maximum number of shapes.
+        :return: The list of (ShapeStats, dictionary) tuples.
+
+        :exception: ValueError if order_by is not supported.
+        """
+        if order_by not in self.ORDER_FIELDS:
+            raise ValueError(f"order_by must be one of {self.ORDER_FIELDS}")
+        with self._lock:
+            shapes = [(shape_stats, self.to_dict(shape_stats)) for shape_stats in self.shapes.values()]
+        return sorted(shapes, key=lambda item: item[1][order_by], reverse=True)[:limit]
+
+    def after_fork(self):
+        """ Start over in a forked child process, the lock may be held by a thread of the parent. """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.shapes.clear()
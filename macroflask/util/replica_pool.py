@@ -0,0 +1,363 @@
+import math
+import random
+import threading
+import time
+
+import sqlalchemy as raw_sa
+import sqlalchemy.event as raw_sa_event
+
+
+class Replica:
+    def __init__(self, engine, weight=1):
+        """
+        A single read replica inside a ReplicaPool.
+
+        :param engine: The SQLAlchemy engine of the replica.
+        :param weight: The weight of the replica, only used by the 'weighted' policy.
+        """
+        self.engine = engine
+        self.weight = weight
+        # number of connections currently checked out from the replica pool
+        self.in_flight = 0
+        # current weight used by the smooth weighted round-robin algorithm
+        self.current_weight = 0
+        self.healthy = True
+        # timestamp after which an unhealthy replica will be probed again
+        self.retry_at = 0
+        self.probing = False
+        self.last_error = None
+        # replication lag in seconds, None means the lag is unknown, ReplicaPool.REPLICATION_STOPPED that
+        # the replica reports no lag as it does not replicate
+        self.lag = None
+        # time.time() when the lag was measured
+        self.lag_measured_at = None
+
+    def to_dict(self):
+        return {
+            "url": self.engine.url.render_as_string(hide_password=True),
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "healthy": self.healthy,
+            "lag": self.lag if self.lag != ReplicaPool.REPLICATION_STOPPED else None,
+            "replication_stopped": self.lag == ReplicaPool.REPLICATION_STOPPED,
+            "last_error": self.last_error,
+        }
+
+
+class ReplicaPool:
+    POLICY_ROUND_ROBIN = "round_robin"
+    POLICY_LEAST_IN_FLIGHT = "least_in_flight"
+    POLICY_WEIGHTED = "weighted"
+    POLICIES = (POLICY_ROUND_ROBIN, POLICY_LEAST_IN_FLIGHT, POLICY_WEIGHTED)
+
+    # the lag of a replica whose lag query returns NULL, e.g. a stopped MySQL replication thread
+    REPLICATION_STOPPED = math.inf
+
+    # the queries to measure the replication lag in seconds of each dialect
+    LAG_QUERIES = {
+        "mysql": "SHOW REPLICA STATUS",
+        "postgresql": "SELECT CASE WHEN pg_is_in_recovery() "
+                      "THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) ELSE 0 END",
+    }
+
+    def __init__(self, bind_key, engines, policy=POLICY_ROUND_ROBIN, weights=None, retry_interval=30,
+                 max_lag=None, lag_check_interval=5, lag_query=None, logger=None):
+        """
+        Load-balance the read traffic of one bind key across several replica engines.
+
+        Replicas that fail to connect or lose their connection are taken out of rotation,
+        and they are probed in a background thread every `retry_interval` seconds until they recover.
+
+        :param bind_key: The bind key the replicas belong to.
+        :param engines: The list of replica engines.
+        :param policy: The balancing policy, 'round_robin', 'least_in_flight' or 'weighted'.
+        :param weights: The weight of each engine, only used by the 'weighted' policy.
+        :param retry_interval: Number of seconds to wait before probing an unhealthy replica again.
+        :param max_lag: The maximum replication lag in seconds, replicas lagging behind it are skipped.
+            None disables the lag check.
+        :param lag_check_interval: Number of seconds between two lag measurements.
+        :param lag_query: A custom query returning the lag in seconds, e.g. from a heartbeat table.
+        :param logger: The logger used to record replica state changes.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Replica policy must be one of {self.POLICIES} with key: {bind_key}")
+        if not engines:
+            raise ValueError(f"At least one replica engine is required with key: {bind_key}")
+        weights = weights or [1] * len(engines)
+        if len(weights) != len(engines):
+            raise ValueError(f"The length of weights and replica urls should be the same with key: {bind_key}")
+
+        self.bind_key = bind_key
+        self.policy = policy
+        self.retry_interval = retry_interval
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lag_query = lag_query
+        self.logger = logger
+        self.replicas = [Replica(engine, weight) for engine, weight in zip(engines, weights)]
+        self._replica_by_engine = {id(replica.engine): replica for replica in self.replicas}
+        self._lock = threading.Lock()
+        self._next_index = random.randrange(len(self.replicas))
+        self._next_lag_check = 0
+        self._lag_checking = False
+
+        for replica in self.replicas:
+            self._register_events(replica)
+
+    @property
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    def _register_events(self, replica):
+        """
+        Track in-flight checkouts and connection failures of the replica engine.
+
+        :param replica: The replica to track.
+        """
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            replica.in_flight += 1
+
+        def on_checkin(dbapi_connection, connection_record):
+            replica.in_flight = max(replica.in_flight - 1, 0)
+
+        def on_handle_error(context):
+            # A missing connection means the error was raised while connecting.
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(replica.engine, context.original_exception)
+
+        raw_sa_event.listen(replica.engine.pool, "checkout", on_checkout)
+        raw_sa_event.listen(replica.engine.pool, "checkin", on_checkin)
+        raw_sa_event.listen(replica.engine, "handle_error", on_handle_error)
+
+    def healthy_replicas(self):
+        return [replica for replica in self.replicas if replica.healthy and not self.is_lagging(replica)]
+
+    def is_lagging(self, replica):
+        if self.max_lag is None or replica.lag is None:
+            return False
+        return replica.lag > self.max_lag
+
+    def has_caught_up(self, engine, since):
+        """
+        Whether a replica had replayed the writes committed on the primary at a point in time,
+        according to its last lag measurement.
+
+        :param engine: The engine of the replica.
+        :param since: The time.time() of the writes.
+        :return: False if the lag of the replica is unknown or too large.
+        """
+        replica = self._replica_by_engine.get(id(engine))
+        if replica is None or replica.lag is None or replica.lag_measured_at is None:
+            return False
+        return replica.lag_measured_at - replica.lag >= since
+
+    def pick(self):
+        """
+        Pick an engine according to the balancing policy.
+
+        :return: The engine of a healthy replica, or None when all replicas are out of rotation.
+        """
+        self._probe_due_replicas()
+        self._check_lag_if_due()
+
+        with self._lock:
+            candidates = self.healthy_replicas()
+            if not candidates:
+                return None
+
+            if self.policy == self.POLICY_LEAST_IN_FLIGHT:
+                replica = min(candidates, key=lambda r: r.in_flight)
+
+            elif self.policy == self.POLICY_WEIGHTED:
+                # smooth weighted round-robin, spreads the heavy replicas evenly over time
+                total_weight = 0
+                replica = None
+                for candidate in candidates:
+                    candidate.current_weight += candidate.weight
+                    total_weight += candidate.weight
+                    if replica is None or candidate.current_weight > replica.current_weight:
+                        replica = candidate
+                replica.current_weight -= total_weight
+
+            else:
+                self._next_index = (self._next_index + 1) % len(candidates)
+                replica = candidates[self._next_index]
+
+        return replica.engine
+
+    def mark_down(self, engine, error=None):
+        """
+        Take a replica out of rotation.
+
+        :param engine: The engine of the replica.
+        :param error: The error which made the replica unhealthy.
+        """
+        replica = self._replica_by_engine.get(id(engine))
+        if replica is None:
+            return
+
+        with self._lock:
+            was_healthy = replica.healthy
+            replica.healthy = False
+            replica.retry_at = time.time() + self.retry_interval
+            replica.last_error = str(error) if error else None
+
+        if was_healthy and self.logger:
+            self.logger.warning(
+                f"Replica {engine.url.render_as_string(hide_password=True)} of bind {self.bind_key} "
+                f"is out of rotation: {error}")
+
+    def mark_up(self, engine):
+        """
+        Put a replica back into rotation.
+
+        :param engine: The engine of the replica.
+        """
+        replica = self._replica_by_engine.get(id(engine))
+        if replica is None:
+            return
+
+        with self._lock:
+            was_healthy = replica.healthy
+            replica.healthy = True
+            replica.last_error = None
+
+        if not was_healthy and self.logger:
+            self.logger.info(
+                f"Replica {engine.url.render_as_string(hide_password=True)} of bind {self.bind_key} "
+                f"is back in rotation.")
+
+    def ping(self, engine):
+        """
+        Check whether the replica accepts connections, and update its state accordingly.
+
+        :param engine: The engine of the replica.
+        :return: True if the replica is healthy, False otherwise.
+        """
+        try:
+            with engine.connect() as connection:
+                connection.execute(raw_sa.text("SELECT 1"))
+        except Exception as e:
+            self.mark_down(engine, e)
+            return False
+
+        self.mark_up(engine)
+        return True
+
+    def _probe_due_replicas(self):
+        """ Probe the unhealthy replicas whose retry time has passed, without blocking the caller. """
+        now = time.time()
+        for replica in self.replicas:
+            if replica.healthy or replica.probing or replica.retry_at > now:
+                continue
+
+            with self._lock:
+                if replica.probing:
+                    continue
+                replica.probing = True
+
+            threading.Thread(target=self._probe, args=(replica,), daemon=True).start()
+
+    def _probe(self, replica):
+        try:
+            self.ping(replica.engine)
+        finally:
+            replica.probing = False
+
+    def measure_lag(self, engine):
+        """
+        Measure the replication lag of a replica.
+
+        :param engine: The engine of the replica.
+        :return: The lag in seconds, REPLICATION_STOPPED if the replica reports a NULL lag,
+            None if it can not be measured.
+        """
+        dialect_name = engine.dialect.name
+        lag_query = self.lag_query or self.LAG_QUERIES.get(dialect_name)
+        if not lag_query:
+            return None
+
+        with engine.connect() as connection:
+            if self.lag_query or dialect_name != "mysql":
+                row = connection.execute(raw_sa.text(lag_query)).first()
+                if row is None:
+                    return None
+                return row[0] if row[0] is not None else self.REPLICATION_STOPPED
+
+            try:
+                row = connection.execute(raw_sa.text(lag_query)).mappings().first()
+            except raw_sa.exc.DBAPIError:
+                # MySQL before 8.0.22 only knows the legacy statement
+                row = connection.execute(raw_sa.text("SHOW SLAVE STATUS")).mappings().first()
+
+        if row is None:
+            # not a replica, no lag at all
+            return 0
+        lag = row["Seconds_Behind_Source"] if "Seconds_Behind_Source" in row else row.get("Seconds_Behind_Master")
+        # the lag is NULL while the replication threads are stopped or broken
+        return lag if lag is not None else self.REPLICATION_STOPPED
+
+    def check_lag(self):
+        """ Measure the replication lag of every healthy replica. """
+        for replica in self.replicas:
+            if not replica.healthy:
+                continue
+            measured_at = time.time()
+            try:
+                lag = self.measure_lag(replica.engine)
+            except Exception as e:
+                self.mark_down(replica.engine, e)
+                continue
+
+            was_lagging = self.is_lagging(replica)
+            replica.lag = float(lag) if lag is not None else None
+            replica.lag_measured_at = measured_at
+            if self.logger and was_lagging != self.is_lagging(replica):
+                state = "lagging behind" if not was_lagging else "caught up with"
+                lag = "replication stopped" if replica.lag == self.REPLICATION_STOPPED else f"{replica.lag} seconds"
+                self.logger.warning(
+                    f"Replica {replica.engine.url.render_as_string(hide_password=True)} of bind {self.bind_key} "
+                    f"is {state} the primary, lag: {lag}.")
+
+    def _check_lag_if_due(self):
+        """ Measure the replication lag in a background thread every `lag_check_interval` seconds. """
+        if self.max_lag is None or self._lag_checking or time.time() < self._next_lag_check:
+            return
+
+        with self._lock:
+            if self._lag_checking:
+                return
+            self._lag_checking = True
+            self._next_lag_check = time.time() + self.lag_check_interval
+
+        threading.Thread(target=self._run_lag_check, daemon=True).start()
+
+    def _run_lag_check(self):
+        try:
+            self.check_lag()
+        finally:
+            self._lag_checking = False
+
+    def after_fork(self):
+        """
+        Reset the state of the replicas in a forked child process, the connections, the probe threads and
+        the lag check thread of the parent are not in the child.
+        """
+        self._lock = threading.Lock()
+        self._lag_checking = False
+        self._next_lag_check = 0
+        for replica in self.replicas:
+            replica.in_flight = 0
+            replica.probing = False
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+    def stats(self):
+        return {
+            "bind_key": self.bind_key,
+            "policy": self.policy,
+            "max_lag": self.max_lag,
+            "replicas": [replica.to_dict() for replica in self.replicas],
+        }
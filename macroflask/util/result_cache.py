@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+
+
+class ResultCache:
+    def __init__(self, max_size=1000):
+        """
+        A bounded LRU of query results, each valid for its ttl and as long as the tables it read are unchanged.
+
+        Each table has a version counter, bumped when a session which wrote to the table commits.
+        A result is stored with the versions of its tables read before the query, so a write committed
+        while the query runs makes the result stale at once. The versions are kept per process: the writes
+        of the other processes are only seen after the ttl of the results.
+
+        :param max_size: The maximum number of results, the least recently used result is dropped beyond it.
+        """
+        self.max_size = max_size
+        # key -> (versions, expiry time, value)
+        self._entries = OrderedDict()
+        # table name -> version
+        self._versions = {}
+        # table name -> time.time() of its last bump
+        self._write_times = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get_versions(self, tables):
+        """
+        :param tables: The names of the tables a query reads.
+        :return: The tuple of their versions.
+        """
+        return tuple(self._versions.get(table, 0) for table in tables)
+
+    def get_last_write_time(self, tables):
+        """
+        :param tables: The names of the tables a query reads.
+        :return: The time.time() of the last commit which wrote to one of them, 0 if none did.
+        """
+        return max((self._write_times.get(table, 0) for table in tables), default=0)
+
+    def get(self, key, versions):
+        """
+        :param key: The key of the query.
+        :param versions: The current versions of the tables of the query, see get_versions().
+        :return: The cached result, None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != versions or entry[1] <= time.monotonic():
+                del self._entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, versions, value, ttl):
+        """
+        :param key: The key of the query.
+        :param versions: The versions of the tables read before the query ran.
+        :param value: The result, the callers share it and must not modify it.
+        :param ttl: The number of seconds the result is valid at most.
+        """
+        with self._lock:
+            self._entries[key] = (versions, time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self, tables):
+        """ Increment the versions of the written tables, the cached results which read them are stale. """
+        now = time.time()
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._write_times[table] = now
+
+    def track_writes(self, session_class, router_class=None):
+        """
+        Bump the versions of the tables written by the sessions of a class when they commit: the objects
+        flushed and the ORM INSERT, UPDATE and DELETE statements. A rollback forgets the writes.
+
+        :param session_class: The Session class, e.g. RoutingSession.
+        :param router_class: The LightSqlAlchemy class, to bump the versions of the tables written by
+            its bulk_insert() and bulk_upsert(), which bypass the sessions.
+        """
+        if router_class is not None:
+            router_class.add_bulk_write_listener(self.bump)
+
+        def add_tables(session, mappers):
+            tables = session.info.setdefault("result_cache_tables", set())
+            for mapper in mappers:
+                tables.update(table.name for table in mapper.tables)
+
+        @event.listens_for(session_class, "after_flush")
+        def after_flush(session, flush_context):
+            objects = list(session.new) + list(session.dirty) + list(session.deleted)
+            add_tables(session, {inspect(obj).mapper for obj in objects})
+
+        @event.listens_for(session_class, "do_orm_execute")
+        def do_orm_execute(orm_execute_state):
+            if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) \
+                    and orm_execute_state.bind_mapper:
+                add_tables(orm_execute_state.session, [orm_execute_state.bind_mapper])
+
+        @event.listens_for(session_class, "after_commit")
+        def after_commit(session):
+            tables = session.info.pop("result_cache_tables", None)
+            if tables:
+                self.bump(tables)
+
+        @event.listens_for(session_class, "after_rollback")
+        def after_rollback(session):
+            session.info.pop("result_cache_tables", None)
+
+    def after_fork(self):
+        """ Reset the lock in a forked child process, a thread of the parent may have held it. """
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.stale = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "tables": len(self._versions),
+        }
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+
+SCOPE_THREAD = "thread"
+SCOPE_GREENLET = "greenlet"
+SCOPE_CONTEXT = "context"
+SCOPES = (SCOPE_THREAD, SCOPE_GREENLET, SCOPE_CONTEXT)
+
+# A greenlet lets the others run while it waits for the database only if the driver is cooperative:
+# PyMySQL and pg8000 are pure Python, they are cooperative once the socket module is monkey patched,
+# psycopg2 is cooperative after psycogreen.gevent.patch_psycopg() (or psycogreen.eventlet.patch_psycopg()).
+# mysqlclient (MySQLdb) and SQLite block the whole worker during a statement.
+COOPERATIVE_DRIVERS = ("pymysql", "pg8000", "psycopg2")
+
+_context_scope = contextvars.ContextVar("session_scope", default=None)
+
+
+def greenlet_scope():
+    """ :return: The current greenlet, the session registry keeps one session per greenlet. """
+    return greenlet.getcurrent()
+
+
+def _get_context_owner():
+    """ :return: The asyncio task, else the greenlet, else the thread running the current context. """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return task
+    if greenlet is not None:
+        return greenlet.getcurrent()
+    return threading.current_thread()
+
+
+def context_scope():
+    """
+    :return: A key of the current contextvars context, created on the first call in the context.
+        An asyncio task, a greenlet or a thread started in a copy of the context gets a key of its own
+        on its first call, it does not share the session of its parent.
+    """
+    owner = _get_context_owner()
+    scope = _context_scope.get()
+    if scope is None or scope[0]() is not owner:
+        scope = (weakref.ref(owner), object())
+        _context_scope.set(scope)
+    return scope[1]
+
+
+def get_scopefunc(session_scope=SCOPE_THREAD):
+    """
+    Return the scope function of the scoped sessions, each scope gets its own session.
+
+    'thread' gives one session to each thread, it is the default of SQLAlchemy. Under gevent or eventlet
+    workers many requests run as greenlets of the same thread: 'greenlet' gives one session to each greenlet,
+    'context' gives one session to each contextvars context, i.e. each thread, greenlet (greenlet >= 1.0)
+    or asyncio task.
+
+    :param session_scope: 'thread', 'greenlet', 'context' or a function returning the key of the current scope.
+    :return: The scope function, None for the thread-local registry of SQLAlchemy.
+
+    :exception: ValueError if the scope is unknown or greenlet is not installed.
+    """
+    if callable(session_scope):
+        return session_scope
+    if session_scope == SCOPE_THREAD:
+        return None
+    if session_scope == SCOPE_GREENLET:
+        if greenlet is None:
+            raise ValueError("The 'greenlet' session scope requires the greenlet package")
+        return greenlet_scope
+    if session_scope == SCOPE_CONTEXT:
+        return context_scope
+    raise ValueError(f"session_scope must be one of {SCOPES} or a function")
+
+
+def is_cooperative_driver(dialect):
+    """
+    Whether the driver of a dialect lets the other greenlets run while it waits for the database.
+
+    :param dialect: The dialect of an engine.
+    :return: True if the driver is cooperative once monkey patched, see COOPERATIVE_DRIVERS.
+    """
+    return dialect.driver in COOPERATIVE_DRIVERS
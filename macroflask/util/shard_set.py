@@ -0,0 +1,160 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from macroflask.util.concurrency_strategy import run_with_deadline
+from macroflask.util.deadline import get_deadline
+
+
+class ShardSet:
+    def __init__(self, bind_key, engines):
+        """
+        Partition the rows of the models of one bind key across several databases by the hash of a shard key.
+
+        A sharded model names its shard key column with the __shard_key__ attribute, e.g. __shard_key__ = "device_id".
+        The shard of a row is crc32(str(shard key value)) % number of shards, so it is stable across processes
+        and the number of shards can not change without moving the rows.
+
+        :param bind_key: The bind key the shards belong to.
+        :param engines: The list of shard engines, the shard id is the index of the engine.
+        """
+        if not engines:
+            raise ValueError(f"At least one shard engine is required with key: {bind_key}")
+        self.bind_key = bind_key
+        self.engines = list(engines)
+
+    @property
+    def shard_ids(self):
+        return list(range(len(self.engines)))
+
+    def shard_id_for(self, value):
+        """
+        :param value: The value of the shard key.
+        :return: The id of the shard the value belongs to.
+        """
+        return zlib.crc32(str(value).encode("utf-8")) % len(self.engines)
+
+    @staticmethod
+    def get_shard_key(model):
+        """
+        :param model: The mapped class.
+        :return: The name of the shard key column of the model.
+
+        :exception: ValueError if the model does not declare __shard_key__.
+        """
+        shard_key = getattr(model, "__shard_key__", None)
+        if not shard_key:
+            raise ValueError(f"Model {model.__name__} of a sharded bind must declare __shard_key__")
+        return shard_key
+
+    def shard_id_for_instance(self, instance):
+        """
+        :param instance: The ORM object.
+        :return: The id of the shard the object belongs to.
+
+        :exception: ValueError if the shard key of the object is not set.
+        """
+        shard_key = self.get_shard_key(type(instance))
+        value = getattr(instance, shard_key, None)
+        if value is None:
+            raise ValueError(f"The shard key {shard_key} of {type(instance).__name__} must be set before it is saved")
+        return self.shard_id_for(value)
+
+    def shard_ids_for_criteria(self, model, whereclause, params=None):
+        """
+        Find the shards a WHERE clause can match, from the equality and IN conditions on the shard key
+        which are joined by AND. Any other clause may match rows of every shard.
+
+        :param model: The mapped class.
+        :param whereclause: The WHERE clause of the query, None for no filter.
+        :param params: The parameters the statement is executed with, e.g. the primary key of Session.get().
+        :return: The sorted list of shard ids.
+        """
+        column = getattr(model, self.get_shard_key(model)).expression
+        shard_ids = set(self.shard_ids)
+        for criterion in _iter_conjuncts(whereclause):
+            values = _get_shard_key_values(criterion, column, params)
+            if values is not None:
+                shard_ids &= {self.shard_id_for(value) for value in values}
+        return sorted(shard_ids)
+
+    @staticmethod
+    def is_primary_key_lookup(model, whereclause):
+        """
+        Whether a WHERE clause has an equality condition on each primary key column of a model, joined by AND,
+        e.g. the statement of Session.get(). The same primary key may exist on several shards.
+
+        :param model: The mapped class.
+        :param whereclause: The WHERE clause of the query, None for no filter.
+        """
+        primary_key = {(column.table, column.key) for column in inspect(model).primary_key}
+        for criterion in _iter_conjuncts(whereclause):
+            if isinstance(criterion, BinaryExpression) and criterion.operator is operators.eq:
+                primary_key.discard((getattr(criterion.left, "table", None), getattr(criterion.left, "key", None)))
+        return not primary_key
+
+    def fan_out(self, query, shard_ids=None):
+        """
+        Run a query on several shards in parallel, each shard on its own session and connection.
+
+        :param query: The ORM Query, the objects it returns are detached from the shard sessions.
+        :param shard_ids: The ids of the shards to query, defaults to all shards.
+        :return: The list of the results of each shard, in the order of shard_ids.
+        """
+        shard_ids = self.shard_ids if shard_ids is None else shard_ids
+        deadline = get_deadline()
+
+        def query_shard(shard_id):
+            with Session(bind=self.engines[shard_id]) as session:
+                return query.with_session(session).all()
+
+        with ThreadPoolExecutor(max_workers=len(shard_ids)) as executor:
+            futures = [executor.submit(run_with_deadline, deadline, query_shard, (shard_id,)) for shard_id in shard_ids]
+            return [future.result() for future in futures]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def stats(self):
+        return {
+            "bind_key": self.bind_key,
+            "shards": [engine.url.render_as_string(hide_password=True) for engine in self.engines],
+        }
+
+
+def _iter_conjuncts(clause):
+    """ Yield the conditions of a WHERE clause which are joined by AND. """
+    if clause is None:
+        return
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        for child in clause.clauses:
+            yield from _iter_conjuncts(child)
+    else:
+        yield clause
+
+
+def _get_shard_key_values(criterion, column, params=None):
+    """
+    :return: The values of a "shard key = value" or "shard key IN (values)" condition, None for any other condition.
+    """
+    if not isinstance(criterion, BinaryExpression) or not isinstance(criterion.right, BindParameter):
+        return None
+
+    left = criterion.left
+    if getattr(left, "key", None) != column.key or getattr(left, "table", None) is not column.table:
+        return None
+
+    if isinstance(params, dict) and criterion.right.key in params:
+        value = params[criterion.right.key]
+    else:
+        value = criterion.right.effective_value
+    if criterion.operator is operators.eq:
+        return [value]
+    if criterion.operator is operators.in_op and isinstance(value, (list, tuple)):
+        return list(value)
+    return None
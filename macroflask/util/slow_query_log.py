@@ -0,0 +1,174 @@
+import collections
+import re
+import threading
+import time
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+# the bind parameters of the DBAPI drivers: ?, %s, %(name)s, :name and $1
+_PARAMETER_RE = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_VALUES_LIST_RE = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+
+
+def fingerprint(statement):
+    """
+    Normalize a statement, the literals and bind parameters are replaced by '?'
+    and the lists of parameters, e.g. IN (?, ?, ?) or multi-row VALUES, are collapsed to '(?+)'.
+
+    :param statement: The SQL statement.
+    :return: The fingerprint of the statement.
+    """
+    statement = _WHITESPACE_RE.sub(" ", statement).strip()
+    statement = _STRING_RE.sub("?", statement)
+    statement = _PARAMETER_RE.sub("?", statement)
+    statement = _NUMBER_RE.sub("?", statement)
+    statement = _IN_LIST_RE.sub("(?+)", statement)
+    return _VALUES_LIST_RE.sub("(?+)", statement)
+
+
+class FingerprintStats:
+    def __init__(self, fingerprint, engine_name, sample_size):
+        """
+        The aggregated durations of the statements of one fingerprint.
+
+        :param fingerprint: The fingerprint of the statements.
+        :param engine_name: The name of the engine which executed the statements first.
+        :param sample_size: The number of the most recent durations kept for the percentiles.
+        """
+        self.fingerprint = fingerprint
+        self.engine_name = engine_name
+        self.count = 0
+        self.slow_count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.durations = collections.deque(maxlen=sample_size)
+
+    def record(self, duration, is_slow):
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.durations.append(duration)
+        if is_slow:
+            self.slow_count += 1
+
+    def percentile(self, percent):
+        durations = sorted(self.durations)
+        if not durations:
+            return 0
+        index = min(len(durations) - 1, int(round(percent / 100 * (len(durations) - 1))))
+        return durations[index]
+
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "engine": self.engine_name,
+            "count": self.count,
+            "slow_count": self.slow_count,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / self.count, 3) if self.count else 0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max_time * 1000, 3),
+        }
+
+
+class SlowQueryLog:
+    ORDER_FIELDS = ("total_ms", "count", "slow_count", "p99_ms", "max_ms")
+
+    def __init__(self, threshold_ms=200, max_entries=500, max_fingerprints=1000, sample_size=1000):
+        """
+        Record the statements slower than a threshold, and aggregate the durations of all statements by fingerprint.
+
+        :param threshold_ms: The duration in milliseconds above which a statement is recorded as slow.
+        :param max_entries: The number of the most recent slow statements kept.
+        :param max_fingerprints: The maximum number of aggregated fingerprints, the new fingerprints are
+            not aggregated once it is reached.
+        :param sample_size: The number of durations kept per fingerprint for the percentiles.
+        """
+        self.threshold_ms = threshold_ms
+        self.max_fingerprints = max_fingerprints
+        self.sample_size = sample_size
+        self.entries = collections.deque(maxlen=max_entries)
+        self.fingerprints = {}
+        self._fingerprint_cache = {}
+        self._lock = threading.Lock()
+
+    def _get_fingerprint(self, statement):
+        # the statements of the ORM are the same strings again and again, normalize each of them once
+        statement_fingerprint = self._fingerprint_cache.get(statement)
+        if statement_fingerprint is None:
+            if len(self._fingerprint_cache) >= 10000:
+                self._fingerprint_cache.clear()
+            statement_fingerprint = fingerprint(statement)
+            self._fingerprint_cache[statement] = statement_fingerprint
+        return statement_fingerprint
+
+    def record(self, engine_name, statement, duration, rowcount, request_uuid=None):
+        """
+        Record one executed statement.
+
+        :param engine_name: The name of the engine, e.g. 'write:database1'.
+        :param statement: The SQL statement.
+        :param duration: The duration of the statement in seconds.
+        :param rowcount: The number of rows of the cursor, -1 if unknown.
+        :param request_uuid: The uuid of the request which executed the statement.
+        :return: The entry dictionary if the statement is slow, otherwise None.
+        """
+        statement_fingerprint = self._get_fingerprint(statement)
+        is_slow = duration * 1000 >= self.threshold_ms
+
+        entry = None
+        with self._lock:
+            fingerprint_stats = self.fingerprints.get(statement_fingerprint)
+            if fingerprint_stats is None and len(self.fingerprints) < self.max_fingerprints:
+                fingerprint_stats = FingerprintStats(statement_fingerprint, engine_name, self.sample_size)
+                self.fingerprints[statement_fingerprint] = fingerprint_stats
+            if fingerprint_stats is not None:
+                fingerprint_stats.record(duration, is_slow)
+
+            if is_slow:
+                entry = {
+                    "time": time.time(),
+                    "fingerprint": statement_fingerprint,
+                    "engine": engine_name,
+                    "duration_ms": round(duration * 1000, 3),
+                    "rowcount": rowcount,
+                    "request_uuid": request_uuid,
+                }
+                self.entries.append(entry)
+        return entry
+
+    def get_entries(self, limit=100):
+        """ Return the most recent slow statements, the most recent first. """
+        with self._lock:
+            entries = list(self.entries)
+        return entries[::-1][:limit]
+
+    def get_aggregates(self, order_by="total_ms", limit=50):
+        """
+        Return the aggregates of the fingerprints.
+
+        :param order_by: The field to sort by in descending order, one of ORDER_FIELDS.
+        :param limit: The maximum number of fingerprints.
+        :return: The list of aggregate dictionaries.
+
+        :exception: ValueError if order_by is not supported.
+        """
+        if order_by not in self.ORDER_FIELDS:
+            raise ValueError(f"order_by must be one of {self.ORDER_FIELDS}")
+        with self._lock:
+            aggregates = [fingerprint_stats.to_dict() for fingerprint_stats in self.fingerprints.values()]
+        return sorted(aggregates, key=lambda item: item[order_by], reverse=True)[:limit]
+
+    def after_fork(self):
+        """ Start over in a forked child process, the lock may be held by a thread of the parent. """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.entries.clear()
+            self.fingerprints.clear()
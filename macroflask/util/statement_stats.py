@@ -0,0 +1,88 @@
+import time
+
+import sqlalchemy.event as raw_sa_event
+
+
+class StatementStats:
+    def __init__(self, request_uuid=None):
+        """
+        The SQL statements executed by one request.
+
+        :param request_uuid: The uuid of the request, g.req_uuid in Flask.
+        """
+        self.request_uuid = request_uuid
+        self.count = 0
+        self.db_time = 0.0
+        # number of executions of each statement, the bound parameters are not part of the statement
+        self.shapes = {}
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.db_time += duration
+        self.shapes[statement] = self.shapes.get(statement, 0) + 1
+
+    def repeated_statements(self, threshold):
+        """
+        Return the statements executed at least threshold times, most executed first.
+
+        :param threshold: The minimum number of executions.
+        :return: The list of (statement, count) tuples.
+        """
+        repeated = [(statement, count) for statement, count in self.shapes.items() if count >= threshold]
+        return sorted(repeated, key=lambda item: item[1], reverse=True)
+
+    def to_dict(self):
+        return {
+            "request_uuid": self.request_uuid,
+            "statements": self.count,
+            "db_time": round(self.db_time, 4),
+            "distinct_statements": len(self.shapes),
+        }
+
+
+class StatementTracker:
+    def __init__(self, router):
+        """
+        Time every SQL statement of the registered engines, the timings are recorded into
+        the StatementStats of the current request and passed to the listeners.
+
+        :param router: The LightSqlAlchemy object, which knows the StatementStats of the current request.
+        """
+        self.router = router
+        # callables called after each statement with (engine_name, statement, duration, rowcount, stats)
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def register_engine(self, name, engine):
+        """
+        Listen to the statements executed by an engine.
+
+        :param name: The name of the engine, e.g. 'write:database1'.
+        :param engine: The engine instance.
+        """
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self._after_cursor_execute(name, conn, cursor, statement)
+
+        raw_sa_event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        raw_sa_event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # a connection executes one statement at a time, also when the tasks of an event loop share a thread
+        conn.info["statement_start_time"] = time.perf_counter()
+
+    def _after_cursor_execute(self, name, conn, cursor, statement):
+        start_time = conn.info.pop("statement_start_time", None)
+        if start_time is None:
+            return
+        duration = time.perf_counter() - start_time
+
+        stats = self.router.get_statement_stats()
+        if stats is not None:
+            stats.record(statement, duration)
+
+        if self.listeners:
+            rowcount = getattr(cursor, "rowcount", -1)
+            for listener in self.listeners:
+                listener(name, statement, duration, rowcount, stats)
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Device(Base):
+    """ The toy model of the tests, each test fills the columns it needs. """
+    __tablename__ = "device"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+    vendor = Column(String(16))
+    status = Column(String(16))
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    """
+    Return a function creating a LightSqlAlchemy for the models of Base on a SQLite file of tmp_path,
+    with the tables created. The databases are disposed at the end of the test.
+
+    make_db(name="test", read_bind=False, bind_options=None, **kwargs):
+    name is the name of the database file, read_bind adds a read bind on the same file, bind_options are
+    merged into the db_config of the bind and kwargs are passed to LightSqlAlchemy.
+    """
+    dbs = []
+
+    def make(name="test", read_bind=False, bind_options=None, **kwargs):
+        url = f"sqlite:///{tmp_path / name}.db"
+        db_config = {"database1": {"url": url, "model_class": Base, **(bind_options or {})}}
+        if read_bind:
+            db_config["database1_read"] = {"url": url, "model_class": Base, "db_operation_type": "read"}
+        db = LightSqlAlchemy(db_config=db_config, **kwargs)
+        dbs.append(db)
+        Base.metadata.create_all(db.engines["write"]["database1"])
+        return db
+
+    yield make
+    for db in dbs:
+        db.dispose_engine()
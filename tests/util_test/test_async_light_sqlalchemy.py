@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from sqlalchemy import Column, Integer, String, func, select
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.util.async_light_sqlalchemy import AsyncLightSqlAlchemy
+
+pytest.importorskip("aiosqlite")
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Item(Base):
+    __tablename__ = "item"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+def test_async_sessions_across_event_loops(tmp_path):
+    db_config = {
+        "database1": {"url": f"sqlite:///{tmp_path / 'write.db'}", "model_class": Base},
+        "database1_read": {"url": f"sqlite:///{tmp_path / 'read.db'}", "model_class": Base,
+                           "db_operation_type": "read"},
+    }
+    db = AsyncLightSqlAlchemy(db_config=db_config, consistency_options={"read_your_writes": True})
+
+    async def setup():
+        await db.connect_engines()
+        for engine in (db.engines["write"]["database1"], db.engines["read"]["database1_read"]):
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+
+    async def insert(index):
+        async with db.get_db_session() as session:
+            session.add(Item(name=str(index)))
+
+    async def count():
+        async with db.get_db_session("read") as session:
+            return (await session.execute(select(func.count()).select_from(Item))).scalar()
+
+    async def run():
+        await asyncio.gather(*(insert(index) for index in range(10)))
+        # read from the primary just after the writes
+        sticky_count = await count()
+        db.set_consistency_options(read_your_writes=False)
+        return sticky_count, await count()
+
+    # each asyncio.run() starts a new event loop, the pools are rebound to it
+    asyncio.run(setup())
+    assert db.is_ready
+    assert asyncio.run(run()) == (10, 0)
+    asyncio.run(db.dispose_engine())
+
+
+def test_async_stream_closes_its_session(tmp_path):
+    db = AsyncLightSqlAlchemy(db_config={"database1": {"url": f"sqlite:///{tmp_path / 'stream.db'}",
+                                                       "model_class": Base}})
+
+    async def run():
+        await db.connect_engines()
+        async with db.engines["write"]["database1"].begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        await db.bulk_insert(Item, [{"id": i, "name": str(i)} for i in range(1, 11)])
+
+        ids = [item.id async for item in db.stream(select(Item), batch_size=3, db_operation_type="write")]
+        names = db.stream(select(Item.name), batch_size=3, db_operation_type="write")
+        first_name = await names.__anext__()
+        await names.aclose()
+        has_session = db.sessions["write"].registry.has()
+
+        async with db.get_db_session() as session:
+            count = len([row async for row in db.stream(select(Item.id), db_operation_type="write")])
+            kept = db.sessions["write"]() is session
+        await db.dispose_engine()
+        return ids, first_name, has_session, count, kept
+
+    assert asyncio.run(run()) == (list(range(1, 11)), ("1",), False, 10, True)
@@ -0,0 +1,33 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects import mysql, postgresql
+
+from macroflask.util.bulk_write import build_upsert_statement
+from tests.conftest import Device
+
+
+def test_bulk_insert_and_upsert(make_db):
+    db = make_db()
+    rows = ({"id": index, "name": f"device{index}", "status": "up"} for index in range(2500))
+    result = db.bulk_insert(Device, rows, chunk_size=1000)
+    assert result["rows"] == 2500
+    assert result["chunks"] == 3
+
+    rows = [{"id": index, "name": f"device{index}", "status": "down"} for index in range(2000, 3000)]
+    result = db.bulk_upsert(Device, rows, chunk_size=300)
+    assert result["chunks"] == 4
+
+    with db.get_db_session() as session:
+        assert session.execute(select(func.count()).select_from(Device)).scalar() == 3000
+        down_count = session.execute(
+            select(func.count()).select_from(Device).where(Device.status == "down")).scalar()
+        assert down_count == 1000
+
+
+def test_upsert_statement_of_each_dialect():
+    table = Device.__table__
+    statement = build_upsert_statement(table, "mysql", ["id", "name", "status"], update_columns=["status"])
+    assert "ON DUPLICATE KEY UPDATE status = VALUES(status)" in str(statement.compile(dialect=mysql.dialect()))
+
+    statement = build_upsert_statement(table, "postgresql", ["id", "name", "status"])
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (id) DO UPDATE SET name = excluded.name, status = excluded.status" in sql
@@ -0,0 +1,57 @@
+import pytest
+import sqlalchemy.exc as raw_sa_exc
+from sqlalchemy import text
+
+from macroflask.util import connection_budget
+
+pytestmark = pytest.mark.skipif(connection_budget.fcntl is None, reason="the connection budget requires fcntl")
+
+
+@pytest.fixture
+def make_budget_db(make_db, tmp_path):
+    def make(**budget_options):
+        budget = {"name": "budget-test", "path": str(tmp_path / "budget.lock"), **budget_options}
+        return make_db("budget", bind_options={"connection_budget": budget})
+    return make
+
+
+def test_budget_limits_connections(make_budget_db):
+    db = make_budget_db(max_connections=1, timeout=0.2)
+    engine = db.engines["write"]["database1"]
+    budget = db.connection_budgets["budget-test"]
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        # the only slot is taken, the second connection times out like an exhausted pool
+        with pytest.raises(raw_sa_exc.TimeoutError):
+            engine.connect()
+        assert budget.stats()["held"] == 1
+
+    # the pooled connection keeps its slot, it is released when the connection is closed
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    engine.dispose()
+    assert budget.stats()["held"] == 0
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+    stats = db.get_pool_metrics()["connection_budgets"][0]
+    assert stats["timeouts"] == 1 and stats["waits"] == 1
+
+
+def test_budget_released_under_pressure(make_budget_db):
+    db = make_budget_db(max_connections=3, min_connections=1, pressure_window=5)
+    engine = db.engines["write"]["database1"]
+    budget = db.connection_budgets["budget-test"]
+
+    first, second = engine.connect(), engine.connect()
+    assert budget.stats()["held"] == 2
+    # another process waiting for a slot puts the budget under pressure
+    budget._signal_pressure()
+    assert budget.is_under_pressure()
+
+    # the idle connections are closed when they are checked in, down to min_connections
+    first.close()
+    second.close()
+    stats = budget.stats()
+    assert stats["held"] == 1 and stats["released_under_pressure"] == 1
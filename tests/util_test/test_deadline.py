@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from sqlalchemy import create_engine, text
+
+from macroflask.util.concurrency_strategy import (
+    ConcurrencyContext, CoroutineStrategy, DEADLINE_EXCEEDED_MSG, ThreadPoolStrategy)
+from macroflask.util.deadline import Deadline, DeadlineExceeded, cap_timeout, deadline_scope, get_deadline
+from macroflask.util.engine_profile import get_engine_profile
+
+ENDLESS_QUERY = "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) SELECT count(*) FROM r"
+
+
+def test_cap_timeout():
+    assert cap_timeout(10) == 10
+    with deadline_scope(5) as deadline:
+        assert get_deadline() is deadline
+        assert 4 < cap_timeout(10) <= 5
+        assert cap_timeout(1) == 1
+        assert 4 < cap_timeout() <= 5
+    assert get_deadline() is None
+
+    with deadline_scope(Deadline(0)):
+        try:
+            cap_timeout(10)
+        except DeadlineExceeded:
+            pass
+        else:
+            raise AssertionError("DeadlineExceeded is expected")
+
+
+def test_sqlite_statement_is_interrupted(tmp_path):
+    profile = get_engine_profile(f"sqlite:///{tmp_path / 'deadline.db'}")
+    engine = create_engine(profile.url, **profile.get_engine_options())
+    profile.configure_engine(engine)
+
+    start_time = time.monotonic()
+    with deadline_scope(0.2):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text(ENDLESS_QUERY))
+        except Exception as e:
+            assert "interrupted" in str(e)
+        else:
+            raise AssertionError("The statement should be interrupted")
+    assert time.monotonic() - start_time < 2
+
+    # the progress handler is removed when the connection is checked in
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT 1")).scalar() == 1
+    engine.dispose()
+
+
+def test_strategies_stop_at_deadline():
+    def slow_task(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    async def slow_coroutine(seconds):
+        await asyncio.sleep(seconds)
+        return seconds
+
+    start_time = time.monotonic()
+    results = ConcurrencyContext(ThreadPoolStrategy()).execute_tasks(
+        [(slow_task, (0.01,)), (slow_task, (1,))], worker_count=2, deadline=Deadline(0.3))
+    assert sorted(results, key=str) == [(False, DEADLINE_EXCEEDED_MSG), (True, 0.01)]
+
+    results = ConcurrencyContext(CoroutineStrategy()).execute_tasks(
+        [(slow_coroutine, (0.01,)), (slow_coroutine, (1,))], deadline=Deadline(0.3))
+    assert results == [(True, 0.01), (False, DEADLINE_EXCEEDED_MSG)]
+    assert time.monotonic() - start_time < 1.5
@@ -0,0 +1,61 @@
+import json
+
+from flask import Blueprint, Flask
+
+from macroflask.system.model_ext.dynamic_api_manager import DynamicBlueprintManager
+from macroflask.system.model_ext.query_processor import QueryRequest
+
+
+class Device:
+    """ Streams three rows after validating the query request like ModelExtMixin.stream_all. """
+    batch_sizes = []
+    closed = []
+
+    @classmethod
+    def stream_all(cls, request_body, batch_size=1000):
+        cls.batch_sizes.append(batch_size)
+        QueryRequest(request_body, require_pagination=False)
+        try:
+            for i in range(1, 4):
+                yield {"id": i}
+        finally:
+            cls.closed.append(batch_size)
+
+
+def export(body):
+    app = Flask(__name__)
+    manager = DynamicBlueprintManager(Blueprint("export", __name__), Device, {})
+    with app.test_request_context(json=body):
+        response = manager._export()
+        if isinstance(response, tuple):
+            return response[1], response[0].json
+        return response.status_code, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_export():
+    Device.batch_sizes.clear()
+    assert export({}) == (200, [{"id": 1}, {"id": 2}, {"id": 3}])
+    assert export({"batch_size": 50})[0] == 200
+    assert export({"batch_size": 10 ** 9})[0] == 200
+    assert Device.batch_sizes == [1000, 50, DynamicBlueprintManager.MAX_EXPORT_BATCH_SIZE]
+
+    for batch_size in (0, -1, "100", 1.5, True):
+        status_code, data = export({"batch_size": batch_size})
+        assert status_code == 400 and data["status"] == "error"
+    assert len(Device.batch_sizes) == 3
+
+    # the request is validated before the response starts
+    status_code, data = export({"relations": [{"name": "site", "strategy": "lazy"}]})
+    assert status_code == 400 and data["status"] == "error"
+
+
+def test_export_releases_rows_on_disconnect():
+    Device.closed.clear()
+    app = Flask(__name__)
+    manager = DynamicBlueprintManager(Blueprint("export", __name__), Device, {})
+    with app.test_request_context(json={"batch_size": 7}):
+        response = manager._export()
+        lines = iter(response.response)
+        assert json.loads(next(lines)) == {"id": 1}
+        response.close()
+    assert Device.closed == [7]
@@ -0,0 +1,67 @@
+import os
+import time
+
+import pytest
+
+from macroflask.util.light_logging import MacroFlaskLogger
+from tests.conftest import Device
+
+
+def run_in_child(func):
+    """ Fork, run func in the child and return its exit code, 0 means func returned True. """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            code = 0 if func() else 1
+        except Exception:
+            code = 2
+        os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="os.fork is not available")
+def test_engines_after_fork(make_db):
+    db = make_db()
+    engine = db.engines["write"]["database1"]
+    with db.get_db_session() as session:
+        session.add(Device(id=1))
+    parent_pool = engine.pool
+    parent_checkouts = db.pool_metrics["write:database1"].checkouts
+
+    def child():
+        # the child gets its own pool and metrics, and the session of the parent is forgotten
+        with db.get_db_session() as session:
+            found = session.get(Device, 1) is not None
+        metrics = db.pool_metrics["write:database1"]
+        return found and engine.pool is not parent_pool and metrics.checkouts < parent_checkouts + 1
+
+    assert run_in_child(child) == 0
+    assert engine.pool is parent_pool
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="os.fork is not available")
+def test_logger_after_fork(tmp_path):
+    config = {
+        "formatters": {"default": {"format": "%(name)s %(message)s"}},
+        "handlers": {"app": {"class": "logging.handlers.RotatingFileHandler", "filename": "app.log",
+                             "formatter": "default"}},
+    }
+    logging_manager = MacroFlaskLogger(config, path=str(tmp_path))
+    logger = logging_manager.get_logger("app")
+    logger.info("from parent")
+
+    # the listener of the parent writes the record before the fork
+    time.sleep(0.2)
+
+    def child():
+        logger.info("from child")
+        # the listener of the child writes the records it has received before it stops
+        logging_manager.shutdown()
+        return True
+
+    assert run_in_child(child) == 0
+    logger.info("from parent again")
+    logging_manager.shutdown()
+    with open(tmp_path / "app.log", encoding="utf-8") as log_file:
+        assert log_file.read().splitlines() == ["app from parent", "app from child", "app from parent again"]
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.system.model_ext.index_advisor import IndexAdvisor
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+from macroflask.util.query_shape_stats import QueryShapeStats
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class DeviceLog(Base):
+    __tablename__ = "device_log"
+    id = Column(Integer, primary_key=True)
+    vendor = Column(String(16))
+    created_at = Column(DateTime)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(QueryProcessor, "shape_stats", QueryShapeStats(QueryProcessor.shape_stats.key_fields))
+    db = LightSqlAlchemy(db_config={"database1": {"url": f"sqlite:///{tmp_path / 'advisor.db'}", "model_class": Base}})
+    Base.metadata.create_all(db.engines["write"]["database1"])
+    start = datetime(2024, 8, 1)
+    db.bulk_insert(DeviceLog, [{"id": i, "vendor": "cisco" if i % 2 else "juniper",
+                                "created_at": start + timedelta(minutes=i)} for i in range(1, 21)])
+    yield db
+    db.dispose_engine()
+
+
+def process(db, filters, sorting=None):
+    body = {"pagination": {"page": 1, "page_count": 5}, "filters": {"and": filters}, "sorting": sorting or {}}
+    with db.get_db_session() as session:
+        QueryProcessor(DeviceLog, session, None, QueryRequest(body)).process()
+
+
+def test_index_advice(db):
+    recent_cisco = ([{"field": "vendor", "op": "==", "value": "cisco"},
+                     {"field": "created_at", "op": ">", "value": datetime(2024, 8, 1, 0, 5)}],
+                    {"sort_by": "created_at", "order": "desc"})
+    for _ in range(3):
+        process(db, *recent_cisco)
+    process(db, [{"field": "id", "op": "in", "value": [1, 2]}])
+
+    shapes = [data for _, data in QueryProcessor.shape_stats.get_top(order_by="count")]
+    assert shapes[0]["filters"] == (("created_at", ">"), ("vendor", "==")) and shapes[0]["count"] == 3
+    assert shapes[0]["sorting"] == (("created_at", "desc"),)
+
+    advice = IndexAdvisor(db).advise(order_by="count")
+    assert advice[0]["full_scan"] and advice[0]["sort_without_index"]
+    assert advice[0]["suggested_index"] == ["vendor", "created_at"]
+    # the primary key serves the lookup by id
+    assert not advice[1]["full_scan"] and advice[1]["suggested_index"] is None
+
+    with db.engines["write"]["database1"].begin() as connection:
+        connection.exec_driver_sql(advice[0]["create_index"])
+    advice = IndexAdvisor(db).advise(order_by="count", limit=1)
+    assert not advice[0]["full_scan"] and not advice[0]["sort_without_index"]
+    assert advice[0]["suggested_index"] is None and ["vendor", "created_at"] in advice[0]["indexes"]
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class DeviceLog(Base):
+    __tablename__ = "device_log"
+    id = Column(Integer, primary_key=True)
+    level = Column(String(16))
+    created_at = Column(DateTime)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = LightSqlAlchemy(db_config={"database1": {"url": f"sqlite:///{tmp_path / 'keyset.db'}", "model_class": Base}})
+    Base.metadata.create_all(db.engines["write"]["database1"])
+    start = datetime(2024, 8, 1)
+    # the logs 1-5, 6-10, ... share the same created_at, the primary key breaks the ties
+    db.bulk_insert(DeviceLog, [{"id": i, "level": "error" if i % 3 == 0 else "info",
+                                "created_at": start + timedelta(minutes=(i - 1) // 5)} for i in range(1, 24)])
+    yield db
+    db.dispose_engine()
+
+
+def read_page(db, pagination, sorting=None, need_fields=None):
+    body = {"pagination": pagination, "sorting": sorting or {}, "need_fields": need_fields or ["id"]}
+    with db.get_db_session() as session:
+        processor = QueryProcessor(DeviceLog, session, None, QueryRequest(body))
+        rows = processor.process()
+    return [row["id"] for row in rows], processor.next_cursor, processor.prev_cursor
+
+
+def test_cursor_pages(db):
+    sorting = {"sort_by": "created_at", "order": "desc"}
+    expected = sorted(range(1, 24), key=lambda i: ((i - 1) // 5, i), reverse=True)
+
+    pages, cursor = [], None
+    while True:
+        ids, next_cursor, prev_cursor = read_page(db, {"after": cursor, "page_count": 4}, sorting)
+        assert (prev_cursor is None) == (cursor is None)
+        pages.append((ids, prev_cursor))
+        if next_cursor is None:
+            break
+        cursor = next_cursor
+    assert [i for ids, _ in pages for i in ids] == expected
+
+    # the previous page of the third page is the second one
+    ids, _, _ = read_page(db, {"before": pages[2][1], "page_count": 4}, sorting)
+    assert ids == pages[1][0]
+    # 'before': null is the last page
+    ids, next_cursor, prev_cursor = read_page(db, {"before": None, "page_count": 4}, sorting)
+    assert ids == expected[-4:] and next_cursor is None and prev_cursor is not None
+
+
+def test_cursor_mixed_orders(db):
+    sorting = [{"field": "level", "order": "asc"}, {"field": "created_at", "order": "desc"}]
+    body = {"pagination": {"after": None, "page_count": 5}, "sorting": sorting, "need_fields": ["id"]}
+    with db.get_db_session() as session:
+        processor = QueryProcessor(DeviceLog, session, None, QueryRequest(body))
+        first_page = [row["id"] for row in processor.process()]
+        ids, _, _ = read_page(db, {"after": processor.next_cursor, "page_count": 5}, sorting)
+    assert first_page == [21, 18, 15, 12, 9] and ids == [6, 3, 23, 22, 20]
+
+    # a cursor made for another sorting is refused
+    with pytest.raises(ValueError):
+        read_page(db, {"after": processor.next_cursor, "page_count": 5}, {"sort_by": "id", "order": "asc"})
+
+
+@pytest.mark.parametrize("order", ["asc", "desc"])
+def test_cursor_pages_past_null(db, order):
+    # the logs 6-12 have no created_at, NULL is the lowest value
+    with db.get_db_session() as session:
+        session.query(DeviceLog).filter(DeviceLog.id.between(6, 12)).update({"created_at": None})
+    sorting = {"sort_by": "created_at", "order": order}
+    expected = sorted(range(1, 24), key=lambda i: (False, 0, i) if 6 <= i <= 12 else (True, (i - 1) // 5, i),
+                      reverse=order == "desc")
+
+    pages, cursor = [], None
+    while True:
+        ids, cursor, prev_cursor = read_page(db, {"after": cursor, "page_count": 4}, sorting)
+        pages.append((ids, prev_cursor))
+        if cursor is None:
+            break
+    assert [i for ids, _ in pages for i in ids] == expected
+
+    # back from the last page, across the NULL values
+    ids, cursor = [], pages[-1][1]
+    while cursor is not None:
+        page_ids, _, cursor = read_page(db, {"before": cursor, "page_count": 4}, sorting)
+        ids = page_ids + ids
+    assert ids + pages[-1][0] == expected
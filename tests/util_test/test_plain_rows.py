@@ -0,0 +1,34 @@
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from tests.conftest import Device
+
+
+def test_plain_rows(make_db):
+    db = make_db()
+    db.bulk_insert(Device, [{"id": i, "vendor": "cisco" if i % 2 else "juniper", "name": f"router-{i}"}
+                            for i in range(1, 11)])
+    plain_fields = ["id", "name"]
+
+    def process(body, session):
+        body = {"pagination": {"page": 1, "page_count": 3}, "sorting": {"sort_by": "id", "order": "desc"}, **body}
+        processor = QueryProcessor(Device, session, None, QueryRequest(body), plain_fields=plain_fields)
+        return processor.process(), processor
+
+    with db.get_db_session("write") as session:
+        rows, _ = process({}, session)
+        assert rows == [{"id": 10, "name": "router-10"}, {"id": 9, "name": "router-9"}, {"id": 8, "name": "router-8"}]
+        # no ORM object is loaded
+        assert len(session.identity_map) == 0
+
+        # need_fields win over the plain fields
+        rows, _ = process({"need_fields": ["vendor"], "with_total": "window"}, session)
+        assert rows == [{"vendor": "juniper"}, {"vendor": "cisco"}, {"vendor": "juniper"}]
+
+        rows, processor = process({"pagination": {"after": None, "page_count": 4}, "with_total": True,
+                                   "filters": {"and": [{"field": "vendor", "op": "==", "value": "cisco"}]}}, session)
+        assert [row["id"] for row in rows] == [9, 7, 5, 3] and processor.total == 5
+        assert set(rows[0]) == {"id", "name"} and processor.next_cursor is not None
+
+        # the pending changes are flushed before the rows are read
+        session.add(Device(id=11, vendor="cisco", name="router-11"))
+        rows, _ = process({}, session)
+        assert rows[0] == {"id": 11, "name": "router-11"}
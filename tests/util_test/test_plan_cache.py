@@ -0,0 +1,56 @@
+import pytest
+
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from macroflask.util.plan_cache import PlanCache
+from tests.conftest import Device
+
+
+@pytest.fixture
+def db(make_db, monkeypatch):
+    monkeypatch.setattr(QueryProcessor, "plan_cache", PlanCache(max_size=3))
+    db = make_db()
+    db.bulk_insert(Device, [{"id": i, "vendor": "cisco" if i % 2 else "juniper", "name": f"router-{i}"}
+                            for i in range(1, 21)])
+    return db
+
+
+def read(db, filters, page=1, need_fields=None, pagination=None):
+    body = {"pagination": pagination or {"page": page, "page_count": 3}, "filters": filters,
+            "sorting": {"sort_by": "id", "order": "desc"}, "need_fields": need_fields or []}
+    with db.get_db_session() as session:
+        processor = QueryProcessor(Device, session, None, QueryRequest(body))
+        rows = processor.process()
+        ids = [row["id"] if isinstance(row, dict) else row.id for row in rows]
+        # the query built with the values of the request reads the same rows, cursor pagination reads one more
+        expected = QueryProcessor(Device, session, None, QueryRequest(body)).build_query().all()
+        assert ids == [row.id for row in expected][:3]
+    return ids, processor.next_cursor
+
+
+def test_one_plan_per_shape(db):
+    plan_cache = QueryProcessor.plan_cache
+
+    def vendor_in(vendors, name):
+        return {"and": [{"field": "vendor", "op": "in", "value": vendors},
+                        {"or": [{"field": "name", "op": "like", "value": name}, {"field": "id", "op": "<", "value": 3}]}]}
+
+    assert read(db, vendor_in(["cisco"], "router-1"))[0] == [19, 17, 15]
+    assert read(db, vendor_in(["cisco", "juniper"], "router-2"))[0] == [20, 2, 1]
+    assert read(db, vendor_in(["cisco", "juniper"], "router-2"), page=2)[0] == []
+    assert read(db, vendor_in([], "router"))[0] == []
+    assert plan_cache.stats()["plans"] == 1 and plan_cache.hits == 3 and plan_cache.misses == 1
+
+    # a filter without a value is left out of the shape
+    assert read(db, {"and": [{"field": "vendor", "op": "==", "value": None}]})[0] == [20, 19, 18]
+    assert read(db, {})[0] == [20, 19, 18]
+    assert plan_cache.stats()["plans"] == 2
+
+    # the selected fields and the cursor are part of the shape
+    assert read(db, {}, need_fields=["id", "name"])[0] == [20, 19, 18]
+    ids, cursor = read(db, vendor_in(["juniper"], "router"), need_fields=["id"], pagination={"after": None, "page_count": 3})
+    assert ids == [20, 18, 16]
+    ids, _ = read(db, vendor_in(["juniper"], "router"), need_fields=["id"], pagination={"after": cursor, "page_count": 3})
+    assert ids == [14, 12, 10]
+
+    stats = plan_cache.stats()
+    assert stats["plans"] == 3 and stats["evictions"] == 2 and stats["hit_rate"] == 0.4444
@@ -0,0 +1,28 @@
+import time
+
+from sqlalchemy import create_engine, text
+
+from macroflask.util.pool_metrics import PoolMetrics
+
+
+def test_pool_metrics(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'metrics.db'}", pool_recycle=0.05)
+    metrics = PoolMetrics("write:database1", engine)
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        assert metrics.snapshot()["checked_out"] == 1
+
+    time.sleep(0.1)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    with engine.connect() as connection:
+        connection.invalidate()
+
+    snapshot = metrics.snapshot()
+    assert snapshot["checkouts"] == 3
+    assert snapshot["checkout_wait"]["count"] == 3
+    assert snapshot["connect_latency"]["count"] == 2
+    assert snapshot["recycles"] == 1
+    assert snapshot["invalidations"] == 1
+    assert snapshot["checked_out"] == 0
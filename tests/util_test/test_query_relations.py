@@ -0,0 +1,105 @@
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, String, event
+from sqlalchemy.orm import DeclarativeBase, relationship
+
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Site(Base):
+    __tablename__ = "site"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    devices = relationship("Device", back_populates="site", order_by="Device.id")
+
+
+class Device(Base):
+    __tablename__ = "device"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+    site_id = Column(Integer, ForeignKey("site.id"))
+    site = relationship(Site, back_populates="devices")
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = LightSqlAlchemy(db_config={"database1": {"url": f"sqlite:///{tmp_path / 'relations.db'}", "model_class": Base}})
+    engine = db.engines["write"]["database1"]
+    Base.metadata.create_all(engine)
+    db.bulk_insert(Site, [{"id": 1, "name": "paris"}, {"id": 2, "name": "tokyo"}])
+    db.bulk_insert(Device, [{"id": i, "name": f"router-{i}", "site_id": i % 3 or None} for i in range(1, 10)])
+
+    db.statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: db.statements.append(args[2]))
+    yield db
+    db.dispose_engine()
+
+
+def process(db, model, body):
+    body = {"pagination": {"page": 1, "page_count": 4}, "sorting": {"sort_by": "id", "order": "desc"}, **body}
+    with db.get_db_session() as session:
+        processor = QueryProcessor(model, session, None, QueryRequest(body))
+        db.statements.clear()
+        return [{"id": row.id, **processor.get_relation_data(row)} if not isinstance(row, dict) else row
+                for row in processor.process()]
+
+
+def test_relation_strategies(db):
+    # a many-to-one relation is joined, its fields are loaded in the same statement
+    rows = process(db, Device, {"relations": [{"name": "site", "fields": ["name"]}]})
+    assert rows == [{"id": 9, "site": None}, {"id": 8, "site": {"name": "tokyo"}},
+                    {"id": 7, "site": {"name": "paris"}}, {"id": 6, "site": None}]
+    assert len(db.statements) == 1 and "JOIN site" in db.statements[0]
+
+    # a collection is loaded by one more statement for the whole page
+    rows = process(db, Site, {"relations": ["devices"]})
+    assert [[device["id"] for device in row["devices"]] for row in rows] == [[2, 5, 8], [1, 4, 7]]
+    assert len(db.statements) == 2
+
+    rows = process(db, Device, {"relations": [{"name": "site", "strategy": "selectin"}]})
+    assert rows[1] == {"id": 8, "site": {"id": 2, "name": "tokyo"}} and len(db.statements) == 2
+
+    with pytest.raises(ValueError):
+        process(db, Device, {"relations": ["owner"]})
+    with pytest.raises(ValueError):
+        QueryRequest({"pagination": {"page": 1, "page_count": 4}, "relations": [{"name": "site", "strategy": "lazy"}]})
+
+
+def test_related_fields(db):
+    rows = process(db, Device, {"need_fields": ["id", "site.name"]})
+    assert rows == [{"id": 9, "site.name": None}, {"id": 8, "site.name": "tokyo"},
+                    {"id": 7, "site.name": "paris"}, {"id": 6, "site.name": None}]
+    assert len(db.statements) == 1
+
+    rows = process(db, Device, {"need_fields": ["site.name", "count(id)"], "group_by": ["site.name"], "sorting": {}})
+    assert sorted(rows, key=lambda row: row["site.name"] or "") == \
+        [{"site.name": None, "count(id)": 3}, {"site.name": "paris", "count(id)": 3},
+         {"site.name": "tokyo", "count(id)": 3}]
+
+    # only the fields of many-to-one relations can be selected
+    with pytest.raises(ValueError):
+        process(db, Site, {"need_fields": ["devices.name"]})
+
+
+def test_sort_by_label_and_related_field(db):
+    # the shape of the request is recorded after the rows are read, whatever the sorting fields
+    rows = process(db, Device, {"need_fields": ["site_id", "count(id)"], "group_by": ["site_id"],
+                                "sorting": {"sort_by": "count(id)", "order": "desc"}})
+    assert sorted(row["count(id)"] for row in rows) == [3, 3, 3]
+
+    rows = process(db, Device, {"need_fields": ["id", "site.name"], "sorting": [{"field": "site.name", "order": "asc"},
+                                                                               {"field": "id", "order": "desc"}]})
+    assert rows == [{"id": 9, "site.name": None}, {"id": 6, "site.name": None}, {"id": 3, "site.name": None},
+                    {"id": 7, "site.name": "paris"}]
+
+    # a related field only used by the sorting is joined as well
+    rows = process(db, Device, {"need_fields": ["id"], "sorting": {"sort_by": "site.name", "order": "desc"}})
+    assert {row["id"] for row in rows[:3]} == {2, 5, 8}
+
+    shapes = {data["sorting"] for _, data in QueryProcessor.shape_stats.get_top(limit=1000)}
+    assert (("count(id)", "desc"),) in shapes and (("site.name", "asc"), ("id", "desc")) in shapes
+    assert (("site.name", "desc"),) in shapes
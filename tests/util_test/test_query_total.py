@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+from sqlalchemy import event
+
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from tests.conftest import Device
+
+
+@pytest.fixture
+def db(make_db):
+    db = make_db()
+    db.bulk_insert(Device, [{"id": i, "vendor": "cisco" if i % 4 else "juniper"} for i in range(1, 42)])
+    return db
+
+
+def process(db, with_total, page=1, need_fields=None, **body):
+    body.update({"pagination": {"page": page, "page_count": 5}, "need_fields": need_fields or [],
+                 "with_total": with_total})
+    with db.get_db_session() as session:
+        processor = QueryProcessor(Device, session, None, QueryRequest(body))
+        rows = processor.process()
+        ids = [row.get("id") if isinstance(row, dict) else row.id for row in rows]
+    return ids, processor.total, processor.total_is_estimate
+
+
+@pytest.mark.parametrize("with_total", [True, "window"])
+def test_exact_totals(db, with_total):
+    juniper = {"and": [{"field": "vendor", "op": "==", "value": "juniper"}]}
+    assert process(db, with_total, filters=juniper, need_fields=["id"]) == ([4, 8, 12, 16, 20], 10, False)
+    assert process(db, with_total, page=2, sorting={"sort_by": "id", "order": "asc"}) == \
+        ([6, 7, 8, 9, 10], 41, False)
+    # a page past the end still has the total
+    assert process(db, with_total, page=20, filters=juniper) == ([], 10, False)
+    assert process(db, with_total, group_by=["vendor"], need_fields=["vendor", "count(id)"])[1] == 2
+
+
+def test_estimated_total(db):
+    # no statistics yet, the exact count is cached
+    assert process(db, "estimate")[1:] == (41, False)
+    with db.engines["write"]["database1"].begin() as connection:
+        connection.exec_driver_sql("ANALYZE")
+        connection.exec_driver_sql("DELETE FROM device WHERE id > 40")
+    # the statistics of ANALYZE lag behind the table
+    assert process(db, "estimate")[1:] == (41, True)
+
+    cisco = {"and": [{"field": "vendor", "op": "==", "value": "cisco"}]}
+    assert process(db, "estimate", filters=cisco)[1:] == (30, False)
+    with db.engines["write"]["database1"].begin() as connection:
+        connection.exec_driver_sql("DELETE FROM device WHERE id = 1")
+    assert process(db, "estimate", filters=cisco)[1:] == (30, True)
+    assert process(db, True, filters=cisco)[1:] == (29, False)
+
+    with pytest.raises(ValueError):
+        QueryRequest({"pagination": {"page": 1, "page_count": 5}, "with_total": "approximate"})
+
+
+def test_exact_total_session(db, make_db):
+    read_db = make_db(read_bind=True)
+    count_sessions = []
+
+    @event.listens_for(read_db.sessions["read"].session_factory, "after_begin")
+    def record_session(session, transaction, connection):
+        if threading.current_thread().name.startswith("query-total"):
+            count_sessions.append(session)
+
+    with read_db.get_db_session("read") as session:
+        for _ in range(2):
+            processor = QueryProcessor(Device, session, None, QueryRequest(
+                {"pagination": {"page": 1, "page_count": 5}, "with_total": True}))
+            processor.process()
+            assert processor.total == 41
+    # the counts ran on the shared executor, in new sessions of the read sessions
+    assert len(count_sessions) == 2 and count_sessions[0] is not session
+    assert QueryProcessor._total_executor is not None
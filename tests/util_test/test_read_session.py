@@ -0,0 +1,60 @@
+from sqlalchemy import Column, Integer
+from sqlalchemy.orm import DeclarativeBase
+
+from tests.conftest import Device
+
+
+def create_db(make_db):
+    db = make_db("read", read_bind=True)
+    with db.get_db_session() as session:
+        session.add_all([Device(id=1, name="router"), Device(id=2, name="switch")])
+    return db
+
+
+def test_read_session_is_read_only(make_db):
+    db = create_db(make_db)
+    try:
+        with db.get_db_session("read") as session:
+            session.add(Device(id=3, name="firewall"))
+            session.flush()
+    except Exception as e:
+        assert "readonly" in str(e)
+    else:
+        raise AssertionError("The read session should not write")
+
+    # the connection is writable again once it is back in the pool
+    read_engine = db.engines["read"]["database1_read"]
+    with read_engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO device (id, name) VALUES (3, 'firewall')")
+
+    with db.get_db_session("read") as session:
+        assert session.get(Device, 3).name == "firewall"
+
+
+def test_fetch_plain_rows(make_db):
+    db = create_db(make_db)
+    with db.get_db_session("read") as session:
+        rows = db.fetch_plain_rows(session.query(Device).filter(Device.id > 1))
+        assert rows == [{"id": 2, "name": "switch", "vendor": None, "status": None}]
+        assert len(session.identity_map) == 0
+
+        rows = db.fetch_plain_rows(session.query(Device.name).order_by(Device.id))
+        assert rows == [{"name": "router"}, {"name": "switch"}]
+
+
+def test_read_operation_type(make_db):
+    class OtherBase(DeclarativeBase):
+        pass
+
+    class Log(OtherBase):
+        __tablename__ = "log"
+        id = Column(Integer, primary_key=True)
+
+    db = create_db(make_db)
+    assert db.get_read_operation_type(Device) == "read"
+    assert db.get_read_operation_type(Device, read_from_primary=True) == "write"
+    # a model without a read bind stays on the primary
+    assert db.get_read_operation_type(Log) == "write"
+
+    db = make_db("write")
+    assert db.get_read_operation_type(Device) == "write"
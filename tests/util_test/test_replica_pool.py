@@ -0,0 +1,77 @@
+from sqlalchemy import create_engine
+
+from macroflask.util.replica_pool import ReplicaPool
+
+
+def _make_engines(count):
+    return [create_engine("sqlite://") for _ in range(count)]
+
+
+def test_round_robin_policy():
+    engines = _make_engines(3)
+    pool = ReplicaPool("database1", engines)
+    picked = [pool.pick() for _ in range(6)]
+    assert set(picked) == set(engines)
+    assert picked[:3] == picked[3:]
+
+
+def test_weighted_policy():
+    engines = _make_engines(2)
+    pool = ReplicaPool("database1", engines, policy="weighted", weights=[3, 1])
+    picked = [pool.pick() for _ in range(8)]
+    assert picked.count(engines[0]) == 6
+    assert picked.count(engines[1]) == 2
+
+
+def test_least_in_flight_policy():
+    engines = _make_engines(2)
+    pool = ReplicaPool("database1", engines, policy="least_in_flight")
+    with engines[0].connect():
+        assert pool.pick() is engines[1]
+    assert pool.replicas[0].in_flight == 0
+
+
+def test_unhealthy_replica_is_out_of_rotation():
+    engines = _make_engines(2)
+    pool = ReplicaPool("database1", engines, retry_interval=3600)
+    pool.mark_down(engines[0], "connection refused")
+    assert {pool.pick() for _ in range(4)} == {engines[1]}
+
+    pool.mark_down(engines[1], "connection refused")
+    assert pool.pick() is None
+
+    assert pool.ping(engines[0])
+    assert pool.pick() is engines[0]
+
+
+def test_invalid_policy():
+    try:
+        ReplicaPool("database1", _make_engines(1), policy="random")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("ValueError is expected")
+
+
+def test_lagging_replica_is_skipped():
+    engines = _make_engines(2)
+    pool = ReplicaPool("database1", engines, max_lag=5, lag_query="SELECT 10")
+    pool.check_lag()
+    assert pool.pick() is None
+
+    pool.max_lag = 30
+    assert pool.pick() in engines
+
+
+def test_stopped_replication_is_lagging():
+    engines = _make_engines(2)
+    # the lag of a stopped replication is NULL
+    pool = ReplicaPool("database1", engines, max_lag=5, lag_query="SELECT NULL")
+    pool.check_lag()
+    assert pool.pick() is None
+    assert pool.replicas[0].to_dict()["replication_stopped"] and pool.replicas[0].to_dict()["lag"] is None
+
+    # no row, the lag can not be measured
+    pool = ReplicaPool("database1", engines, max_lag=5, lag_query="SELECT 1 WHERE 0")
+    pool.check_lag()
+    assert pool.replicas[0].lag is None and pool.pick() in engines
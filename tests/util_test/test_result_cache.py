@@ -0,0 +1,127 @@
+import time
+
+from sqlalchemy import Column, Integer, create_engine, insert, update
+from sqlalchemy.orm import Session
+
+from macroflask.system.model_ext import base_model
+from macroflask.system.model_ext.base_model import ModelExtMixin, result_cache
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+from macroflask.util.result_cache import ResultCache
+from tests.conftest import Base, Device
+
+
+class TrackedSession(Session):
+    pass
+
+
+def test_result_cache():
+    cache = ResultCache(max_size=2)
+    cache.track_writes(TrackedSession)
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+
+    def read(key, ttl=10):
+        versions = cache.get_versions(["device"])
+        result = cache.get(key, versions)
+        if result is None:
+            with TrackedSession(engine) as session:
+                result = [device.name for device in session.query(Device).order_by(Device.id)]
+            cache.put(key, versions, result, ttl)
+        return result
+
+    assert read("all") == [] and read("all") == []
+    assert cache.hits == 1
+
+    # a commit writing to the table makes the result stale, a rollback does not
+    with TrackedSession(engine) as session:
+        session.add(Device(id=1, name="router"))
+        session.flush()
+        session.rollback()
+    assert read("all") == [] and cache.hits == 2
+    with TrackedSession(engine) as session, session.begin():
+        session.add(Device(id=1, name="router"))
+    assert read("all") == ["router"]
+    with TrackedSession(engine) as session, session.begin():
+        session.execute(update(Device).values(name="switch"))
+    assert read("all") == ["switch"]
+
+    # the ttl and the size bound the entries
+    assert read("short", ttl=0.05) == ["switch"]
+    time.sleep(0.06)
+    read("short", ttl=0.05)
+    read("third")
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["stale"] == 3 and stats["evictions"] == 1 and stats["hits"] == 2
+    engine.dispose()
+
+
+class CachedDevice(Base, ModelExtMixin):
+    __tablename__ = "cached_device"
+    id = Column(Integer, primary_key=True)
+    result_cache_ttl = 60
+
+
+def test_replica_reads_are_cached_once_caught_up(tmp_path, monkeypatch):
+    primary_url, replica_url = f"sqlite:///{tmp_path / 'primary.db'}", f"sqlite:///{tmp_path / 'replica.db'}"
+    db = LightSqlAlchemy(db_config={
+        "database1": {"url": primary_url, "model_class": Base},
+        "database1_read": {"url": [replica_url], "model_class": Base, "db_operation_type": "read",
+                           "replica_options": {"lag_query": "SELECT 0"}},
+    })
+    replica_pool = db.replica_pools["database1_read"]
+    for engine in (db.engines["write"]["database1"], replica_pool.engines[0]):
+        Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(CachedDevice), [{"id": 1}])
+    monkeypatch.setattr(base_model, "db", db)
+    monkeypatch.setattr(result_cache, "_versions", {})
+    monkeypatch.setattr(result_cache, "_write_times", {})
+    result_cache.clear()
+
+    def read_ids():
+        rows = CachedDevice.read_all({"pagination": {"page": 1, "page_count": 10},
+                                      "sorting": {"sort_by": "id", "order": "asc"}})
+        return [row["id"] for row in rows]
+
+    assert read_ids() == [1] and read_ids() == [1] and result_cache.hits == 1
+
+    # the replica has not replayed the write yet, its rows are not cached under the new version
+    with db.get_db_session() as session:
+        session.add(CachedDevice(id=2))
+    assert read_ids() == [1] and read_ids() == [1]
+    assert result_cache.hits == 1 and result_cache.stats()["entries"] == 0
+
+    # caught up according to a lag measured after the write
+    with replica_pool.engines[0].begin() as connection:
+        connection.execute(insert(CachedDevice), [{"id": 2}])
+    replica_pool.check_lag()
+    assert read_ids() == [1, 2] and read_ids() == [1, 2] and result_cache.hits == 2
+
+    # the reads pinned to the primary after a write skip the cache
+    db.set_consistency_options(read_your_writes=True)
+    with db.get_db_session() as session:
+        session.add(CachedDevice(id=3))
+    assert read_ids() == [1, 2, 3] and read_ids() == [1, 2, 3]
+    assert result_cache.hits == 2 and result_cache.misses == 4
+    db.dispose_engine()
+
+
+def test_inserts_bump_versions(make_db):
+    db = make_db("insert")
+
+    def get_version():
+        return result_cache.get_versions(["cached_device"])[0]
+
+    # the bulk writes bypass the sessions
+    version = get_version()
+    db.bulk_insert(CachedDevice, [{"id": 1}])
+    db.bulk_upsert(CachedDevice, [{"id": 1}])
+    assert get_version() == version + 2
+
+    with db.get_db_session() as session:
+        session.execute(insert(CachedDevice), [{"id": 2}])
+    assert get_version() == version + 3
+    with db.get_db_session() as session:
+        session.execute(insert(CachedDevice), [{"id": 3}])
+        session.rollback()
+    assert get_version() == version + 3
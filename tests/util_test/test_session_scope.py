@@ -0,0 +1,59 @@
+import asyncio
+import contextvars
+
+import greenlet
+import pytest
+
+from tests.conftest import Device
+
+
+@pytest.mark.parametrize("session_scope", ["greenlet", "context"])
+def test_one_session_per_greenlet(make_db, session_scope):
+    db = make_db(session_scope=session_scope)
+    sessions = []
+
+    def poll(device_id):
+        with db.get_db_session() as session:
+            session.add(Device(id=device_id))
+            sessions.append(session)
+            # another greenlet runs while this one waits, e.g. for an SSH command
+            greenlet.getcurrent().parent.switch()
+            sessions.append(db.sessions["write"]())
+
+    first, second = greenlet.greenlet(poll), greenlet.greenlet(poll)
+    # a greenlet started in a copy of the context, as gevent.spawn does
+    if session_scope == "context":
+        first.gr_context, second.gr_context = contextvars.Context(), contextvars.Context()
+    first.switch(1)
+    second.switch(2)
+    first.switch()
+    second.switch()
+
+    # each greenlet got its own session from the registry, and kept it across the switch
+    assert sessions[0] is sessions[2] and sessions[1] is sessions[3] and sessions[0] is not sessions[1]
+    with db.get_db_session() as session:
+        assert session.query(Device).count() == 2
+
+
+def test_one_session_per_task(make_db):
+    db = make_db(session_scope="context")
+
+    async def use_session():
+        session = db.sessions["write"]()
+        await asyncio.sleep(0)
+        return session, db.sessions["write"]()
+
+    async def run():
+        # the tasks are started in copies of the context of the parent, which already has a session
+        parent_session = db.sessions["write"]()
+        results = await asyncio.gather(use_session(), use_session())
+        return parent_session, results, db.sessions["write"]()
+
+    parent_session, [(first, first_again), (second, second_again)], parent_again = asyncio.run(run())
+    assert first is first_again and second is second_again and parent_session is parent_again
+    assert len({id(parent_session), id(first), id(second)}) == 3
+
+
+def test_invalid_session_scope(make_db):
+    with pytest.raises(ValueError):
+        make_db(session_scope="process")
@@ -0,0 +1,115 @@
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.system.model_ext.query_processor import QueryProcessor, QueryRequest
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+from macroflask.util.shard_set import ShardSet
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class DeviceResult(Base):
+    __tablename__ = "device_result"
+    __shard_key__ = "device_id"
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer)
+    output = Column(String(64))
+
+
+def test_shard_ids_for_criteria():
+    shard_set = ShardSet("results", [create_engine("sqlite://") for _ in range(4)])
+    assert shard_set.shard_id_for(42) == shard_set.shard_id_for("42")
+
+    statement = select(DeviceResult).where(DeviceResult.device_id == 42, DeviceResult.output == "ok")
+    assert shard_set.shard_ids_for_criteria(DeviceResult, statement.whereclause) == [shard_set.shard_id_for(42)]
+
+    statement = select(DeviceResult).where(DeviceResult.device_id.in_([1, 2, 3]))
+    expected = sorted({shard_set.shard_id_for(value) for value in (1, 2, 3)})
+    assert shard_set.shard_ids_for_criteria(DeviceResult, statement.whereclause) == expected
+
+    # an OR may match rows of every shard
+    statement = select(DeviceResult).where((DeviceResult.device_id == 1) | (DeviceResult.output == "ok"))
+    assert shard_set.shard_ids_for_criteria(DeviceResult, statement.whereclause) == [0, 1, 2, 3]
+
+
+def test_sharded_bind(tmp_path):
+    db_config = {"results": {"shards": [f"sqlite:///{tmp_path / 'shard0.db'}", f"sqlite:///{tmp_path / 'shard1.db'}"],
+                             "model_class": Base}}
+    db = LightSqlAlchemy(db_config=db_config)
+    shard_set = db.shard_sets["results"]
+    for engine in shard_set.engines:
+        Base.metadata.create_all(engine)
+
+    with db.get_db_session() as session:
+        session.add_all([DeviceResult(device_id=device_id, output=f"output-{device_id}") for device_id in range(1, 7)])
+    db.bulk_insert(DeviceResult, [{"device_id": device_id, "output": "bulk"} for device_id in range(7, 11)])
+
+    # each row is stored on the shard of its device id
+    for shard_id, engine in enumerate(shard_set.engines):
+        with engine.connect() as connection:
+            device_ids = connection.exec_driver_sql("SELECT device_id FROM device_result").scalars().all()
+        assert device_ids and all(shard_set.shard_id_for(device_id) == shard_id for device_id in device_ids)
+
+    with db.get_db_session() as session:
+        # the same primary keys exist on both shards, the identity token keeps the objects apart
+        assert len(session.query(DeviceResult).all()) == 10
+        result = session.query(DeviceResult).filter(DeviceResult.device_id == 4).one()
+        result.output = "changed"
+
+    with db.get_db_session() as session:
+        assert session.query(DeviceResult).filter(DeviceResult.device_id == 4).one().output == "changed"
+
+        request = QueryRequest({"pagination": {"page": 2, "page_count": 3},
+                                "sorting": {"sort_by": "device_id", "order": "desc"},
+                                "need_fields": ["output"]})
+        # device ids 10 to 1 merged from both shards, the second page is 7, 6 and 5
+        assert QueryProcessor(DeviceResult, session, None, request).process() == \
+            [{"output": "bulk"}, {"output": "output-6"}, {"output": "output-5"}]
+
+        # cursor pagination merges the rows past the cursor of each shard
+        request = QueryRequest({"pagination": {"after": None, "page_count": 4},
+                                "sorting": {"sort_by": "device_id", "order": "asc"}, "need_fields": ["device_id"]})
+        processor = QueryProcessor(DeviceResult, session, None, request)
+        assert [row["device_id"] for row in processor.process()] == [1, 2, 3, 4]
+        request = QueryRequest({"pagination": {"after": processor.next_cursor, "page_count": 4},
+                                "sorting": {"sort_by": "device_id", "order": "asc"}, "need_fields": ["device_id"]})
+        processor = QueryProcessor(DeviceResult, session, None, request)
+        assert [row["device_id"] for row in processor.process()] == [5, 6, 7, 8]
+        assert processor.next_cursor is not None and processor.prev_cursor is not None
+
+        # the total of a sharded model sums the counts of the shards, the window total falls back to it
+        request = QueryRequest({"pagination": {"page": 1, "page_count": 3}, "with_total": "window"})
+        processor = QueryProcessor(DeviceResult, session, None, request)
+        assert len(processor.process()) == 3 and processor.total == 10
+    db.dispose_engine()
+
+
+def test_sharded_primary_key_lookup(tmp_path):
+    db_config = {"results": {"shards": [f"sqlite:///{tmp_path / 'shard0.db'}", f"sqlite:///{tmp_path / 'shard1.db'}"],
+                             "model_class": Base}}
+    db = LightSqlAlchemy(db_config=db_config)
+    shard_set = db.shard_sets["results"]
+    for engine in shard_set.engines:
+        Base.metadata.create_all(engine)
+    # the first row of each shard has the primary key 1
+    db.bulk_insert(DeviceResult, [{"device_id": device_id, "output": f"output-{device_id}"} for device_id in (1, 4)])
+    assert shard_set.shard_id_for(1) != shard_set.shard_id_for(4)
+
+    with db.get_db_session() as session:
+        # without the shard key, the lookup would read the row of each shard
+        with pytest.raises(ValueError, match="device_id"):
+            session.get(DeviceResult, 1)
+        with pytest.raises(ValueError, match="device_id"):
+            session.query(DeviceResult).filter(DeviceResult.id == 1).one()
+
+        for device_id in (1, 4):
+            result = session.query(DeviceResult).filter(DeviceResult.id == 1, DeviceResult.device_id == device_id).one()
+            # the refresh of an expired object is a primary key lookup on the shard of the object
+            session.expire(result)
+            assert result.output == f"output-{device_id}"
+        # a filter which is not a primary key lookup still reads all the shards
+        assert len(session.query(DeviceResult).filter(DeviceResult.id >= 1).all()) == 2
+    db.dispose_engine()
@@ -0,0 +1,60 @@
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+from macroflask.util.slow_query_log import SlowQueryLog, fingerprint
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Interface(Base):
+    __tablename__ = "interface"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+def test_fingerprint():
+    assert fingerprint("SELECT * FROM user WHERE id = 42 AND name = 'it''s'") == \
+        "SELECT * FROM user WHERE id = ? AND name = ?"
+    assert fingerprint("SELECT a FROM t WHERE id IN (%s, %s, %s)\n  LIMIT %(param_1)s") == \
+        "SELECT a FROM t WHERE id IN (?+) LIMIT ?"
+    assert fingerprint("INSERT INTO t (a, b) VALUES ($1, $2), ($3, $4)") == "INSERT INTO t (a, b) VALUES (?+)"
+    assert fingerprint("SELECT t.col_1 FROM t2 WHERE x = :x_1") == "SELECT t.col_1 FROM t2 WHERE x = ?"
+
+
+def test_slow_query_aggregates():
+    slow_query_log = SlowQueryLog(threshold_ms=100)
+    for duration in (0.01, 0.02, 0.5):
+        slow_query_log.record("write:database1", "SELECT 1 FROM t WHERE id = 1", duration, 1, "uuid-1")
+    slow_query_log.record("write:database1", "UPDATE t SET a = 2", 0.001, 3)
+
+    entries = slow_query_log.get_entries()
+    assert len(entries) == 1
+    assert entries[0]["request_uuid"] == "uuid-1"
+    assert entries[0]["fingerprint"] == "SELECT ? FROM t WHERE id = ?"
+
+    aggregates = slow_query_log.get_aggregates(order_by="total_ms")
+    assert [aggregate["count"] for aggregate in aggregates] == [3, 1]
+    assert aggregates[0]["p50_ms"] == 20
+    assert aggregates[0]["p99_ms"] == 500
+
+
+def test_slow_query_options(tmp_path):
+    db_config = {"database1": {"url": f"sqlite:///{tmp_path / 'slow.db'}", "model_class": Base}}
+    db = LightSqlAlchemy(db_config=db_config, slow_query_options={"threshold_ms": 0})
+    Base.metadata.create_all(db.engines["write"]["database1"])
+
+    with db.track_statements("task-1"):
+        with db.get_db_session() as session:
+            session.get(Interface, 1)
+
+    slow_queries = db.get_slow_queries()
+    assert slow_queries["entries"][0]["request_uuid"] == "task-1"
+    assert slow_queries["entries"][0]["engine"] == "write:database1"
+    assert any("FROM interface WHERE interface.id = ?" in item["fingerprint"] for item in slow_queries["fingerprints"])
+
+    db.set_slow_query_options(threshold_ms=None)
+    assert db.get_slow_queries() == {}
+    db.dispose_engine()
@@ -0,0 +1,41 @@
+import logging
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import DeclarativeBase
+
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Host(Base):
+    __tablename__ = "host"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+def test_track_statements(tmp_path, caplog):
+    db_config = {"database1": {"url": f"sqlite:///{tmp_path / 'stats.db'}", "model_class": Base}}
+    db = LightSqlAlchemy(db_config=db_config, logger=logging.getLogger("test_statement_stats"),
+                         statement_options={"statement_budget": 5, "repeat_threshold": 3})
+    Base.metadata.create_all(db.engines["write"]["database1"])
+
+    # statements outside track_statements are not recorded
+    with db.get_db_session() as session:
+        session.get(Host, 100)
+    assert db.get_statement_stats() is None
+
+    with caplog.at_level(logging.WARNING, logger="test_statement_stats"):
+        with db.track_statements("task-1") as stats:
+            with db.get_db_session() as session:
+                for index in range(6):
+                    session.get(Host, index)
+
+    assert stats.count == 6
+    assert stats.db_time > 0
+    assert stats.to_dict()["distinct_statements"] == 1
+    assert "task-1 executed 6 statements" in caplog.text
+    assert "possible N+1 query, the same statement was executed 6 times" in caplog.text
+    db.dispose_engine()
@@ -0,0 +1,41 @@
+from sqlalchemy import select
+
+from tests.conftest import Device
+
+
+def test_stream(make_db):
+    db = make_db()
+    db.bulk_insert(Device, ({"id": i, "name": f"device-{i}"} for i in range(1, 101)))
+
+    with db.get_db_session() as session:
+        devices = db.stream(session.query(Device).order_by(Device.id), batch_size=10)
+        assert [device.id for device in devices] == list(range(1, 101))
+
+        rows = list(db.stream(session.query(Device).filter(Device.id > 98), batch_size=10, plain_rows=True))
+        assert [(row["id"], row["name"]) for row in rows] == [(99, "device-99"), (100, "device-100")]
+        assert set(rows[0]) == {column.key for column in Device.__table__.columns}
+
+        names = db.stream(select(Device.name).order_by(Device.id), batch_size=10, db_operation_type="write")
+        assert next(names) == ("device-1",)
+        # the cursor is released when the caller stops early
+        names.close()
+        assert session.get(Device, 100).name == "device-100"
+
+
+def test_stream_select_session(make_db):
+    db = make_db()
+    db.bulk_insert(Device, ({"id": i, "name": f"device-{i}"} for i in range(1, 21)))
+
+    # outside get_db_session() the Select runs on a session of its own, ended with the iteration
+    assert [device.id for device in db.stream(select(Device), batch_size=5, db_operation_type="write")] == \
+        list(range(1, 21))
+    assert not db.sessions["write"].registry.has()
+    names = db.stream(select(Device.name), batch_size=5, db_operation_type="write")
+    assert next(names) == ("device-1",)
+    names.close()
+    assert not db.sessions["write"].registry.has()
+
+    # inside get_db_session() the session is left to the caller
+    with db.get_db_session() as session:
+        assert len(list(db.stream(select(Device.id), db_operation_type="write"))) == 20
+        assert db.sessions["write"]() is session
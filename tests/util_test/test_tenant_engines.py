@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from macroflask.util.light_sqlalchemy import LightSqlAlchemy
+from tests.conftest import Base, Device
+
+
+def make_tenant_db(tmp_path, **tenant_options):
+    db_config = {"customers": {"tenant_url": f"sqlite:///{tmp_path}/customer_{{tenant_id}}.db", "model_class": Base,
+                               "engine_options": {"pool_size": 2, "max_overflow": 0},
+                               "tenant_options": tenant_options}}
+    return LightSqlAlchemy(db_config=db_config)
+
+
+def test_tenant_databases(tmp_path):
+    db = make_tenant_db(tmp_path, max_engines=2)
+    tenant_engines = db.tenant_engines["customers"]
+
+    with pytest.raises(ValueError):
+        with db.get_db_session() as session:
+            session.query(Device).all()
+
+    for tenant_id in (1, 2, 3):
+        with db.use_tenant(tenant_id):
+            Base.metadata.create_all(db.get_write_engine(Device))
+            with db.get_db_session() as session:
+                session.add(Device(id=1, name=f"router of {tenant_id}"))
+            db.bulk_insert(Device, [{"id": 2, "name": f"switch of {tenant_id}"}])
+
+    # the engine of the least recently used tenant has been disposed, it is created again on use
+    assert len(tenant_engines.engines) == 2
+    with db.use_tenant(1), db.get_db_session() as session:
+        assert [device.name for device in session.query(Device).order_by(Device.id)] == \
+            ["router of 1", "switch of 1"]
+
+    stats = db.get_pool_metrics()["tenant_engines"][0]
+    assert stats["engines"] == 2 and stats["created"] == 4 and stats["evicted"] == 2
+    assert len([name for name in db.pool_metrics if name.startswith("write:customers")]) == 2
+    db.dispose_engine()
+
+
+def test_tenant_connection_cap_and_idle(tmp_path):
+    db = make_tenant_db(tmp_path, max_connections=4, idle_timeout=0.1)
+    tenant_engines = db.tenant_engines["customers"]
+
+    first = tenant_engines.get_engine(1)
+    connection = first.connect()
+    tenant_engines.get_engine(2)
+    # a third pool of 2 connections goes over the cap, the engine in use is kept
+    tenant_engines.get_engine(3)
+    assert tenant_engines.engines == [first, tenant_engines.get_engine(3)]
+    connection.close()
+
+    time.sleep(0.15)
+    assert tenant_engines.reap_idle() == 2
+    assert tenant_engines.engines == []
+    db.dispose_engine()